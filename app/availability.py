@@ -0,0 +1,323 @@
+import bisect
+import datetime
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.config import AVAILABILITY_INDEX_ENABLED, AVAILABILITY_RELOAD_SECONDS, AVAILABILITY_MAX_NIGHTS, get_logger
+from app.database import Booking, Room, get_booked_rooms
+
+logger = get_logger(__name__)
+
+# Night n of the calendar is the night starting on _EPOCH + n days
+_EPOCH = datetime.date(2000, 1, 1)
+
+
+def _night(day: datetime.date) -> int:
+    return max((day - _EPOCH).days, 0)
+
+
+def _stay(check_in: datetime.datetime, check_out: datetime.datetime) -> Tuple[int, int]:
+    """The nights a booking holds, as a [first, end) range: check-in day up to the check-out day."""
+    return _night(check_in.date()), _night(check_out.date())
+
+
+def _mask(first: int, end: int) -> int:
+    return ((1 << (end - first)) - 1) << first if end > first else 0
+
+
+# --- Availability calendar --- #
+
+class AvailabilityCalendar:
+    """
+    In-memory calendar of booked nights, one bitmap per room.
+
+    Bit n of a room's bitmap is set when an active booking holds the night
+    starting n days after 2000-01-01, so "is the room free for these nights" is
+    one AND against a mask, and a query over the whole property costs one AND
+    per room whatever the booking history. The bookings in the way of a booked
+    room are found by bisecting its stays sorted by first night. Bookings
+    written through the ORM in this process are applied on commit. Bookings
+    inserted by other processes are picked up by id on every refresh;
+    cancellations and date changes made elsewhere by the full reload every
+    AVAILABILITY_RELOAD_SECONDS. Until then such a room only shows as booked,
+    never as free by mistake.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bits: Dict[str, int] = {}  # room_number -> booked nights
+        self._stays: Dict[str, List[Tuple[int, int, int]]] = {}  # room_number -> sorted (first, end, booking_id)
+        self._longest: Dict[str, int] = {}  # room_number -> most nights of any stay seen, to bound the bisect
+        self._stay_of: Dict[int, Tuple[str, int, int]] = {}  # booking_id -> (room_number, first, end)
+        self._floors: Dict[str, Optional[int]] = {}  # registered rooms -> floor
+        self._max_id = 0
+        self._loaded_at: Optional[float] = None
+        self._rooms_changed = False
+        self._loading = 0  # loads in progress; changes committed meanwhile are kept in _pending
+        self._pending: Dict[int, Optional[Tuple[str, Tuple[int, int]]]] = {}
+
+    def invalidate(self):
+        """Reloads the whole calendar on next refresh."""
+        with self._lock:
+            self._loaded_at = None
+
+    def invalidate_rooms(self):
+        with self._lock:
+            self._rooms_changed = True
+
+    def refresh(self, session: Session):
+        """Loads the calendar on first use or when it is due a reload, else reads bookings newer than the last one seen."""
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > AVAILABILITY_RELOAD_SECONDS:
+            self._load(session)
+            return
+        if self._rooms_changed:
+            self._load_rooms(session)
+        rows = self._query(session).filter(Booking.id > self._max_id).all()
+        if rows:
+            with self._lock:
+                for row in rows:
+                    self._discard(row.id)
+                    self._add(row.id, row.room_number, *_stay(row.check_in_date, row.check_out_date))
+                    self._max_id = max(self._max_id, row.id)
+            logger.debug(f"Availability calendar picked up {len(rows)} new bookings")
+
+    @staticmethod
+    def _query(session: Session):
+        return session.query(Booking.id, Booking.room_number, Booking.check_in_date, Booking.check_out_date).filter(
+            Booking.is_cancelled.isnot(True)
+        )
+
+    def _load(self, session: Session):
+        """
+        Reads every active booking and swaps in the new calendar. Bookings
+        inserted during the read have ids above `max_id`, which is taken first,
+        so the next refresh picks them up; changes committed in this process
+        during the read are replayed onto the new calendar.
+        """
+        started = time.monotonic()
+        with self._lock:
+            self._loading += 1
+        try:
+            max_id = session.query(Booking.id).order_by(Booking.id.desc()).limit(1).scalar() or 0
+            rows = self._query(session).all()
+            bits, stays, longest, stay_of = {}, {}, {}, {}
+            for row in rows:
+                first, end = _stay(row.check_in_date, row.check_out_date)
+                stays.setdefault(row.room_number, []).append((first, end, row.id))
+                stay_of[row.id] = (row.room_number, first, end)
+            for room_number, room_stays in stays.items():
+                room_stays.sort()
+                bits[room_number] = self._combine(room_stays)
+                longest[room_number] = max(end - first for first, end, _ in room_stays)
+            with self._lock:
+                self._bits, self._stays, self._longest, self._stay_of = bits, stays, longest, stay_of
+                self._max_id, self._loaded_at = max_id, started
+                self._apply(self._pending)
+        finally:
+            with self._lock:
+                self._loading -= 1
+                if not self._loading:
+                    self._pending = {}
+        self._load_rooms(session)
+        logger.info(f"Availability calendar loaded with {len(rows)} bookings in {time.monotonic() - started:.2f}s")
+
+    def _load_rooms(self, session: Session):
+        rows = session.query(Room.room_number, Room.floor).all()
+        with self._lock:
+            self._floors = {row.room_number: row.floor for row in rows}
+            self._rooms_changed = False
+
+    def apply(self, changes: Dict[int, Optional[Tuple[str, Tuple[int, int]]]]):
+        """Applies committed changes: booking_id -> (room_number, (first, end)), or None once cancelled or deleted."""
+        with self._lock:
+            if self._loading:
+                self._pending.update(changes)  # the load in progress may have read the rows before these commits
+            if self._loaded_at is None:
+                return  # the next refresh reads the committed state anyway
+            self._apply(changes)
+
+    def _apply(self, changes: Dict[int, Optional[Tuple[str, Tuple[int, int]]]]):
+        for booking_id, entry in changes.items():
+            self._discard(booking_id)
+            if entry is not None:
+                room_number, (first, end) = entry
+                self._add(booking_id, room_number, first, end)
+        # _max_id stays put: another worker may still commit a lower id, and re-reading ours is harmless
+
+    @staticmethod
+    def _combine(stays) -> int:
+        bits = 0
+        for first, end, _ in stays:
+            bits |= _mask(first, end)
+        return bits
+
+    def _add(self, booking_id: int, room_number: str, first: int, end: int):
+        bisect.insort(self._stays.setdefault(room_number, []), (first, end, booking_id))
+        self._stay_of[booking_id] = (room_number, first, end)
+        self._longest[room_number] = max(self._longest.get(room_number, 0), end - first)
+        self._bits[room_number] = self._bits.get(room_number, 0) | _mask(first, end)
+
+    def _discard(self, booking_id: int):
+        entry = self._stay_of.pop(booking_id, None)
+        if entry is None:
+            return
+        room_number, first, end = entry
+        room_stays = self._stays[room_number]
+        del room_stays[bisect.bisect_left(room_stays, (first, end, booking_id))]
+        # Other bookings may share the nights (older data has overlaps), so put back what they still hold
+        cleared = self._bits[room_number] & ~_mask(first, end)
+        self._bits[room_number] = cleared | (self._combine(self._overlapping(room_number, first, end)) & _mask(first, end))
+
+    def _overlapping(self, room_number: str, first: int, end: int) -> List[Tuple[int, int, int]]:
+        """Stays of the room holding any night in [first, end)."""
+        room_stays = self._stays.get(room_number, [])
+        # A stay starting before first - longest cannot reach first
+        lo = bisect.bisect_left(room_stays, (first - self._longest.get(room_number, 0) + 1,))
+        hi = bisect.bisect_left(room_stays, (end,))
+        return [stay for stay in room_stays[lo:hi] if stay[1] > first]
+
+    def rooms(self, floor: Optional[int] = None) -> List[str]:
+        """Registered rooms, or every room with a booking when none are registered."""
+        with self._lock:
+            if self._floors:
+                return sorted(r for r, f in self._floors.items() if floor is None or f == floor)
+            if floor is not None:
+                return []
+            return sorted(r for r, stays in self._stays.items() if stays)
+
+    def booked(self, first_night: datetime.date, end_night: datetime.date, rooms: List[str]) -> Dict[str, List[int]]:
+        """Returns {room_number: [booking ids]} for the given rooms with a booking holding any of the nights."""
+        first, end = _night(first_night), _night(end_night)
+        mask = _mask(first, end)
+        booked = {}
+        with self._lock:
+            for room_number in rooms:
+                if self._bits.get(room_number, 0) & mask:
+                    booked[room_number] = [booking_id for _, _, booking_id in self._overlapping(room_number, first, end)]
+        return booked
+
+    def __len__(self):
+        return len(self._stay_of)
+
+
+calendar = AvailabilityCalendar()
+
+
+@event.listens_for(Booking, "after_insert")
+@event.listens_for(Booking, "after_update")
+def _track_booking_change(mapper, connection, target):
+    """Remembers changed bookings on the session until the transaction commits."""
+    session = Session.object_session(target)
+    if session is None or target.id is None:
+        return
+    entry = None if target.is_cancelled else (target.room_number, _stay(target.check_in_date, target.check_out_date))
+    session.info.setdefault("availability_changes", {})[target.id] = entry
+
+
+@event.listens_for(Booking, "after_delete")
+def _track_booking_delete(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None and target.id is not None:
+        session.info.setdefault("availability_changes", {})[target.id] = None
+
+
+@event.listens_for(Room, "after_insert")
+@event.listens_for(Room, "after_update")
+@event.listens_for(Room, "after_delete")
+def _track_room_change(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info["availability_rooms_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _flush_availability_changes(session):
+    changes = session.info.pop("availability_changes", None)
+    if changes:
+        calendar.apply(changes)
+    if session.info.pop("availability_rooms_changed", False):
+        calendar.invalidate_rooms()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_availability_changes(session):
+    session.info.pop("availability_changes", None)
+    session.info.pop("availability_rooms_changed", None)
+
+
+# --- Queries --- #
+
+def check_range(first_night: datetime.date, end_night: datetime.date):
+    """Raises ValueError unless the range covers between one and AVAILABILITY_MAX_NIGHTS nights."""
+    nights = (end_night - first_night).days
+    if nights < 1:
+        raise ValueError("The end date must be after the start date")
+    if nights > AVAILABILITY_MAX_NIGHTS:
+        raise ValueError(f"Ask about at most {AVAILABILITY_MAX_NIGHTS} nights at a time")
+
+
+def find_available_rooms(session: Session, first_night: datetime.date, end_night: datetime.date, floor: Optional[int] = None) -> dict:
+    """
+    Answers "which rooms are free from first_night until end_night" (the
+    check-out day, so Friday to Sunday is two nights) across the property.
+
+    Uses the in-memory calendar, or the (room, check-in, check-out) indexed
+    overlap query when AVAILABILITY_INDEX_ENABLED is off. Returns the free
+    rooms and, for each booked room, the bookings in the way.
+    """
+    check_range(first_night, end_night)
+    if AVAILABILITY_INDEX_ENABLED:
+        calendar.refresh(session)
+        rooms = calendar.rooms(floor)
+        booked = calendar.booked(first_night, end_night, rooms)
+    else:
+        booked = get_booked_rooms(session, first_night, end_night)
+        registered = session.query(Room.room_number)
+        if floor is not None:
+            registered = registered.filter(Room.floor == floor)
+        rooms = sorted(row.room_number for row in registered) or ([] if floor is not None else sorted(booked))
+        wanted = set(rooms)
+        booked = {room: ids for room, ids in booked.items() if room in wanted}
+    return {
+        "start": first_night.isoformat(),
+        "end": end_night.isoformat(),
+        "nights": (end_night - first_night).days,
+        "free": [room for room in rooms if room not in booked],
+        "booked": booked,
+    }
+
+
+_WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+_DAY_MONTH = re.compile(r"^(\d{1,2})/(\d{1,2})$")
+
+
+def parse_day(text: str, today: Optional[datetime.date] = None, after: Optional[datetime.date] = None) -> datetime.date:
+    """
+    Reads a day as people type it: 2026-10-23, 23/10, today, tomorrow, or a
+    weekday name (fri, friday) for its next occurrence from today, or from
+    `after` for the end of a range. Raises ValueError otherwise.
+    """
+    today = today or datetime.date.today()
+    text = text.strip().lower()
+    if text == "today":
+        return today
+    if text == "tomorrow":
+        return today + datetime.timedelta(days=1)
+    for number, name in enumerate(_WEEKDAYS):
+        if len(text) >= 3 and name.startswith(text):
+            start = after + datetime.timedelta(days=1) if after else today
+            return start + datetime.timedelta(days=(number - start.weekday()) % 7)
+    match = _DAY_MONTH.match(text)
+    if match:
+        day = datetime.date(today.year, int(match.group(2)), int(match.group(1)))
+        return day if day >= today else day.replace(year=today.year + 1)
+    try:
+        return datetime.date.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"Cannot read '{text}' as a day; use YYYY-MM-DD, DD/MM, today, tomorrow or a weekday") from None
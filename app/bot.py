@@ -0,0 +1,483 @@
+import asyncio
+import datetime
+import functools
+import time
+from telegram import Update, WebAppInfo, KeyboardButton, ReplyKeyboardMarkup
+from telegram.error import RetryAfter
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+
+from app.config import (
+    TELEGRAM_BOT_TOKEN, AUTHORIZED_USER_ID, LLM_STREAM_EDIT_INTERVAL,
+    TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_PATH, TELEGRAM_WEBHOOK_SECRET,
+    TELEGRAM_CONCURRENT_UPDATES, TELEGRAM_UPDATE_QUEUE_SIZE, TELEGRAM_API_URL,
+    RETRIEVAL_ENABLED, RETRIEVAL_TOP_K,
+    get_logger
+)
+from app.database import (
+    get_async_db, run_write, db_writer, pool_stats, find_booking_by_details, verify_payment, DuplicateSlip, get_daily_report_data, get_report_data
+)
+from app.ocr_engine import OCRQueueFull
+from app import retrieval
+from app import availability
+from app import conversation
+from app import dispatcher
+from app import metrics
+from app import subsystems
+from app.subsystems import SubsystemUnavailable
+
+logger = get_logger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Time to handle a Telegram update, by handler and outcome.", ["handler", "outcome"])
+
+# --- Authorization ---
+def is_authorized(update: Update) -> bool:
+    """Checks if the user is authorized to use the bot."""
+    return update.effective_user.id == AUTHORIZED_USER_ID
+
+# --- Instrumentation ---
+def instrumented(handler):
+    """Times a bot handler, counts its failures and tags its log lines with the update's trace id."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        token = metrics.trace_id.set(f"u{update.update_id}")
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await handler(update, context)
+            outcome = "ok"
+            return result
+        finally:
+            HANDLER_SECONDS.labels(handler=handler.__name__, outcome=outcome).observe(time.perf_counter() - started)
+            metrics.trace_id.reset(token)
+    return wrapper
+
+# --- Telegram Bot Handlers ---
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update):
+        await update.message.reply_text("You are not authorized to use this bot.")
+        return
+
+    # Create a button that opens the web app
+    web_app_button = KeyboardButton(
+        "Open Hotel OS Web App",
+        web_app=WebAppInfo(url=f"https://nssuwan186-Bot-telegram.hf.space/static/index.html")
+    )
+    keyboard = [[web_app_button]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+    await update.message.reply_text(
+        "Welcome to Hotel OS! Use the button below to manage payments and expenses.",
+        reply_markup=reply_markup
+    )
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update): return
+    help_text = """
+    Available Commands:
+    /start - Show the main menu and Web App button.
+    /help - Show this help message.
+    /daily_report - Get a summary of today's income and expenses.
+    /weekly_report - Income and expenses since Monday, day by day.
+    /monthly_report - Income and expenses since the 1st of the month, day by day.
+    /availability <from> [to] [floor N] - Free rooms for the nights from one day to the check-out day.
+      Days: 2026-10-23, 23/10, today, tomorrow or a weekday (fri). Default is one night.
+    /light [target] <ON|OFF> - Control the lights.
+    /ac [target] <ON|OFF|temperature> - Control the AC.
+      target: a room (12), rooms (12,14), floor 3, all or vacant.
+    /status - Show the last reported state of each device and database pool usage.
+
+    You can also send me a payment slip image to verify it, or ask me anything else.
+    """
+    await update.message.reply_text(help_text)
+
+async def daily_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update): return
+    today = datetime.date.today()
+    async with get_async_db() as db:
+        report_data = await db.run_sync(get_daily_report_data, today)
+    message = (
+        f"Financial Report for {today.strftime('%Y-%m-%d')}:\n"
+        f"- Total Income: {report_data['income']:.2f} THB\n"
+        f"- Total Expenses: {report_data['expenses']:.2f} THB\n"
+        f"--------------------\n"
+        f"- Net Profit: {report_data['net']:.2f} THB"
+    )
+    await update.message.reply_text(message)
+
+async def send_period_report(update: Update, title: str, start: datetime.date, end: datetime.date):
+    """Replies with totals for the period and one line per day that had activity."""
+    async with get_async_db() as db:
+        report_data = await db.run_sync(get_report_data, start, end)
+    lines = [
+        f"{title} ({start.strftime('%Y-%m-%d')} to {end.strftime('%Y-%m-%d')}):",
+        f"- Total Income: {report_data['income']:.2f} THB ({report_data['paid_bookings']} paid bookings)",
+        f"- Total Expenses: {report_data['expenses']:.2f} THB",
+        "--------------------",
+        f"- Net Profit: {report_data['net']:.2f} THB",
+    ]
+    if report_data['days']:
+        lines.append("")
+        for day in report_data['days']:
+            lines.append(f"{day['day'].strftime('%a %d')}: +{day['income']:.2f} / -{day['expenses']:.2f} = {day['net']:.2f}")
+    await update.message.reply_text("\n".join(lines))
+
+async def weekly_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update): return
+    today = datetime.date.today()
+    await send_period_report(update, "Weekly Report", today - datetime.timedelta(days=today.weekday()), today)
+
+async def monthly_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update): return
+    today = datetime.date.today()
+    await send_period_report(update, "Monthly Report", today.replace(day=1), today)
+
+async def availability_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update): return
+    args = list(context.args)
+    floor = None
+    if len(args) >= 2 and args[-2].lower() == "floor" and args[-1].isdigit():
+        floor = int(args[-1])
+        args = args[:-2]
+    if not 1 <= len(args) <= 2:
+        await update.message.reply_text("Usage: /availability <from> [to] [floor N], e.g. /availability fri sun")
+        return
+    try:
+        start = availability.parse_day(args[0])
+        end = availability.parse_day(args[1], after=start) if len(args) == 2 else start + datetime.timedelta(days=1)
+        async with get_async_db() as db:
+            result = await db.run_sync(availability.find_available_rooms, start, end, floor)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    total = len(result['free']) + len(result['booked'])
+    where = f" on floor {floor}" if floor is not None else ""
+    lines = [
+        f"{start.strftime('%a %Y-%m-%d')} to {end.strftime('%a %Y-%m-%d')} ({result['nights']} night(s)){where}:",
+        f"{len(result['free'])} of {total} rooms free",
+    ]
+    if result['free']:
+        lines.append(f"Free: {', '.join(result['free'])}")
+    if result['booked']:
+        lines.append(f"Booked: {', '.join(result['booked'])}")
+    await update.message.reply_text("\n".join(lines)[:TELEGRAM_MESSAGE_LIMIT])
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update): return
+    if subsystems.mqtt.ready:
+        device_states = subsystems.mqtt.value.device_states
+        states = device_states.snapshot()
+        now = datetime.datetime.now().timestamp()
+        lines = ["Device status:"] if states else ["No device has reported its state yet."]
+        for state in states:
+            age = int(now - state.updated_at)
+            stale = " (stale)" if device_states.is_stale(state) else ""
+            lines.append(f"- {state.room} {state.device}: {state.value}, {age}s ago{stale}")
+    else:
+        lines = [f"Device status unavailable: MQTT is {subsystems.mqtt.state}."]
+    db = pool_stats()["async"]
+    lines.append(
+        f"Database: {db['checked_out']} connection(s) in use, longest {db['longest_held_s']}s, "
+        f"{db['leaked_now']} held too long ({db['leaks_total']} since start), "
+        f"{db_writer.stats()['queue_depth']} write(s) queued"
+    )
+    if subsystems.ai.ready:
+        ai = subsystems.ai.value.gateway.stats()
+        lines.append(f"AI: {ai['requests']} request(s), {ai['cache_hits']} answered from cache, {ai['in_flight']} in flight")
+    unavailable = [f"{name} ({s['state']})" for name, s in subsystems.registry.status().items() if s["state"] != "ready"]
+    if unavailable:
+        lines.append(f"Not available: {', '.join(unavailable)}")
+    await update.message.reply_text("\n".join(lines))
+
+async def handle_payment_slip(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update): return
+
+    try:
+        ocr = await subsystems.ocr.get()
+    except SubsystemUnavailable:
+        await update.message.reply_text("Slip reading is not available right now. Please check the payment manually.")
+        return
+
+    photo = update.message.photo[-1]
+    file_id = photo.file_id
+    await update.message.reply_text("Processing your payment slip... This may take a moment.")
+
+    async def report_position(position: int):
+        await update.message.reply_text(f"Your slip is queued, position {position}.")
+
+    try:
+        ocr_result = await ocr.process_payment_slip(
+            context.bot, file_id, cache=True, file_unique_id=photo.file_unique_id, on_queued=report_position
+        )
+    except OCRQueueFull:
+        await update.message.reply_text("I'm busy reading other slips right now. Please send this one again in a minute.")
+        return
+    except ocr.SlipTooLarge:
+        await update.message.reply_text("This image is too large to read. Please send a screenshot of the slip instead.")
+        return
+
+    if not ocr_result:
+        await update.message.reply_text("Sorry, I couldn't read the details from the slip. Please check the image quality or enter the details manually.")
+        return
+
+    if ocr_result.get('paid_booking_id'):
+        await update.message.reply_text(
+            f"This slip was already used to pay booking ID {ocr_result['paid_booking_id']}. It will not be counted again."
+        )
+        return
+
+    slip_data = {"name": ocr_result['name'], "amount": ocr_result['amount']}
+    booking = None
+    # A concurrent slip may claim the matched booking first; then match again among the rest.
+    # The read session is closed before the write, which may need a connection of its own.
+    for _ in range(3):
+        async with get_async_db() as db:
+            booking = await db.run_sync(find_booking_by_details, ocr_result['name'], ocr_result['amount'])
+        if not booking:
+            break
+        try:
+            if await run_write(verify_payment, booking.id, file_id, str(slip_data), ocr_result.get('cache_id')):
+                break
+        except DuplicateSlip:
+            await update.message.reply_text("This slip was already used to pay another booking. It will not be counted again.")
+            return
+        booking = None
+
+    if booking:
+        await update.message.reply_text(
+            f"Success! Payment verified for booking ID {booking.id} (Customer: {booking.customer_name}). The booking is now marked as paid."
+        )
+    else:
+        await update.message.reply_text(
+            f"I read the slip (Name: {ocr_result['name']}, Amount: {ocr_result['amount']}), but couldn't find a matching unpaid booking. Please check the details."
+        )
+
+async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update): return
+
+    lat = update.message.location.latitude
+    lon = update.message.location.longitude
+
+    try:
+        geofence = await subsystems.geofence.get()
+    except SubsystemUnavailable:
+        await update.message.reply_text("Geofences are not available right now.")
+        return
+
+    await update.message.reply_text(f"Received your location: Lat={lat}, Lon={lon}. Checking geofences...")
+
+    async with get_async_db() as db:
+        containing_fences = await db.run_sync(geofence.get_geofences_containing_point, lat, lon)
+
+    if containing_fences:
+        fence_names = [f.name for f in containing_fences]
+        await update.message.reply_text(f"You are currently inside the following geofence(s): {', '.join(fence_names)}")
+    else:
+        await update.message.reply_text("You are not currently inside any known geofence.")
+
+async def device_command(update: Update, context: ContextTypes.DEFAULT_TYPE, device: str, usage: str):
+    """Handles /light and /ac: `/<device> [target] <command>` goes through the action dispatcher."""
+    if not is_authorized(update): return
+    if not context.args:
+        await update.message.reply_text(usage)
+        return
+    try:
+        action = dispatcher.parse_action({
+            "type": "hardware_control", "device": device,
+            "command": context.args[-1], "target": " ".join(context.args[:-1]),
+        })
+    except dispatcher.InvalidAction as e:
+        await update.message.reply_text(f"{e}\n{usage}")
+        return
+    result = await dispatcher.dispatch(action)
+    await update.message.reply_text(result.message)
+
+async def light_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await device_command(update, context, "light", "Usage: /light [room|floor N|all|vacant] <ON|OFF>")
+
+async def ac_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await device_command(update, context, "ac", "Usage: /ac [room|floor N|all|vacant] <ON|OFF|temperature>")
+
+async def handle_web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs the actions the Web App sent with Telegram.WebApp.sendData."""
+    if not is_authorized(update): return
+    try:
+        actions = dispatcher.parse_web_app_data(update.effective_message.web_app_data.data)
+    except dispatcher.InvalidAction as e:
+        logger.warning(f"Invalid Web App data: {e}")
+        await update.effective_message.reply_text(f"Ignored invalid Web App data: {e}")
+        return
+    results = await dispatcher.dispatch_many(actions)
+    await update.effective_message.reply_text("\n".join(r.message for r in results) or "Nothing to do.")
+
+async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update): return
+
+    user_text = update.message.text
+    logger.info(f"Received text from user: {user_text}")
+
+    # Lookups the database can answer exactly skip the model; anything else
+    # goes to Gemini with the most relevant records from our own data and the
+    # recent conversation. The history is part of the prompt and so of the
+    # response cache key: a follow-up like "how much is it?" depends on it.
+    conversation_id = f"telegram:{update.effective_chat.id}"
+    prompt, answer = user_text, None
+    try:
+        async with get_async_db() as db:
+            if RETRIEVAL_ENABLED:
+                answer = await db.run_sync(retrieval.answer_locally, user_text)
+                if not answer:
+                    records = await db.run_sync(retrieval.search, user_text, RETRIEVAL_TOP_K)
+                    prompt = retrieval.build_prompt(user_text, records)
+            if not answer:
+                history = await db.run_sync(conversation.get_context, conversation_id)
+                prompt = conversation.render(history, prompt)
+    except Exception as e:
+        logger.error(f"Error preparing context for '{user_text}': {e}", exc_info=True)
+    if answer:
+        # Replied after the session is released: remember_turns needs connections of its own
+        await update.message.reply_text(answer)
+        await remember_turns(conversation_id, user_text, answer)
+        return
+
+    # Fallback to Gemini AI
+    try:
+        llm = await subsystems.ai.get()
+    except SubsystemUnavailable:
+        await update.message.reply_text("AI answers are not available right now. I can still answer lookups such as \"is room 5 paid?\"; see /help for commands.")
+        return
+    await update.message.reply_chat_action('typing')
+    try:
+        answer = await stream_reply(update, llm.gateway.stream(prompt))
+    except Exception as e:
+        logger.error(f"Error calling Gemini AI: {e}", exc_info=True)
+        await update.message.reply_text("Sorry, I'm having trouble connecting to my AI brain. Please try again later.")
+        return
+    await remember_turns(conversation_id, user_text, answer)
+
+async def remember_turns(conversation_id: str, question: str, answer: str):
+    """Stores a question and its answer, then compacts the history if it outgrew the token budget."""
+    try:
+        await run_write(conversation.add_turn, conversation_id, "user", question)
+        await run_write(conversation.add_turn, conversation_id, "assistant", answer)
+        async with get_async_db() as db:
+            pending = await db.run_sync(conversation.pending_compaction, conversation_id)
+        if pending is None:
+            return
+        summary = None
+        if subsystems.ai.ready:
+            llm = subsystems.ai.value
+            try:
+                summary = await llm.gateway.generate(conversation.summary_prompt(pending))
+            except llm.LLMError as e:
+                logger.warning(f"Could not summarize conversation {conversation_id}, truncating instead: {e}")
+        summary = conversation.checked_summary(pending, summary)
+        await run_write(conversation.save_summary, conversation_id, summary, pending["last_turn_id"])
+    except Exception as e:
+        logger.error(f"Error saving conversation {conversation_id}: {e}", exc_info=True)
+
+async def stream_reply(update: Update, chunks):
+    """
+    Sends streamed text as it arrives: the first chunk as a new message, then
+    edits with the accumulated text at most every LLM_STREAM_EDIT_INTERVAL
+    seconds. Text past Telegram's message limit continues in a new message.
+    Returns the full text.
+    """
+    message, text, shown, last_edit = None, "", "", 0.0
+    full = []
+    async for chunk in chunks:
+        full.append(chunk)
+        text += chunk
+        while len(text) > TELEGRAM_MESSAGE_LIMIT:
+            # Finish the open message, or send a full one, and carry the rest over.
+            # One chunk can span several messages, e.g. a long answer from the cache.
+            if message is None:
+                await update.message.reply_text(text[:TELEGRAM_MESSAGE_LIMIT])
+            else:
+                await message.edit_text(text[:TELEGRAM_MESSAGE_LIMIT])
+            text, message = text[TELEGRAM_MESSAGE_LIMIT:], None
+        if not text:
+            continue
+        if message is None:
+            message = await update.message.reply_text(text)
+            shown, last_edit = text, time.monotonic()
+        elif time.monotonic() - last_edit >= LLM_STREAM_EDIT_INTERVAL:
+            await message.edit_text(text)
+            shown, last_edit = text, time.monotonic()
+    if message is not None and text != shown:
+        await message.edit_text(text)
+    return "".join(full)
+
+# --- Bot Lifecycle ---
+def build_bot() -> Application:
+    """
+    Builds the bot with its handlers. Up to TELEGRAM_CONCURRENT_UPDATES updates
+    are handled at once. In webhook mode there is no updater: updates arrive
+    through the webhook route in app.main.
+    """
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+        .update_queue(asyncio.Queue(TELEGRAM_UPDATE_QUEUE_SIZE))
+    )
+    if TELEGRAM_WEBHOOK_URL:
+        builder = builder.updater(None)
+    bot_app = builder.build()
+
+    # Add handlers
+    bot_app.add_handler(CommandHandler("start", instrumented(start_command)))
+    bot_app.add_handler(CommandHandler("help", instrumented(help_command)))
+    bot_app.add_handler(CommandHandler("daily_report", instrumented(daily_report_command)))
+    bot_app.add_handler(CommandHandler("weekly_report", instrumented(weekly_report_command)))
+    bot_app.add_handler(CommandHandler("monthly_report", instrumented(monthly_report_command)))
+    bot_app.add_handler(CommandHandler("availability", instrumented(availability_command)))
+    bot_app.add_handler(CommandHandler("status", instrumented(status_command)))
+    bot_app.add_handler(CommandHandler("light", instrumented(light_command)))
+    bot_app.add_handler(CommandHandler("ac", instrumented(ac_command)))
+    bot_app.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, instrumented(handle_web_app_data)))
+    bot_app.add_handler(MessageHandler(filters.PHOTO, instrumented(handle_payment_slip)))
+    bot_app.add_handler(MessageHandler(filters.LOCATION, instrumented(handle_location)))
+    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(handle_text_message)))
+    return bot_app
+
+async def register_webhook(bot):
+    """
+    Points Telegram at this app's webhook route. Every uvicorn worker does this
+    on startup with the same URL and secret, so it does not matter which wins.
+    """
+    try:
+        await bot.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL + TELEGRAM_WEBHOOK_PATH,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info(f"Telegram webhook set to {TELEGRAM_WEBHOOK_URL + TELEGRAM_WEBHOOK_PATH}")
+    except RetryAfter:
+        logger.info("Telegram webhook is being set by another worker")
+
+async def start() -> Application:
+    """Starts the bot on the running event loop, fed by the webhook route or by polling."""
+    application = build_bot()
+    await application.initialize()
+    await application.start()
+    if TELEGRAM_WEBHOOK_URL:
+        await register_webhook(application.bot)
+    else:
+        # Polling removes any webhook; only one process may poll, so run a single worker
+        await application.updater.start_polling()
+    logger.info(f"Telegram bot started ({'webhook' if TELEGRAM_WEBHOOK_URL else 'polling'} mode).")
+    return application
+
+async def stop(application: Application):
+    # The webhook stays registered: other workers keep serving it, and a restart sets it again
+    if application.updater is not None and application.updater.running:
+        await application.updater.stop()
+    await application.stop() # Let handlers in progress finish
+    await application.shutdown()
+
+metrics.gauge("telegram_update_queue_depth", "Updates waiting for a handler.",
+              lambda: subsystems.bot.value.update_queue.qsize() if subsystems.bot.ready else 0)
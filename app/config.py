@@ -1,4 +1,5 @@
 import os
+import hashlib
 import logging
 from dotenv import load_dotenv
 
@@ -7,9 +8,10 @@ load_dotenv()
 
 # --- Logging Configuration ---
 LOGGING_LEVEL = os.getenv("LOGGING_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 logging.basicConfig(
     level=LOGGING_LEVEL,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    format=LOG_FORMAT,
     handlers=[
         logging.StreamHandler() # Log to console
     ]
@@ -28,22 +30,109 @@ if ADMIN_CHAT_ID:
         ADMIN_CHAT_ID = int(ADMIN_CHAT_ID)
     except ValueError:
         ADMIN_CHAT_ID = None
+# Webhook mode: Telegram posts updates to TELEGRAM_WEBHOOK_URL + TELEGRAM_WEBHOOK_PATH
+# instead of the bot long-polling. Required to run more than one uvicorn worker.
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/") # Public base URL, e.g. https://my-space.hf.space
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+# Checked against the X-Telegram-Bot-Api-Secret-Token header. Defaults to a hash of the bot
+# token, so every worker derives the same secret without extra configuration.
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or (
+    hashlib.sha256(f"webhook:{os.getenv('TELEGRAM_BOT_TOKEN', '')}".encode()).hexdigest()[:32]
+)
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", 8)) # Updates handled at once per worker
+TELEGRAM_UPDATE_QUEUE_SIZE = int(os.getenv("TELEGRAM_UPDATE_QUEUE_SIZE", 1000)) # Past this, the webhook answers 503 and Telegram retries later
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/") # Bot API server, e.g. a local one for load tests
 
 # --- Gemini AI Configuration ---
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") # Without it, AI answers are off and only local lookups are answered
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-pro")
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "https://generativelanguage.googleapis.com") # Point at a fake server for tests
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 4)) # Gemini requests in flight at once
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 30)) # Seconds per attempt
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", 2)) # Extra attempts on timeouts, 429 and 5xx
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 3600)) # Seconds an answer is reused for the same question
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 500))
+LLM_STREAM_EDIT_INTERVAL = float(os.getenv("LLM_STREAM_EDIT_INTERVAL", 1.0)) # Seconds between message edits while streaming
+
+# --- Retrieval Configuration ---
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "true").lower() == "true" # Ground AI answers in hotel data and answer lookups locally
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 5)) # Records added to the prompt
+RETRIEVAL_HISTORY_DAYS = int(os.getenv("RETRIEVAL_HISTORY_DAYS", 180)) # Older paid bookings and expenses are not indexed
+KNOWLEDGE_DIR = os.getenv("KNOWLEDGE_DIR", "knowledge") # House rules and FAQ as .md/.txt files, one entry per paragraph
 
 # --- Database Configuration ---
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///hotel_os_bot.db")
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 5))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", 10)) # Extra connections opened under load beyond the pool size
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", 30)) # Seconds to wait for a free connection
+DATABASE_LEAK_SECONDS = float(os.getenv("DATABASE_LEAK_SECONDS", 60)) # Connections held longer are reported as leaked
+DATABASE_LEAK_TRACE = os.getenv("DATABASE_LEAK_TRACE", "false").lower() == "true" # Record where leaked connections were taken
+# SQLite profile, applied to every new connection
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL") # WAL lets readers run alongside the writer
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL") # With WAL, fsync at checkpoints rather than every commit
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000)) # Wait this long for a lock instead of failing
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 65536)) # Page cache per connection
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)) # Bytes of the file read through mmap
+# Serialize writes through one thread and connection; defaults to on for SQLite, which allows a single writer anyway
+DATABASE_SINGLE_WRITER = os.getenv("DATABASE_SINGLE_WRITER", str(DATABASE_URL.startswith("sqlite"))).lower() == "true"
+
+# --- Web App Configuration ---
+WEBAPP_AUTH_MAX_AGE = int(os.getenv("WEBAPP_AUTH_MAX_AGE", 86400)) # Seconds a Web App initData signature stays valid
+WEBAPP_MAX_ACTIONS = int(os.getenv("WEBAPP_MAX_ACTIONS", 50)) # Actions accepted per /api/actions request
+EXPENSE_BATCH_SIZE = int(os.getenv("EXPENSE_BATCH_SIZE", 100)) # Expenses inserted per transaction
+EXPENSE_BATCH_WAIT_MS = int(os.getenv("EXPENSE_BATCH_WAIT_MS", 50)) # How long the first expense waits for others to share its transaction
+
+# --- Geofence Configuration ---
+# When disabled, lookups use the SQL bounding-box prefilter instead of the in-memory index.
+GEOFENCE_INDEX_ENABLED = os.getenv("GEOFENCE_INDEX_ENABLED", "true").lower() == "true"
+GEOFENCE_SYNC_SECONDS = float(os.getenv("GEOFENCE_SYNC_SECONDS", 60)) # How often polygons edited outside the app are re-normalized
+
+# --- Availability Configuration ---
+# When disabled, availability is answered with indexed SQL overlap queries instead of the in-memory calendar.
+AVAILABILITY_INDEX_ENABLED = os.getenv("AVAILABILITY_INDEX_ENABLED", "true").lower() == "true"
+AVAILABILITY_RELOAD_SECONDS = float(os.getenv("AVAILABILITY_RELOAD_SECONDS", 300)) # Full reload interval, to pick up cancellations made by other workers
+AVAILABILITY_MAX_NIGHTS = int(os.getenv("AVAILABILITY_MAX_NIGHTS", 366)) # Longest range one availability query may ask about
+
+# --- Payment Reconciliation Configuration ---
+# When disabled, slips are matched with indexed SQL queries instead of the in-memory index of unpaid bookings.
+RECONCILE_INDEX_ENABLED = os.getenv("RECONCILE_INDEX_ENABLED", "true").lower() == "true"
+RECONCILE_AMOUNT_TOLERANCE = float(os.getenv("RECONCILE_AMOUNT_TOLERANCE", 0)) # Baht a slip may differ from the booking total
+RECONCILE_MIN_NAME_SCORE = float(os.getenv("RECONCILE_MIN_NAME_SCORE", 0.6)) # 0..1 similarity needed to accept a name
+
+# --- OCR Configuration ---
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", os.cpu_count() or 1)) # Tesseract processes run in parallel
+OCR_QUEUE_SIZE = int(os.getenv("OCR_QUEUE_SIZE", 50)) # Slips waiting for a worker before new ones are refused
+OCR_JOB_TIMEOUT = float(os.getenv("OCR_JOB_TIMEOUT", 60))
+OCR_TARGET_WIDTH = int(os.getenv("OCR_TARGET_WIDTH", 1000)) # Slips are downscaled to this width before OCR
+OCR_USE_TEMPLATES = os.getenv("OCR_USE_TEMPLATES", "true").lower() == "true" # Read only known bank layout regions
+OCR_MAX_DOWNLOAD_BYTES = int(os.getenv("OCR_MAX_DOWNLOAD_BYTES", 10 * 1024 * 1024))
+OCR_MAX_PIXELS = int(os.getenv("OCR_MAX_PIXELS", 40_000_000)) # Larger images are rejected from their header
+OCR_DOWNLOAD_TIMEOUT = float(os.getenv("OCR_DOWNLOAD_TIMEOUT", 30))
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", 10000)) # Least recently used results are evicted
 
 # --- MQTT Configuration ---
 MQTT_BROKER = os.getenv("MQTT_BROKER", "broker.hivemq.com")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
-MQTT_TOPIC_PREFIX = os.getenv("MQTT_TOPIC_PREFIX", "hotel/room1")
+MQTT_TOPIC_PREFIX = os.getenv("MQTT_TOPIC_PREFIX", "hotel/room1") # Topic of the default room
+# Room topics are {MQTT_TOPIC_ROOT}/{room_number}/{device}/command; defaults to the parent of the prefix
+MQTT_TOPIC_ROOT = os.getenv("MQTT_TOPIC_ROOT", MQTT_TOPIC_PREFIX.rstrip("/").rsplit("/", 1)[0])
+MQTT_KEEPALIVE = int(os.getenv("MQTT_KEEPALIVE", 60))
+MQTT_QOS = int(os.getenv("MQTT_QOS", 1))
+MQTT_PUBLISH_TIMEOUT = float(os.getenv("MQTT_PUBLISH_TIMEOUT", 5))
+MQTT_QUEUE_SIZE = int(os.getenv("MQTT_QUEUE_SIZE", 1000)) # Messages held in memory while the broker is unreachable
+MQTT_MAX_INFLIGHT = int(os.getenv("MQTT_MAX_INFLIGHT", 100))
+MQTT_STATE_TTL = float(os.getenv("MQTT_STATE_TTL", 300)) # Seconds before a reported device state is considered stale
+
+# --- Metrics Configuration ---
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") # If set, /metrics and /debug/profile require "Authorization: Bearer <token>"
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true" if METRICS_TOKEN else "false").lower() == "true" # Serve Prometheus metrics on /metrics
+LOG_TRACE_IDS = os.getenv("LOG_TRACE_IDS", "false").lower() == "true" # Tag log lines with the update or request they belong to
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true" # Serve the sampling profiler on /debug/profile; needs METRICS_TOKEN
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", 5)) # Time between stack samples
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", 60)) # Longest profile one request may take
 
 # --- Validation ---
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set!")
 if not AUTHORIZED_USER_ID:
     raise ValueError("TELEGRAM_USER_ID environment variable not set!")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable not set!")
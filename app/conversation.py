@@ -0,0 +1,209 @@
+"""
+Per-user conversation memory shared by the Telegram bot and the Streamlit app.
+
+Turns are stored in the app database. The prompt context for a turn is the
+rolling summary of older turns plus as many recent turns as fit the token
+budget, so prompt size stays bounded however long a conversation runs. Once
+the unsummarized turns outgrow the budget, the older ones are folded into the
+summary: by the model when the caller passes a summarizer, otherwise by
+keeping the first lines of each folded turn.
+
+This module only needs SQLAlchemy and the environment: the Streamlit app uses
+it without importing app.config, which requires the Telegram settings.
+"""
+import datetime
+import os
+from typing import Callable, List, Optional
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, create_engine
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+
+# Same defaults as app.config, which the Streamlit app does not import
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///hotel_os_bot.db")
+TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", 2000)) # Max tokens of summary + history sent per turn
+KEEP_TURNS = int(os.getenv("CONVERSATION_KEEP_TURNS", 6)) # Recent turns kept verbatim when compacting
+SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", 300)) # Target size of the rolling summary
+
+Base = declarative_base()
+
+
+class ConversationTurn(Base):
+    __tablename__ = "conversation_turns"
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(String, nullable=False, index=True)  # e.g. "telegram:<chat id>"
+    role = Column(String, nullable=False)  # "user" or "assistant"
+    content = Column(Text, nullable=False)
+    tokens = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+
+
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries"
+    conversation_id = Column(String, primary_key=True)
+    summary = Column(Text, nullable=False, default="")
+    tokens = Column(Integer, nullable=False, default=0)
+    last_turn_id = Column(Integer, nullable=False, default=0)  # Turns up to this id are folded into the summary
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+
+def create_tables(bind):
+    Base.metadata.create_all(bind=bind)
+
+
+def connect(url: str = DATABASE_URL) -> sessionmaker:
+    """Session factory for callers without app.database, creating the tables if needed."""
+    engine = create_engine(url, connect_args={"check_same_thread": False} if url.startswith("sqlite") else {})
+    create_tables(engine)
+    return sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate without a tokenizer: about four Latin characters per
+    token, while Thai and other non-ASCII text takes roughly one per character
+    pair.
+    """
+    ascii_chars = sum(1 for c in text if c < "\x80")
+    return 1 + ascii_chars // 4 + (len(text) - ascii_chars) // 2
+
+
+def add_turn(db: Session, conversation_id: str, role: str, content: str) -> ConversationTurn:
+    turn = ConversationTurn(conversation_id=conversation_id, role=role, content=content, tokens=estimate_tokens(content))
+    db.add(turn)
+    db.commit()
+    return turn
+
+
+def get_turns(db: Session, conversation_id: str, limit: int = 100) -> List[ConversationTurn]:
+    """The latest `limit` turns, oldest first, for display."""
+    turns = db.query(ConversationTurn).filter(ConversationTurn.conversation_id == conversation_id) \
+        .order_by(ConversationTurn.id.desc()).limit(limit).all()
+    return turns[::-1]
+
+
+def _summary(db: Session, conversation_id: str) -> Optional[ConversationSummary]:
+    return db.get(ConversationSummary, conversation_id)
+
+
+def _unsummarized(db: Session, conversation_id: str, after_id: int) -> List[ConversationTurn]:
+    return db.query(ConversationTurn).filter(
+        ConversationTurn.conversation_id == conversation_id, ConversationTurn.id > after_id
+    ).order_by(ConversationTurn.id).all()
+
+
+def get_context(db: Session, conversation_id: str, budget: int = TOKEN_BUDGET) -> dict:
+    """
+    What to send with the next turn: {"summary": str, "messages": [{"role", "content"}]}.
+
+    The newest turns are taken until the budget (after the summary) is spent,
+    so the result stays within `budget` even before compaction catches up.
+    """
+    summary = _summary(db, conversation_id)
+    remaining = budget - (summary.tokens if summary else 0)
+    messages = []
+    for turn in reversed(_unsummarized(db, conversation_id, summary.last_turn_id if summary else 0)):
+        if turn.tokens > remaining:
+            break
+        remaining -= turn.tokens
+        messages.append({"role": turn.role, "content": turn.content})
+    return {"summary": summary.summary if summary else "", "messages": messages[::-1]}
+
+
+def pending_compaction(db: Session, conversation_id: str, budget: int = TOKEN_BUDGET,
+                       keep_turns: int = KEEP_TURNS) -> Optional[dict]:
+    """
+    The turns to fold into the summary, once the unsummarized history exceeds
+    the budget: {"summary": str, "turns": [...], "last_turn_id": int}, or None.
+    The newest `keep_turns` turns always stay verbatim.
+    """
+    summary = _summary(db, conversation_id)
+    turns = _unsummarized(db, conversation_id, summary.last_turn_id if summary else 0)
+    used = (summary.tokens if summary else 0) + sum(t.tokens for t in turns)
+    if used <= budget or len(turns) <= keep_turns:
+        return None
+    fold = turns[:len(turns) - keep_turns]
+    return {
+        "summary": summary.summary if summary else "",
+        "turns": [{"role": t.role, "content": t.content} for t in fold],
+        "last_turn_id": fold[-1].id,
+    }
+
+
+def save_summary(db: Session, conversation_id: str, summary: str, last_turn_id: int):
+    row = _summary(db, conversation_id)
+    if row is None:
+        row = ConversationSummary(conversation_id=conversation_id)
+        db.add(row)
+    elif row.last_turn_id >= last_turn_id:
+        return  # Another compaction got here first
+    row.summary = summary
+    row.tokens = estimate_tokens(summary)
+    row.last_turn_id = last_turn_id
+    db.commit()
+
+
+def summary_prompt(pending: dict, max_tokens: int = SUMMARY_TOKENS) -> str:
+    """Instruction for a model to fold `pending` turns into the running summary."""
+    transcript = "\n".join(f"{t['role'].capitalize()}: {t['content']}" for t in pending["turns"])
+    return (
+        f"Update the summary of this conversation in at most {max_tokens * 3 // 4} words. "
+        "Keep names, room numbers, dates, amounts and anything the user asked to remember; drop small talk.\n\n"
+        f"Current summary:\n{pending['summary'] or '(none)'}\n\n"
+        f"New messages:\n{transcript}"
+    )
+
+
+def truncate_summary(pending: dict, max_tokens: int = SUMMARY_TOKENS) -> str:
+    """Fallback summary without a model: the first line of each folded turn, newest kept when over budget."""
+    lines = [line for line in pending["summary"].splitlines() if line]
+    for turn in pending["turns"]:
+        first_line = turn["content"].strip().splitlines()[0] if turn["content"].strip() else ""
+        lines.append(f"{turn['role'].capitalize()}: {first_line[:200]}")
+    kept, used = [], 0
+    for line in reversed(lines):
+        used += estimate_tokens(line)
+        if used > max_tokens:
+            break
+        kept.append(line)
+    return "\n".join(kept[::-1])
+
+
+def compact(db: Session, conversation_id: str, summarize: Optional[Callable[[str], str]] = None,
+            budget: int = TOKEN_BUDGET, keep_turns: int = KEEP_TURNS) -> bool:
+    """
+    Folds older turns into the summary if the history is over budget. `summarize`
+    takes a summary_prompt and returns the model's answer; without it, or if it
+    fails, the summary is truncated instead. Returns whether anything was folded.
+    """
+    pending = pending_compaction(db, conversation_id, budget, keep_turns)
+    if pending is None:
+        return False
+    summary = None
+    if summarize is not None:
+        try:
+            summary = summarize(summary_prompt(pending))
+        except Exception:
+            summary = None
+    save_summary(db, conversation_id, checked_summary(pending, summary), pending["last_turn_id"])
+    return True
+
+
+def checked_summary(pending: dict, summary: Optional[str]) -> str:
+    """The model's summary, or the truncated fallback if it gave none or ignored the length limit."""
+    if not summary or estimate_tokens(summary) > 2 * SUMMARY_TOKENS:
+        return truncate_summary(pending)
+    return summary.strip()
+
+
+def render(context: dict, prompt: str) -> str:
+    """Prepends the conversation context to a prompt, for single-prompt APIs."""
+    parts = []
+    if context["summary"]:
+        parts.append(f"Summary of the earlier conversation:\n{context['summary']}")
+    if context["messages"]:
+        parts.append("Recent messages:\n" + "\n".join(
+            f"{m['role'].capitalize()}: {m['content']}" for m in context["messages"]
+        ))
+    if not parts:
+        return prompt
+    return "\n\n".join(parts) + f"\n\nCurrent message:\n{prompt}"
@@ -1,10 +1,28 @@
 
+import asyncio
 import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, Text
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from collections import defaultdict
+from sqlalchemy import and_, or_, create_engine, event, inspect, select, text, update, Column, Integer, String, Float, Date, DateTime, Boolean, Text, LargeBinary, Index
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.orm.attributes import NO_VALUE
 from sqlalchemy.sql import func
 
-from app.config import DATABASE_URL, get_logger
+from app import conversation
+from app import metrics
+from app.config import (
+    DATABASE_URL, DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_TIMEOUT,
+    DATABASE_LEAK_SECONDS, DATABASE_LEAK_TRACE, DATABASE_SINGLE_WRITER,
+    SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_BUSY_TIMEOUT_MS, SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE,
+    get_logger
+)
 
 logger = get_logger(__name__)
 
@@ -19,8 +37,27 @@ class Booking(Base):
     check_out_date = Column(DateTime, nullable=False)
     room_number = Column(String, nullable=False)
     total_price = Column(Float, nullable=False)
+    total_price_satang = Column(Integer) # total_price as integer satang, kept in sync on write for exact amount lookups
     is_paid = Column(Boolean, default=False)
-    created_at = Column(DateTime, default=func.now())
+    is_cancelled = Column(Boolean, default=False) # Cancelled bookings keep their row but no longer hold the room; NULL on older rows
+    created_at = Column(DateTime, default=func.now(), index=True)
+
+    __table_args__ = (
+        Index('ix_bookings_paid_price', 'is_paid', 'total_price'),
+        Index('ix_bookings_paid_created', 'is_paid', 'created_at'),
+        Index('ix_bookings_paid_satang', 'is_paid', 'total_price_satang'),
+        Index('ix_bookings_room_stay', 'room_number', 'check_in_date', 'check_out_date'),
+    )
+
+def to_satang(amount: float) -> int:
+    """Converts a baht amount to integer satang, so amounts compare exactly."""
+    return int(round(float(amount) * 100))
+
+@event.listens_for(Booking, "before_insert")
+@event.listens_for(Booking, "before_update")
+def _sync_satang(mapper, connection, target):
+    if target.total_price is not None:
+        target.total_price_satang = to_satang(target.total_price)
 
 class PaymentSlip(Base):
     __tablename__ = 'payment_slips'
@@ -37,13 +74,208 @@ class Expense(Base):
     description = Column(String, nullable=False)
     amount = Column(Float, nullable=False)
     category = Column(String, default='General')
-    date = Column(DateTime, default=func.now())
+    date = Column(DateTime, default=func.now(), index=True)
+
+class OCRCacheEntry(Base):
+    __tablename__ = 'ocr_cache'
+    id = Column(Integer, primary_key=True)
+    file_unique_id = Column(String, unique=True) # Telegram file_unique_id of the first copy seen
+    content_hash = Column(String, nullable=False, index=True) # SHA-256 of the image bytes
+    perceptual_hash = Column(String, index=True) # 256-bit dHash, survives re-encoding
+    name = Column(String)
+    amount = Column(Float)
+    raw_text = Column(Text)
+    booking_id = Column(Integer, index=True) # Booking this slip paid, kept for duplicate-payment checks
+    created_at = Column(DateTime, default=func.now())
+    last_used_at = Column(DateTime, default=func.now(), index=True)
+
+class Geofence(Base):
+    __tablename__ = 'geofences'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    polygon = Column(Text, nullable=False) # JSON list of [lat, lon] or [lon, lat] pairs
+    # Normalized on write by geofence.py: canonical (lon, lat) WKB and its bounding box
+    geometry_wkb = Column(LargeBinary)
+    is_valid = Column(Boolean, default=False)
+    min_lat = Column(Float)
+    max_lat = Column(Float)
+    min_lon = Column(Float)
+    max_lon = Column(Float)
+    polygon_hash = Column(String) # SHA-256 of the polygon text the columns above were computed from
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index('ix_geofences_bbox', 'min_lat', 'max_lat', 'min_lon', 'max_lon'),
+    )
+
+class Room(Base):
+    __tablename__ = 'rooms'
+    id = Column(Integer, primary_key=True)
+    room_number = Column(String, nullable=False, unique=True) # Also the MQTT topic segment for the room
+    floor = Column(Integer, index=True)
+    devices = Column(String, default='light,ac') # Comma-separated devices installed in the room
+
+class DailySummary(Base):
+    """Per-day financial totals, kept up to date on every write so reports read one row per day."""
+    __tablename__ = 'daily_summary'
+    day = Column(Date, primary_key=True)
+    income = Column(Float, nullable=False, default=0.0) # Paid bookings, by the day the booking was created
+    expenses = Column(Float, nullable=False, default=0.0)
+    paid_bookings = Column(Integer, nullable=False, default=0)
+    expense_count = Column(Integer, nullable=False, default=0)
+
+# --- Daily Summary Rollup --- #
+# Bookings and expenses adjust the summary in the same transaction that writes
+# them. ORM flushes are covered by the mapper events below; bulk updates (see
+# verify_payment) call _bump_daily_summary themselves.
+
+def _bump_daily_summary(connection, day: datetime.date | None, income: float = 0.0, expenses: float = 0.0,
+                        paid_bookings: int = 0, expense_count: int = 0):
+    """Adds the given amounts to a day's summary row, creating the row if needed."""
+    if day is None:
+        return
+    table = DailySummary.__table__
+    deltas = {"income": income, "expenses": expenses, "paid_bookings": paid_bookings, "expense_count": expense_count}
+    dialect = {"sqlite": sqlite, "postgresql": postgresql}.get(connection.dialect.name)
+    if dialect is not None:
+        stmt = dialect.insert(table).values(day=day, **deltas)
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.day],
+            set_={name: table.c[name] + stmt.excluded[name] for name in deltas}
+        ))
+        return
+    updated = connection.execute(
+        table.update().where(table.c.day == day).values({name: table.c[name] + value for name, value in deltas.items()})
+    ).rowcount
+    if not updated:
+        connection.execute(table.insert().values(day=day, **deltas))
+
+def _as_day(value) -> datetime.date | None:
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+def _current(connection, target, column):
+    """A column's value on a flushed object, read back from the row when it was set by a SQL default."""
+    value = inspect(target).attrs[column.key].loaded_value
+    if value is NO_VALUE:
+        value = connection.execute(select(column).where(type(target).id == target.id)).scalar()
+    return value
+
+def _previous(target, column, current):
+    """A column's value before this flush."""
+    history = inspect(target).attrs[column.key].history
+    return history.deleted[0] if history.deleted else current
+
+def _booking_income(connection, target, previous: bool = False):
+    """Returns (day, price) if the booking counts as income, else None."""
+    values = [_current(connection, target, c) for c in (Booking.is_paid, Booking.created_at, Booking.total_price)]
+    if previous:
+        values = [_previous(target, c, v) for c, v in zip((Booking.is_paid, Booking.created_at, Booking.total_price), values)]
+    is_paid, created_at, price = values
+    return (_as_day(created_at), price) if is_paid and price else None
+
+def _expense_cost(connection, target, previous: bool = False):
+    """Returns (day, amount) for an expense."""
+    values = [_current(connection, target, c) for c in (Expense.date, Expense.amount)]
+    if previous:
+        values = [_previous(target, c, v) for c, v in zip((Expense.date, Expense.amount), values)]
+    date, amount = values
+    return (_as_day(date), amount or 0.0)
+
+def _load_old_value(target, value, oldvalue, initiator):
+    return value
+
+# Load the old value when these are set on an expired object, so the flush history
+# tells the rollup what a change replaced
+for _attribute in (Booking.is_paid, Booking.created_at, Booking.total_price, Expense.date, Expense.amount):
+    event.listen(_attribute, "set", _load_old_value, active_history=True, retval=True)
+
+@event.listens_for(Booking, "after_insert")
+def _rollup_booking_insert(mapper, connection, target):
+    new = _booking_income(connection, target)
+    if new:
+        _bump_daily_summary(connection, new[0], income=new[1], paid_bookings=1)
+
+@event.listens_for(Booking, "after_update")
+def _rollup_booking_update(mapper, connection, target):
+    old, new = _booking_income(connection, target, previous=True), _booking_income(connection, target)
+    if old != new:
+        if old:
+            _bump_daily_summary(connection, old[0], income=-old[1], paid_bookings=-1)
+        if new:
+            _bump_daily_summary(connection, new[0], income=new[1], paid_bookings=1)
+
+@event.listens_for(Booking, "before_delete")
+def _rollup_booking_delete(mapper, connection, target):
+    old = _booking_income(connection, target)
+    if old:
+        _bump_daily_summary(connection, old[0], income=-old[1], paid_bookings=-1)
+
+@event.listens_for(Expense, "after_insert")
+def _rollup_expense_insert(mapper, connection, target):
+    day, amount = _expense_cost(connection, target)
+    _bump_daily_summary(connection, day, expenses=amount, expense_count=1)
+
+@event.listens_for(Expense, "after_update")
+def _rollup_expense_update(mapper, connection, target):
+    old, new = _expense_cost(connection, target, previous=True), _expense_cost(connection, target)
+    if old != new:
+        _bump_daily_summary(connection, old[0], expenses=-old[1], expense_count=-1)
+        _bump_daily_summary(connection, new[0], expenses=new[1], expense_count=1)
+
+@event.listens_for(Expense, "before_delete")
+def _rollup_expense_delete(mapper, connection, target):
+    day, amount = _expense_cost(connection, target)
+    _bump_daily_summary(connection, day, expenses=-amount, expense_count=-1)
 
 # --- Database Engine and Session --- #
+_IS_SQLITE = DATABASE_URL.startswith("sqlite")
 # The `check_same_thread=False` is needed only for SQLite.
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+_CONNECT_ARGS = {"check_same_thread": False} if _IS_SQLITE else {}
+# In-memory SQLite uses a single static connection, which takes no pool settings
+_POOL_ARGS = {} if _IS_SQLITE and (":memory:" in DATABASE_URL or DATABASE_URL == "sqlite://") else {
+    "pool_size": DATABASE_POOL_SIZE,
+    "max_overflow": DATABASE_MAX_OVERFLOW,
+    "pool_timeout": DATABASE_POOL_TIMEOUT,
+}
+
+def _async_url(url: str) -> str:
+    """Maps a sync database URL to its asyncio driver (aiosqlite, asyncpg)."""
+    for prefix, async_prefix in (("sqlite://", "sqlite+aiosqlite://"),
+                                 ("postgresql://", "postgresql+asyncpg://"),
+                                 ("postgres://", "postgresql+asyncpg://")):
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None):
+    """
+    Applies the SQLite profile to a new connection: WAL journal, relaxed fsync,
+    busy timeout, page cache and mmap. Registered as a connect event on SQLite engines.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
+engine = create_engine(DATABASE_URL, connect_args=_CONNECT_ARGS, **_POOL_ARGS)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Used by the bot handlers, so a slow query no longer blocks the event loop.
+# Objects stay readable after commit: an expired attribute cannot be lazy-loaded
+# outside `run_sync`.
+async_engine = create_async_engine(_async_url(DATABASE_URL), **_POOL_ARGS)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+if _IS_SQLITE:
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+
 
 def get_db():
     """Dependency to get a DB session for each request."""
@@ -53,60 +285,497 @@ def get_db():
     finally:
         db.close()
 
+@asynccontextmanager
+async def get_async_db():
+    """
+    Async session for the bot handlers, closed (and rolled back if uncommitted)
+    on exit. The sync CRUD functions in this module run on it unchanged through
+    `await db.run_sync(fn, *args)`.
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# --- Writer --- #
+
+DB_WRITE_WAIT_SECONDS = metrics.histogram(
+    "db_write_wait_seconds", "Time a write waited in the single writer's queue.", buckets=metrics.FAST_BUCKETS
+)
+DB_WRITE_SECONDS = metrics.histogram(
+    "db_write_seconds", "Time the writer thread spent in a write function, commit included.", ["function"],
+    buckets=metrics.FAST_BUCKETS,
+)
+
+class DatabaseWriter:
+    """
+    Runs write functions one at a time on a dedicated thread and session.
+
+    SQLite allows a single writer; funnelling every write through one queue means
+    writers never contend for the lock (or fail with `database is locked`), while
+    reads keep using pooled connections, which WAL lets run alongside the writer.
+    Functions take the session as their first argument, like the CRUD functions
+    in this module, and their results stay readable after the session closes.
+    """
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # Metrics
+        self.completed = 0
+        self.failed = 0
+        self._wait_total = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Finishes the queued writes, then stops the writer thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Queues `fn(session, *args, **kwargs)` and returns a concurrent Future for its result."""
+        self.start()
+        future = Future()
+        self._queue.put((fn, args, kwargs, future, time.monotonic()))
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Awaits `fn(session, *args, **kwargs)` on the writer thread."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            fn, args, kwargs, future, queued_at = job
+            started = time.monotonic()
+            self._wait_total += started - queued_at
+            DB_WRITE_WAIT_SECONDS.observe(started - queued_at)
+            if not future.set_running_or_notify_cancel():
+                continue
+            session = self._session_factory()
+            try:
+                result = fn(session, *args, **kwargs)
+                self.completed += 1
+                future.set_result(result)
+            except Exception as e:
+                session.rollback()
+                self.failed += 1
+                future.set_exception(e)
+            finally:
+                session.close()
+                DB_WRITE_SECONDS.labels(function=fn.__name__).observe(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        finished = self.completed + self.failed
+        return {
+            "queue_depth": self._queue.qsize(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_ms": round(1000 * self._wait_total / finished, 1) if finished else 0.0,
+        }
+
+_WriterSession = sessionmaker(autocommit=False, autoflush=False, bind=engine, expire_on_commit=False)
+db_writer = DatabaseWriter(_WriterSession)
+
+async def run_write(fn, *args, **kwargs):
+    """
+    Runs a write function (taking the session first) without blocking the event loop:
+    on the single writer thread when DATABASE_SINGLE_WRITER is on, else on a fresh async session.
+    """
+    if DATABASE_SINGLE_WRITER:
+        return await db_writer.run(fn, *args, **kwargs)
+    async with get_async_db() as db:
+        return await db.run_sync(fn, *args, **kwargs)
+
+# --- Pool Metrics and Leak Detection --- #
+
+class _PoolMonitor:
+    """Tracks connections checked out of an engine's pool and how long each is held."""
+
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.pool = engine.pool
+        self._lock = threading.Lock()
+        self._checked_out = {}  # id(dbapi connection) -> (checked out at, stack or None)
+        self._reported = set()
+        self.leaks = 0
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        stack = "".join(traceback.format_stack(limit=12)) if DATABASE_LEAK_TRACE else None
+        with self._lock:
+            self._checked_out[id(dbapi_connection)] = (time.monotonic(), stack)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            entry = self._checked_out.pop(id(dbapi_connection), None)
+            self._reported.discard(id(dbapi_connection))
+        if entry and time.monotonic() - entry[0] > DATABASE_LEAK_SECONDS:
+            logger.warning(f"{self.name} connection returned after {time.monotonic() - entry[0]:.0f}s")
+
+    def stats(self) -> dict:
+        """Pool usage, and connections held past DATABASE_LEAK_SECONDS (each logged once)."""
+        now = time.monotonic()
+        with self._lock:
+            held = {key: (now - since, stack) for key, (since, stack) in self._checked_out.items()}
+            leaked = {key: v for key, v in held.items() if v[0] > DATABASE_LEAK_SECONDS}
+            new_leaks = [v for key, v in leaked.items() if key not in self._reported]
+            self._reported.update(leaked)
+            self.leaks += len(new_leaks)
+        for seconds, stack in new_leaks:
+            logger.warning(f"{self.name} connection held for {seconds:.0f}s, possible session leak"
+                           + (f"; checked out at:\n{stack}" if stack else ""))
+        return {
+            "pool_size": self.pool.size() if hasattr(self.pool, "size") else None,
+            "checked_out": len(held),
+            "overflow": max(self.pool.overflow(), 0) if hasattr(self.pool, "overflow") else None,
+            "longest_held_s": round(max((v[0] for v in held.values()), default=0.0), 1),
+            "leaked_now": len(leaked),
+            "leaks_total": self.leaks,
+        }
+
+_pool_monitors = (_PoolMonitor("sync", engine), _PoolMonitor("async", async_engine.sync_engine))
+
+def pool_stats() -> dict:
+    """Connection pool metrics for the sync and async engines."""
+    return {monitor.name: monitor.stats() for monitor in _pool_monitors}
+
+metrics.gauge("db_pool_checked_out", "Connections checked out of each engine's pool.",
+              lambda: {(name,): stats["checked_out"] for name, stats in pool_stats().items()}, ["engine"])
+metrics.counter_from("db_pool_leaks_total", "Connections held longer than DATABASE_LEAK_SECONDS.",
+                     lambda: {(name,): stats["leaks_total"] for name, stats in pool_stats().items()}, ["engine"])
+metrics.gauge("db_write_queue_depth", "Writes waiting for the writer thread.", lambda: db_writer.stats()["queue_depth"])
+metrics.counter_from("db_writes_total", "Writes run by the writer thread.",
+                     lambda: {("ok",): db_writer.completed, ("error",): db_writer.failed}, ["result"])
+
+# --- Query Metrics --- #
+
+DB_QUERY_SECONDS = metrics.histogram(
+    "db_query_seconds", "Time to execute a SQL statement, by engine and statement kind.",
+    ["engine", "statement"], buckets=metrics.FAST_BUCKETS,
+)
+DB_QUERY_ERRORS = metrics.counter("db_query_errors_total", "SQL statements that raised.", ["engine"])
+
+_STATEMENT_KINDS = {"SELECT", "INSERT", "UPDATE", "DELETE", "PRAGMA"}
+
+def _statement_kind(statement: str) -> str:
+    words = statement.split(None, 1)
+    kind = words[0].upper() if words else ""
+    return kind.lower() if kind in _STATEMENT_KINDS else "other"
+
+def _time_queries(name: str, engine):
+    """Times every statement the engine runs, with cursor events on its connections."""
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        DB_QUERY_SECONDS.labels(engine=name, statement=_statement_kind(statement)).observe(time.perf_counter() - started)
+
+    def error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_started"):
+            conn.info["query_started"].pop()
+        DB_QUERY_ERRORS.labels(engine=name).inc()
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+    event.listen(engine, "handle_error", error)
+
+_time_queries("sync", engine)
+_time_queries("async", async_engine.sync_engine)
+
+def _upgrade_schema():
+    """Adds columns and indexes introduced after a table was first created."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(dialect=engine.dialect)
+                    logger.info(f"Adding column {table.name}.{column.name}")
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'))
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+        if inspector.has_table(Booking.__tablename__):
+            # Rows written before total_price_satang existed, or by other tools
+            backfilled = conn.execute(text(
+                'UPDATE bookings SET total_price_satang = CAST(ROUND(total_price * 100) AS INTEGER) '
+                'WHERE total_price_satang IS NULL AND total_price IS NOT NULL'
+            )).rowcount
+            if backfilled:
+                logger.info(f"Backfilled total_price_satang for {backfilled} bookings")
+
 def init_db():
-    """Initializes the database and creates tables if they don't exist."""
+    """Initializes the database and creates tables if they don't exist. Raises if it cannot."""
     try:
         logger.info("Initializing database...")
         Base.metadata.create_all(bind=engine)
+        conversation.create_tables(engine)
+        _upgrade_schema()
+        with SessionLocal() as db:
+            # First start with the rollup table: fill it from existing history
+            if db.query(DailySummary.day).first() is None and (
+                db.query(Booking.id).filter(Booking.is_paid == True).first() or db.query(Expense.id).first()
+            ):
+                rebuild_daily_summary(db)
         logger.info("Database initialized successfully.")
     except Exception as e:
         logger.error(f"Error initializing database: {e}", exc_info=True)
+        raise
 
 # --- CRUD Operations --- #
 
 def find_booking_by_details(db, name: str, amount: float):
-    """Finds an unpaid booking matching customer name and amount."""
+    """Finds the unpaid booking that best matches the customer name and amount."""
+    from app.reconcile import match_booking  # app.reconcile builds on the models in this module
+    return match_booking(db, name, amount)
+
+def get_unpaid_bookings_by_amount(db, min_satang: int, max_satang: int):
+    """Returns unpaid bookings whose total lies in [min_satang, max_satang], using the (is_paid, amount) indexes."""
     return db.query(Booking).filter(
-        Booking.customer_name.ilike(f'%{name}%'),
-        Booking.total_price == amount,
-        Booking.is_paid == False
-    ).first()
-
-def mark_booking_as_paid(db, booking_id: int):
-    """Marks a booking as paid."""
-    booking = db.query(Booking).filter(Booking.id == booking_id).first()
-    if booking:
-        booking.is_paid = True
-        db.commit()
-        return booking
-    return None
-
-def create_payment_slip_record(db, booking_id: int, file_id: str, slip_data: str):
-    """Creates a record for a new payment slip."""
-    slip = PaymentSlip(
-        booking_id=booking_id,
-        file_id=file_id,
-        slip_data=slip_data,
-        verified=True # Mark as verified since we found a matching booking
-    )
-    db.add(slip)
+        Booking.is_paid == False,
+        Booking.is_cancelled.isnot(True),
+        or_(
+            Booking.total_price_satang.between(min_satang, max_satang),
+            # Rows inserted by other tools since the last backfill have no satang yet
+            and_(Booking.total_price_satang.is_(None), Booking.total_price.between((min_satang - 0.5) / 100, (max_satang + 0.5) / 100))
+        )
+    ).all()
+
+class DuplicateSlip(Exception):
+    """Raised when a slip that already paid a booking is used to pay another."""
+
+# Called with a booking id after a transaction that marked the booking paid commits
+_booking_paid_listeners = []
+
+def on_booking_paid(listener):
+    """Registers `listener(booking_id)` to run after a booking is marked paid. Usable as a decorator."""
+    _booking_paid_listeners.append(listener)
+    return listener
+
+def _notify_booking_paid(booking_id: int):
+    for listener in _booking_paid_listeners:
+        try:
+            listener(booking_id)
+        except Exception as e:
+            logger.error(f"Booking paid listener failed for booking {booking_id}: {e}", exc_info=True)
+
+def add_expenses(db, expenses: list) -> list:
+    """Inserts several expenses in one transaction. Each item is a dict with description, amount and optional category and date."""
+    rows = [
+        Expense(description=e["description"], amount=e["amount"], category=e.get("category") or "General",
+                date=e.get("date") or datetime.datetime.now())
+        for e in expenses
+    ]
+    db.add_all(rows)
     db.commit()
+    return rows
+
+def verify_payment(db, booking_id: int, file_id: str, slip_data: str, cache_entry_id: int | None = None):
+    """
+    Pays a booking with a slip in one transaction.
+
+    The booking is claimed with a conditional UPDATE (`WHERE is_paid = false`), so
+    when several slips race for the same booking exactly one wins. The slip record
+    and, if given, the OCR cache entry's link to the booking are written in the
+    same transaction, which commits once.
+
+    Returns the new PaymentSlip, or None if the booking was already paid. Raises
+    DuplicateSlip if the cache entry already paid another booking.
+    """
+    try:
+        claimed = db.execute(
+            update(Booking)
+            .where(Booking.id == booking_id, Booking.is_paid == False)
+            .values(is_paid=True)
+            .returning(Booking.total_price, Booking.created_at)
+        ).first()
+        if claimed is None:
+            db.rollback()
+            return None
+        # A bulk UPDATE skips the mapper events, so roll the income up here
+        _bump_daily_summary(db.connection(), _as_day(claimed.created_at), income=claimed.total_price, paid_bookings=1)
+        if cache_entry_id is not None:
+            linked = db.query(OCRCacheEntry).filter(
+                OCRCacheEntry.id == cache_entry_id,
+                OCRCacheEntry.booking_id.is_(None)
+            ).update({OCRCacheEntry.booking_id: booking_id}, synchronize_session=False)
+            # Zero rows also means the entry was evicted, which is no reason to refuse
+            if not linked and db.query(OCRCacheEntry.id).filter(OCRCacheEntry.id == cache_entry_id).first():
+                raise DuplicateSlip(f"Slip {file_id} already paid a booking")
+        slip = PaymentSlip(booking_id=booking_id, file_id=file_id, slip_data=slip_data, verified=True)
+        db.add(slip)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    _notify_booking_paid(booking_id)
     return slip
 
+def get_report_data(db, start: datetime.date, end: datetime.date):
+    """Fetches income and expenses for the days from start to end (inclusive) from the daily summary."""
+    rows = db.query(DailySummary).filter(
+        DailySummary.day >= start,
+        DailySummary.day <= end
+    ).order_by(DailySummary.day).all()
+    income = sum(r.income for r in rows)
+    expenses = sum(r.expenses for r in rows)
+    return {
+        "income": income,
+        "expenses": expenses,
+        "net": income - expenses,
+        "paid_bookings": sum(r.paid_bookings for r in rows),
+        "days": [{"day": r.day, "income": r.income, "expenses": r.expenses, "net": r.income - r.expenses} for r in rows],
+    }
+
 def get_daily_report_data(db, date: datetime.date):
     """Fetches data for the daily financial report."""
-    start_of_day = datetime.datetime.combine(date, datetime.time.min)
-    end_of_day = datetime.datetime.combine(date, datetime.time.max)
+    report = get_report_data(db, date, date)
+    return {"income": report["income"], "expenses": report["expenses"], "net": report["net"]}
+
+def rebuild_daily_summary(db) -> int:
+    """
+    Recomputes the daily summary from every paid booking and expense, in one
+    transaction. Returns the number of days written.
+    """
+    # Delete first: on SQLite this takes the write lock, so no rollup update
+    # can land between the scans below and the commit
+    db.query(DailySummary).delete()
+    totals = defaultdict(lambda: {"income": 0.0, "expenses": 0.0, "paid_bookings": 0, "expense_count": 0})
+    for created_at, price in db.query(Booking.created_at, Booking.total_price).filter(Booking.is_paid == True).yield_per(5000):
+        day = totals[_as_day(created_at)]
+        day["income"] += price or 0.0
+        day["paid_bookings"] += 1
+    for date, amount in db.query(Expense.date, Expense.amount).yield_per(5000):
+        day = totals[_as_day(date)]
+        day["expenses"] += amount or 0.0
+        day["expense_count"] += 1
+    totals.pop(None, None)
+    if totals:
+        db.execute(DailySummary.__table__.insert(), [{"day": day, **values} for day, values in totals.items()])
+    db.commit()
+    logger.info(f"Rebuilt daily summary for {len(totals)} days")
+    return len(totals)
+
+def get_rooms(db, floor: int | None = None):
+    """Returns registered rooms, optionally only those on one floor."""
+    query = db.query(Room)
+    if floor is not None:
+        query = query.filter(Room.floor == floor)
+    return query.order_by(Room.room_number).all()
+
+def get_occupied_room_numbers(db, at: datetime.datetime) -> set:
+    """Returns the room numbers with a booking covering the given moment."""
+    rows = db.query(Booking.room_number).filter(
+        Booking.check_in_date <= at,
+        Booking.check_out_date > at,
+        Booking.is_cancelled.isnot(True)
+    ).distinct().all()
+    return {row.room_number for row in rows}
+
+# --- Bookings and Availability --- #
 
-    income = db.query(func.sum(Booking.total_price)).filter(
-        Booking.is_paid == True,
-        Booking.created_at >= start_of_day,
-        Booking.created_at <= end_of_day
-    ).scalar() or 0.0
+class BookingConflict(Exception):
+    """Raised when a new booking overlaps nights already booked in the same room."""
 
-    expenses = db.query(func.sum(Expense.amount)).filter(
-        Expense.date >= start_of_day,
-        Expense.date <= end_of_day
-    ).scalar() or 0.0
+    def __init__(self, room_number: str, booking_ids: list):
+        super().__init__(f"Room {room_number} is already booked for those nights (booking {', '.join(map(str, booking_ids))})")
+        self.room_number = room_number
+        self.booking_ids = booking_ids
 
-    return {"income": income, "expenses": expenses, "net": income - expenses}
+def _overlapping_nights(first_night: datetime.date, end_night: datetime.date):
+    """
+    Filter for active bookings holding any night from first_night up to (not
+    including) end_night. A booking holds the nights from its check-in day up
+    to its check-out day, whatever the times of day.
+    """
+    return and_(
+        Booking.check_in_date < datetime.datetime.combine(end_night, datetime.time.min),
+        Booking.check_out_date >= datetime.datetime.combine(first_night + datetime.timedelta(days=1), datetime.time.min),
+        Booking.is_cancelled.isnot(True),
+    )
+
+def find_overlapping_bookings(db, room_number: str, first_night: datetime.date, end_night: datetime.date, exclude_id: int | None = None):
+    """Returns the active bookings of a room holding any of the nights, using the (room, check-in, check-out) index."""
+    query = db.query(Booking).filter(Booking.room_number == room_number, _overlapping_nights(first_night, end_night))
+    if exclude_id is not None:
+        query = query.filter(Booking.id != exclude_id)
+    return query.order_by(Booking.check_in_date).all()
+
+def get_booked_rooms(db, first_night: datetime.date, end_night: datetime.date) -> dict:
+    """Returns {room_number: [booking ids]} for rooms with a booking holding any of the nights."""
+    booked = defaultdict(list)
+    rows = db.query(Booking.room_number, Booking.id).filter(_overlapping_nights(first_night, end_night)).order_by(Booking.check_in_date)
+    for room_number, booking_id in rows:
+        booked[room_number].append(booking_id)
+    return dict(booked)
+
+class UnknownRoom(ValueError):
+    """Raised when booking a room that is not in the rooms registry."""
+
+def _lock_room(db, room_number: str):
+    """
+    Serializes bookings of one room until the transaction ends. Registered rooms
+    lock their `rooms` row; while no rooms are registered at all, any room may be
+    booked, and PostgreSQL takes an advisory lock on the room number instead
+    (SQLite already holds the database write lock since the insert).
+    """
+    room = db.query(Room.id).filter(Room.room_number == room_number).with_for_update().first()
+    if room is not None:
+        return
+    if db.query(Room.id).first() is not None:
+        raise UnknownRoom(f"Room {room_number} is not registered")
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(select(func.pg_advisory_xact_lock(func.hashtext(f"booking:{room_number}"))))
+
+def create_booking(db, customer_name: str, room_number: str, check_in: datetime.datetime, check_out: datetime.datetime, total_price: float):
+    """
+    Books a room, refusing overlaps in the same transaction.
+
+    The row is inserted before the overlap check, so on SQLite the insert takes
+    the write lock and a concurrent booking only checks once this one has
+    committed or rolled back. PostgreSQL serializes bookings of the same room
+    on its `rooms` row instead (see _lock_room).
+
+    Returns the new Booking. Raises BookingConflict if the room is taken for any
+    of the nights, UnknownRoom if rooms are registered and this is not one of
+    them, or ValueError if the stay is not at least one night.
+    """
+    if check_out.date() <= check_in.date():
+        raise ValueError("Check-out must be at least one day after check-in")
+    try:
+        booking = Booking(customer_name=customer_name, room_number=room_number, check_in_date=check_in,
+                          check_out_date=check_out, total_price=total_price, is_paid=False, is_cancelled=False)
+        db.add(booking)
+        db.flush()
+        _lock_room(db, room_number)
+        conflicts = find_overlapping_bookings(db, room_number, check_in.date(), check_out.date(), exclude_id=booking.id)
+        if conflicts:
+            raise BookingConflict(room_number, [b.id for b in conflicts])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return booking
+
+def cancel_booking(db, booking_id: int):
+    """Cancels a booking, freeing its nights. Returns the booking, or None if there is no such active booking."""
+    booking = db.query(Booking).filter(Booking.id == booking_id, Booking.is_cancelled.isnot(True)).first()
+    if booking is None:
+        return None
+    booking.is_cancelled = True
+    db.commit()
+    return booking
@@ -0,0 +1,315 @@
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import time
+from typing import Annotated, Awaitable, Callable, Dict, List, Literal, Optional, Union
+from urllib.parse import parse_qsl
+
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, field_validator, model_validator
+
+from app.config import (
+    TELEGRAM_BOT_TOKEN, AUTHORIZED_USER_ID, WEBAPP_AUTH_MAX_AGE, WEBAPP_MAX_ACTIONS,
+    EXPENSE_BATCH_SIZE, EXPENSE_BATCH_WAIT_MS,
+    get_logger
+)
+from app import metrics
+from app import subsystems
+
+logger = get_logger(__name__)
+
+ACTION_SECONDS = metrics.histogram("action_seconds", "Time to run a Web App or device action, by type and result.", ["type", "ok"])
+
+AC_MIN_TEMPERATURE = 16
+AC_MAX_TEMPERATURE = 30
+
+
+class InvalidAction(ValueError):
+    """Raised when a payload is not a valid action."""
+
+
+class InvalidInitData(ValueError):
+    """Raised when Web App initData is missing, forged, expired or from another user."""
+
+
+# --- Action Schemas --- #
+
+class HardwareControl(BaseModel):
+    type: Literal["hardware_control"]
+    device: Literal["light", "ac"]
+    command: str
+    target: str = Field("", max_length=100)  # '' (default room), '12', '12,14', 'floor 3', 'all' or 'vacant'
+
+    @field_validator("command")
+    @classmethod
+    def _normalize_command(cls, command: str) -> str:
+        return command.strip().upper()
+
+    @model_validator(mode="after")
+    def _check_command(self):
+        if self.command in ("ON", "OFF"):
+            return self
+        if self.device == "ac" and self.command.isdigit() and AC_MIN_TEMPERATURE <= int(self.command) <= AC_MAX_TEMPERATURE:
+            return self
+        allowed = "ON, OFF" + (f" or {AC_MIN_TEMPERATURE}-{AC_MAX_TEMPERATURE}" if self.device == "ac" else "")
+        raise ValueError(f"command for {self.device} must be {allowed}")
+
+
+class ExpenseAdd(BaseModel):
+    type: Literal["expense_add"]
+    description: str = Field(min_length=1, max_length=200)
+    amount: float = Field(gt=0, le=10_000_000)
+    category: str = Field("General", max_length=50)
+    date: Optional[datetime.datetime] = None
+
+
+class BookingAdd(BaseModel):
+    type: Literal["booking_add"]
+    customer_name: str = Field(min_length=1, max_length=200)
+    room_number: str = Field(min_length=1, max_length=20)
+    check_in: datetime.date
+    check_out: datetime.date  # the day the guest leaves, so one night is check_in + 1
+    total_price: float = Field(ge=0, le=10_000_000)
+
+    @model_validator(mode="after")
+    def _check_stay(self):
+        if self.check_out <= self.check_in:
+            raise ValueError("check_out must be after check_in")
+        return self
+
+
+class BookingCancel(BaseModel):
+    type: Literal["booking_cancel"]
+    booking_id: int = Field(gt=0)
+
+
+Action = Annotated[Union[HardwareControl, ExpenseAdd, BookingAdd, BookingCancel], Field(discriminator="type")]
+_action_adapter = TypeAdapter(Action)
+
+
+def parse_action(data: Union[str, dict]) -> Action:
+    """Validates one action payload (a dict or its JSON text). Raises InvalidAction with a readable reason."""
+    try:
+        if isinstance(data, str):
+            return _action_adapter.validate_json(data)
+        return _action_adapter.validate_python(data)
+    except ValidationError as e:
+        reasons = "; ".join(
+            f"{'.'.join(str(part) for part in error['loc'][1:]) or 'payload'}: {error['msg'].removeprefix('Value error, ')}" for error in e.errors()
+        )
+        raise InvalidAction(reasons) from e
+
+
+def parse_web_app_data(data: str) -> List[Action]:
+    """
+    Parses a Web App sendData payload: one action, or {"type": "batch", "actions": [...]}
+    when several actions were queued before sending.
+    """
+    try:
+        payload = json.loads(data)
+    except json.JSONDecodeError as e:
+        raise InvalidAction(f"payload is not JSON: {e}") from e
+    if isinstance(payload, dict) and payload.get("type") == "batch":
+        return [parse_action(item) for item in payload.get("actions") or []]
+    return [parse_action(payload)]
+
+
+class ActionBatch(BaseModel):
+    """Body of POST /api/actions. Actions are validated one by one, so one bad action does not reject the rest."""
+    actions: List[dict] = Field(min_length=1, max_length=WEBAPP_MAX_ACTIONS)
+
+
+class ActionResult(BaseModel):
+    ok: bool
+    message: str
+    id: Optional[int] = None  # id of the created record, if any
+
+
+# --- Expense Batching --- #
+
+class ExpenseBatcher:
+    """
+    Inserts expenses submitted close together in one transaction through the
+    database writer. The first expense of a batch waits up to `max_wait`
+    seconds for others; a full batch is written at once.
+    """
+
+    def __init__(self, max_size: int, max_wait: float):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending: List[tuple] = []  # (expense dict, future)
+        self._timer: Optional[asyncio.Task] = None
+        self._tasks = set()
+        # Metrics
+        self.batches = 0
+        self.inserted = 0
+
+    async def add(self, expense: dict) -> int:
+        """Queues an expense and returns its id once its batch is committed."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((expense, future))
+        if len(self._pending) >= self.max_size:
+            self._flush_soon()
+        elif self._timer is None:
+            self._timer = self._spawn(self._flush_after_wait())
+        return await future
+
+    def _spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_after_wait(self):
+        await asyncio.sleep(self.max_wait)
+        self._timer = None
+        await self._flush()
+
+    def _flush_soon(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._spawn(self._flush())
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            database = await subsystems.database.get()
+            rows = await database.run_write(database.add_expenses, [expense for expense, _ in batch])
+        except Exception as e:
+            logger.error(f"Error inserting {len(batch)} expenses: {e}", exc_info=True)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.inserted += len(rows)
+        for (_, future), row in zip(batch, rows):
+            if not future.done():
+                future.set_result(row.id)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "inserted": self.inserted, "pending": len(self._pending)}
+
+
+expense_batcher = ExpenseBatcher(EXPENSE_BATCH_SIZE, EXPENSE_BATCH_WAIT_MS / 1000)
+
+
+# --- Handlers --- #
+
+_handlers: Dict[str, Callable[[BaseModel], Awaitable[ActionResult]]] = {}
+
+
+def handles(action_type: str):
+    """Registers the handler for an action type."""
+    def register(handler):
+        _handlers[action_type] = handler
+        return handler
+    return register
+
+
+@handles("hardware_control")
+async def _hardware_control(action: HardwareControl) -> ActionResult:
+    """Sends the command over MQTT to every room the target resolves to."""
+    try:
+        mqtt = await subsystems.mqtt.get()
+    except subsystems.SubsystemUnavailable:
+        return ActionResult(ok=False, message="Device control is not available right now.")
+    database = await subsystems.database.get()
+    async with database.get_async_db() as db:
+        rooms = await db.run_sync(mqtt.resolve_targets, action.target, action.device)
+    if not rooms:
+        return ActionResult(ok=False, message=f"No rooms with a {action.device} match '{action.target}'.")
+    results = await mqtt.publish_to_rooms(rooms, action.device, action.command)
+    sent = sum(1 for r in results.values() if r == "sent")
+    skipped = sum(1 for r in results.values() if r == "skipped")
+    failed = [room for room, r in results.items() if r == "failed"]
+    if len(rooms) == 1 and not action.target:
+        if failed:
+            return ActionResult(ok=False, message=f"Failed to send {action.command} to the {action.device}.")
+        return ActionResult(ok=True, message=f"Sent {action.command} to the {action.device}.")
+    message = f"{action.device} {action.command} for {len(rooms)} room(s): {sent} sent, {skipped} already {action.command}."
+    if failed:
+        message += f"\nFailed: {', '.join(failed)}"
+    return ActionResult(ok=not failed, message=message)
+
+
+@handles("expense_add")
+async def _expense_add(action: ExpenseAdd) -> ActionResult:
+    expense_id = await expense_batcher.add(action.model_dump(exclude={"type"}))
+    return ActionResult(ok=True, message=f"Recorded expense: {action.description}, {action.amount:.2f} THB ({action.category}).",
+                        id=expense_id)
+
+
+@handles("booking_add")
+async def _booking_add(action: BookingAdd) -> ActionResult:
+    """Books the room unless another booking holds any of its nights."""
+    database = await subsystems.database.get()
+    try:
+        booking = await database.run_write(
+            database.create_booking, action.customer_name, action.room_number,
+            datetime.datetime.combine(action.check_in, datetime.time.min),
+            datetime.datetime.combine(action.check_out, datetime.time.min), action.total_price,
+        )
+    except (database.BookingConflict, database.UnknownRoom) as e:
+        return ActionResult(ok=False, message=str(e))
+    nights = (action.check_out - action.check_in).days
+    return ActionResult(ok=True, message=f"Booked room {action.room_number} for {action.customer_name}, "
+                                         f"{action.check_in} to {action.check_out} ({nights} night(s)), {action.total_price:.2f} THB.",
+                        id=booking.id)
+
+
+@handles("booking_cancel")
+async def _booking_cancel(action: BookingCancel) -> ActionResult:
+    database = await subsystems.database.get()
+    booking = await database.run_write(database.cancel_booking, action.booking_id)
+    if booking is None:
+        return ActionResult(ok=False, message=f"No active booking with ID {action.booking_id}.")
+    return ActionResult(ok=True, message=f"Cancelled booking {booking.id} (room {booking.room_number}, {booking.customer_name}).",
+                        id=booking.id)
+
+
+async def dispatch(action: Action) -> ActionResult:
+    """Runs the handler for one validated action. Handler errors become a failed result."""
+    started = time.perf_counter()
+    try:
+        result = await _handlers[action.type](action)
+    except Exception as e:
+        logger.error(f"Error handling {action.type} action: {e}", exc_info=True)
+        result = ActionResult(ok=False, message=f"Could not complete {action.type}.")
+    ACTION_SECONDS.labels(type=action.type, ok=result.ok).observe(time.perf_counter() - started)
+    return result
+
+
+async def dispatch_many(actions: List[Action]) -> List[ActionResult]:
+    """Runs actions concurrently, so the expenses among them share one transaction. Results keep the input order."""
+    return list(await asyncio.gather(*(dispatch(action) for action in actions)))
+
+
+# --- Web App Authentication --- #
+
+def verify_init_data(init_data: str, max_age: int = WEBAPP_AUTH_MAX_AGE) -> dict:
+    """
+    Checks Telegram.WebApp.initData as Telegram specifies: the HMAC-SHA256 of the
+    sorted fields, keyed with HMAC("WebAppData", bot token), must match `hash`.
+    Also rejects stale signatures and users other than the authorized one.
+    Returns the fields, with `user` decoded.
+    """
+    if not init_data:
+        raise InvalidInitData("initData is missing")
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop("hash", "")
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", TELEGRAM_BOT_TOKEN.encode(), hashlib.sha256).digest()
+    expected_hash = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected_hash, received_hash):
+        raise InvalidInitData("initData signature does not match")
+    if time.time() - int(fields.get("auth_date", 0)) > max_age:
+        raise InvalidInitData("initData has expired")
+    fields["user"] = json.loads(fields.get("user") or "{}")
+    if fields["user"].get("id") != AUTHORIZED_USER_ID:
+        raise InvalidInitData("user is not authorized")
+    return fields
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from app.config import (
+    GEMINI_API_KEY, GEMINI_MODEL, GEMINI_API_ENDPOINT,
+    LLM_MAX_CONCURRENCY, LLM_TIMEOUT, LLM_RETRIES, LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES,
+    get_logger
+)
+from app import metrics
+
+logger = get_logger(__name__)
+
+LLM_REQUEST_SECONDS = metrics.histogram(
+    "llm_request_seconds", "Time of a Gemini request, retries included, from getting a slot until the last chunk.",
+    ["mode", "outcome"],
+)
+LLM_FIRST_CHUNK_SECONDS = metrics.histogram(
+    "llm_first_chunk_seconds", "Time from getting a slot until Gemini's first chunk of text.", ["mode"]
+)
+LLM_WAIT_SECONDS = metrics.histogram(
+    "llm_wait_seconds", "Time a request waited for one of the LLM_MAX_CONCURRENCY slots.", buckets=metrics.FAST_BUCKETS + (5.0, 10.0, 30.0)
+)
+
+# Worth another attempt: rate limiting and transient server errors
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """Raised when the model gives no usable answer after all retries."""
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Cache key for a prompt: 'What time is  checkout?' and 'what time is checkout' share one."""
+    return re.sub(r"[\s?!.。]+$", "", " ".join(prompt.casefold().split()))
+
+
+class ResponseCache:
+    """Answers by normalized prompt, expiring after `ttl` seconds and evicting the least recently used."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()  # key -> (answer, expires_at)
+
+    def get(self, prompt: str) -> Optional[str]:
+        key = normalize_prompt(prompt)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        answer, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return answer
+
+    def put(self, prompt: str, answer: str):
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        key = normalize_prompt(prompt)
+        self._entries[key] = (answer, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LLMGateway:
+    """
+    Async gateway to the Gemini REST API.
+
+    Requests share one keep-alive client, at most `max_concurrency` run at once,
+    and each attempt is bounded by `timeout`. Timeouts, connection errors, 429 and
+    5xx responses are retried with jittered exponential backoff. Answers are cached
+    by normalized prompt, so repeated FAQ questions never reach the API.
+    """
+
+    def __init__(self, api_key: str, model: str, endpoint: str, max_concurrency: int,
+                 timeout: float, retries: int, cache: ResponseCache):
+        self.api_key = api_key
+        self.model = model
+        self.endpoint = endpoint.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = cache
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client: httpx.AsyncClient | None = None
+        # Metrics
+        self.requests = 0
+        self.cache_hits = 0
+        self.retried = 0
+        self.failed = 0
+        self.in_flight = 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.endpoint,
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 10)),
+                limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60),
+            )
+        return self._client
+
+    async def close(self, *args):
+        """Closes the HTTP client. Usable as a PTB post_shutdown hook."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _url(self, method: str) -> str:
+        return f"/v1beta/models/{self.model}:{method}"
+
+    def _body(self, prompt: str) -> dict:
+        return {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+
+    @staticmethod
+    def _text(response: dict) -> str:
+        candidates = response.get("candidates") or []
+        if not candidates:
+            return ""
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(part.get("text", "") for part in parts)
+
+    async def _backoff(self, attempt: int, reason: str):
+        self.retried += 1
+        delay = min(0.5 * 2 ** attempt, 8) * random.uniform(0.5, 1.0)
+        logger.warning(f"Gemini request failed ({reason}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    async def generate(self, prompt: str) -> str:
+        """Returns the model's full answer to `prompt`. Raises LLMError if it cannot get one."""
+        cached = self.cache.get(prompt)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+        chunks = [chunk async for chunk in self._stream_or_generate(prompt, stream=False)]
+        return "".join(chunks)
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        """
+        Yields the answer in chunks as the model produces them. A cached answer is
+        yielded whole. Retries only happen before the first chunk has been yielded.
+        """
+        cached = self.cache.get(prompt)
+        if cached is not None:
+            self.cache_hits += 1
+            yield cached
+            return
+        async for chunk in self._stream_or_generate(prompt, stream=True):
+            yield chunk
+
+    async def _stream_or_generate(self, prompt: str, stream: bool) -> AsyncIterator[str]:
+        self.requests += 1
+        client = self._get_client()
+        params = {"key": self.api_key}
+        if stream:
+            params["alt"] = "sse"
+        url = self._url("streamGenerateContent" if stream else "generateContent")
+        mode = "stream" if stream else "generate"
+        waited = time.perf_counter()
+        async with self._semaphore:
+            started = time.perf_counter()
+            LLM_WAIT_SECONDS.observe(started - waited)
+            outcome = "error"
+            self.in_flight += 1
+            try:
+                for attempt in range(self.retries + 1):
+                    last_attempt = attempt == self.retries
+                    answer = []
+                    try:
+                        async with client.stream("POST", url, params=params, json=self._body(prompt)) as response:
+                            if response.status_code in _RETRY_STATUSES and not last_attempt:
+                                await self._backoff(attempt, f"HTTP {response.status_code}")
+                                continue
+                            if response.status_code >= 400:
+                                body = (await response.aread()).decode(errors="replace")[:200]
+                                raise LLMError(f"Gemini returned HTTP {response.status_code}: {body}")
+                            if stream:
+                                async for line in response.aiter_lines():
+                                    if not line.startswith("data:"):
+                                        continue
+                                    text = self._text(json.loads(line[5:]))
+                                    if text:
+                                        if not answer:
+                                            LLM_FIRST_CHUNK_SECONDS.labels(mode=mode).observe(time.perf_counter() - started)
+                                        answer.append(text)
+                                        yield text
+                            else:
+                                text = self._text(json.loads(await response.aread()))
+                                if text:
+                                    LLM_FIRST_CHUNK_SECONDS.labels(mode=mode).observe(time.perf_counter() - started)
+                                    answer.append(text)
+                                    yield text
+                    except (httpx.TimeoutException, httpx.TransportError) as e:
+                        if answer or last_attempt:
+                            raise LLMError(f"Gemini request failed: {e!r}") from e
+                        await self._backoff(attempt, type(e).__name__)
+                        continue
+                    if not answer:
+                        raise LLMError("Gemini returned no text")
+                    self.cache.put(prompt, "".join(answer))
+                    outcome = "ok"
+                    return
+            except LLMError:
+                self.failed += 1
+                raise
+            finally:
+                self.in_flight -= 1
+                LLM_REQUEST_SECONDS.labels(mode=mode, outcome=outcome).observe(time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "cache_entries": len(self.cache),
+            "retried": self.retried,
+            "failed": self.failed,
+            "in_flight": self.in_flight,
+        }
+
+
+gateway = LLMGateway(
+    api_key=GEMINI_API_KEY,
+    model=GEMINI_MODEL,
+    endpoint=GEMINI_API_ENDPOINT,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    timeout=LLM_TIMEOUT,
+    retries=LLM_RETRIES,
+    cache=ResponseCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL),
+)
+
+metrics.counter_from("llm_cache_hits_total", "Questions answered from the response cache.", lambda: gateway.cache_hits)
+metrics.counter_from("llm_retries_total", "Gemini requests retried after a timeout, 429 or 5xx.", lambda: gateway.retried)
+metrics.gauge("llm_in_flight", "Gemini requests in progress.", lambda: gateway.in_flight)
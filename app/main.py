@@ -1,170 +1,67 @@
 
 import asyncio
-import threading
-from fastapi import FastAPI, Request
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-import uvicorn
-import google.generativeai as genai
-from telegram import Update, WebAppInfo, KeyboardButton, ReplyKeyboardMarkup
 import datetime
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackContext
+import hmac
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, PlainTextResponse
 
-# Import from our modules
+# Import from our modules. The bot, database, OCR, AI, MQTT and geofences are
+# subsystems started by the lifespan handler, so importing this module stays fast.
 from app.config import (
-    TELEGRAM_BOT_TOKEN, AUTHORIZED_USER_ID, GEMINI_API_KEY,
+    TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_PATH, TELEGRAM_WEBHOOK_SECRET, TELEGRAM_UPDATE_QUEUE_SIZE,
+    METRICS_ENABLED, METRICS_TOKEN, LOG_TRACE_IDS, PROFILER_ENABLED, PROFILER_MAX_SECONDS,
     get_logger
 )
-from app.database import init_db, get_db, find_booking_by_details, mark_booking_as_paid, create_payment_slip_record, get_daily_report_data
-from app.ocr import process_payment_slip
-from app.mqtt import publish_command
-from geofence import get_geofences_containing_point
+from app import dispatcher
+from app import metrics
+from app import subsystems
+from app.subsystems import SubsystemUnavailable, registry
 
 # --- Initialization ---
 logger = get_logger(__name__)
 
-# Configure Gemini AI
-genai.configure(api_key=GEMINI_API_KEY)
-ai_model = genai.GenerativeModel('gemini-pro')
-
-# FastAPI app setup
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="webapp"), name="static")
-
-# --- Authorization ---
-def is_authorized(update: Update) -> bool:
-    """Checks if the user is authorized to use the bot."""
-    return update.effective_user.id == AUTHORIZED_USER_ID
+HTTP_SECONDS = metrics.histogram("http_request_seconds", "Time to answer an HTTP request, by route and status.", ["method", "route", "status"])
 
-# --- Telegram Bot Handlers ---
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update):
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-
-    # Create a button that opens the web app
-    web_app_button = KeyboardButton(
-        "Open Hotel OS Web App",
-        web_app=WebAppInfo(url=f"https://nssuwan186-Bot-telegram.hf.space/static/index.html")
-    )
-    keyboard = [[web_app_button]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-
-    await update.message.reply_text(
-        "Welcome to Hotel OS! Use the button below to manage payments and expenses.",
-        reply_markup=reply_markup
-    )
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update): return
-    help_text = """
-    Available Commands:
-    /start - Show the main menu and Web App button.
-    /help - Show this help message.
-    /daily_report - Get a summary of today's income and expenses.
-    /light <ON|OFF> - Control the lights.
-    /ac <ON|OFF|temperature> - Control the AC.
-    
-    You can also send me a payment slip image to verify it, or ask me anything else.
+# --- Application Lifecycle ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     """
-    await update.message.reply_text(help_text)
-
-async def daily_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update): return
-    db = next(get_db())
-    today = datetime.date.today()
-    report_data = get_daily_report_data(db, today)
-    message = (
-        f"Financial Report for {today.strftime('%Y-%m-%d')}:\n"
-        f"- Total Income: {report_data['income']:.2f} THB\n"
-        f"- Total Expenses: {report_data['expenses']:.2f} THB\n"
-        f"--------------------\n"
-        f"- Net Profit: {report_data['net']:.2f} THB"
-    )
-    await update.message.reply_text(message)
-
-async def handle_payment_slip(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update): return
-    
-    file_id = update.message.photo[-1].file_id
-    await update.message.reply_text("Processing your payment slip... This may take a moment.")
-
-    ocr_result = await asyncio.to_thread(process_payment_slip, context.bot, file_id)
-
-    if not ocr_result:
-        await update.message.reply_text("Sorry, I couldn't read the details from the slip. Please check the image quality or enter the details manually.")
-        return
-
-    db = next(get_db())
-    booking = find_booking_by_details(db, name=ocr_result['name'], amount=ocr_result['amount'])
-
-    if booking:
-        mark_booking_as_paid(db, booking.id)
-        create_payment_slip_record(db, booking.id, file_id, str(ocr_result))
-        await update.message.reply_text(
-            f"Success! Payment verified for booking ID {booking.id} (Customer: {booking.customer_name}). The booking is now marked as paid."
-        )
-    else:
-        await update.message.reply_text(
-            f"I read the slip (Name: {ocr_result['name']}, Amount: {ocr_result['amount']}), but couldn't find a matching unpaid booking. Please check the details."
-        )
-
-async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update): return
-    
-    lat = update.message.location.latitude
-    lon = update.message.location.longitude
-    
-    await update.message.reply_text(f"Received your location: Lat={lat}, Lon={lon}. Checking geofences...")
-
-    db = next(get_db())
-    containing_fences = get_geofences_containing_point(db, lat, lon)
-
-    if containing_fences:
-        fence_names = [f.name for f in containing_fences]
-        await update.message.reply_text(f"You are currently inside the following geofence(s): {', '.join(fence_names)}")
-    else:
-        await update.message.reply_text("You are not currently inside any known geofence.")
-
-async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update): return
-    
-    user_text = update.message.text
-    logger.info(f"Received text from user: {user_text}")
-
-    # Simple routing for hardware commands
-    if user_text.lower().startswith('/light'):
-        parts = user_text.split()
-        if len(parts) > 1 and parts[1].upper() in ['ON', 'OFF']:
-            command = parts[1].upper()
-            if publish_command('light', command):
-                await update.message.reply_text(f"Turned the light {command}.")
-            else:
-                await update.message.reply_text("Failed to send command to the light.")
-        else:
-            await update.message.reply_text("Usage: /light <ON|OFF>")
-        return
+    Starts the subsystems in the background and serves at once: / answers
+    immediately, /ready once the database and the bot are up.
+    """
+    if LOG_TRACE_IDS:
+        metrics.enable_trace_ids()
+    logger.info("Application startup...")
+    registry.start_all()
+    yield
+    await registry.stop_all()
 
-    if user_text.lower().startswith('/ac'):
-        parts = user_text.split()
-        if len(parts) > 1:
-            command = parts[1].upper()
-            if publish_command('ac', command):
-                await update.message.reply_text(f"Sent command '{command}' to the AC.")
-            else:
-                await update.message.reply_text("Failed to send command to the AC.")
-        else:
-            await update.message.reply_text("Usage: /ac <ON|OFF|temperature>")
-        return
+# FastAPI app setup
+app = FastAPI(lifespan=lifespan)
+app.mount("/static", StaticFiles(directory="webapp"), name="static")
 
-    # Fallback to Gemini AI
-    await update.message.reply_chat_action('typing')
+# --- Instrumentation ---
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Times every request by route template, and gives it a trace id (X-Request-ID if the caller sent one)."""
+    token = metrics.trace_id.set(request.headers.get("X-Request-ID") or metrics.new_trace_id())
+    started = time.perf_counter()
+    status = 500
     try:
-        response = await asyncio.to_thread(ai_model.generate_content, user_text)
-        await update.message.reply_text(response.text)
-    except Exception as e:
-        logger.error(f"Error calling Gemini AI: {e}", exc_info=True)
-        await update.message.reply_text("Sorry, I'm having trouble connecting to my AI brain. Please try again later.")
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        HTTP_SECONDS.labels(method=request.method, route=route, status=status).observe(time.perf_counter() - started)
+        metrics.trace_id.reset(token)
+
+def check_metrics_token(authorization: str):
+    if METRICS_TOKEN and not hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="A valid metrics token is required")
 
 # --- FastAPI Endpoints ---
 @app.get("/")
@@ -172,30 +69,113 @@ async def root():
     # This could be a simple health check page
     return {"status": "running"}
 
-# --- Application Lifecycle ---
-def run_bot():
-    """Runs the Telegram bot in a polling loop."""
-    logger.info("Starting Telegram bot polling...")
-    bot_app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
-    # Add handlers
-    bot_app.add_handler(CommandHandler("start", start_command))
-    bot_app.add_handler(CommandHandler("help", help_command))
-    bot_app.add_handler(CommandHandler("daily_report", daily_report_command))
-    bot_app.add_handler(MessageHandler(filters.PHOTO, handle_payment_slip))
-    bot_app.add_handler(MessageHandler(filters.LOCATION, handle_location))
-    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
-
-    bot_app.run_polling()
-
-@app.on_event("startup")
-async def startup_event():
-    """Actions to take on application startup."""
-    logger.info("Application startup...")
-    init_db() # Initialize the database
-    
-    # Run the bot in a separate thread
-    bot_thread = threading.Thread(target=run_bot)
-    bot_thread.daemon = True
-    bot_thread.start()
-    logger.info("Telegram bot thread started.")
+@app.get("/ready")
+async def ready():
+    """
+    503 until the critical subsystems (database, bot) have started, 200 after.
+    Lists every subsystem's state; optional ones may be disabled or failed
+    while the app is ready.
+    """
+    is_ready = registry.ready()
+    return JSONResponse({"ready": is_ready, "subsystems": registry.status()}, status_code=200 if is_ready else 503)
+
+if TELEGRAM_WEBHOOK_URL:
+    @app.post(TELEGRAM_WEBHOOK_PATH)
+    async def telegram_webhook(request: Request):
+        """
+        Receives an update from Telegram and queues it for the bot's handler
+        workers, answering at once. A full queue, or a bot still starting,
+        answers 503, so Telegram backs off and redelivers instead of the
+        update being dropped.
+        """
+        if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), TELEGRAM_WEBHOOK_SECRET):
+            return Response(status_code=403)
+        if not subsystems.bot.ready:
+            return Response(status_code=503)
+        from telegram import Update # Loaded by the bot subsystem by now
+        bot_app = subsystems.bot.value
+        try:
+            update = Update.de_json(await request.json(), bot_app.bot)
+        except Exception as e:
+            logger.warning(f"Ignoring malformed webhook update: {e}")
+            return Response(status_code=400)
+        try:
+            bot_app.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning(f"Update queue full ({TELEGRAM_UPDATE_QUEUE_SIZE}), asking Telegram to retry")
+            return Response(status_code=503)
+        return Response(status_code=200)
+
+@app.post("/api/actions")
+async def post_actions(batch: dispatcher.ActionBatch, x_telegram_init_data: str = Header("")):
+    """
+    Runs a batch of Web App actions in one round trip. The caller is
+    authenticated by the Web App's signed initData in X-Telegram-Init-Data.
+    Each action gets its own result; invalid ones fail without affecting the rest.
+    """
+    try:
+        dispatcher.verify_init_data(x_telegram_init_data)
+    except dispatcher.InvalidInitData as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    try:
+        await subsystems.database.get()
+    except SubsystemUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    actions, results = [], {}
+    for index, payload in enumerate(batch.actions):
+        try:
+            actions.append((index, dispatcher.parse_action(payload)))
+        except dispatcher.InvalidAction as e:
+            results[index] = dispatcher.ActionResult(ok=False, message=str(e))
+    outcomes = await dispatcher.dispatch_many([action for _, action in actions])
+    results.update({index: outcome for (index, _), outcome in zip(actions, outcomes)})
+    return {"results": [results[index] for index in range(len(batch.actions))]}
+
+@app.get("/api/availability")
+async def get_availability(
+    start: datetime.date,
+    end: datetime.date | None = None,
+    floor: int | None = None,
+    x_telegram_init_data: str = Header(""),
+):
+    """
+    Free and booked rooms for the nights from `start` up to the check-out day
+    `end` (default: one night), optionally on one floor. Authenticated like
+    /api/actions.
+    """
+    try:
+        dispatcher.verify_init_data(x_telegram_init_data)
+    except dispatcher.InvalidInitData as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    try:
+        database = await subsystems.database.get()
+    except SubsystemUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    from app import availability # Its models are loaded with the database subsystem
+    try:
+        async with database.get_async_db() as db:
+            return await db.run_sync(availability.find_available_rooms, start, end or start + datetime.timedelta(days=1), floor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+if METRICS_ENABLED:
+    @app.get("/metrics")
+    async def get_metrics(authorization: str = Header("")):
+        """Prometheus metrics of this worker process."""
+        check_metrics_token(authorization)
+        return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+if PROFILER_ENABLED and not METRICS_TOKEN:
+    logger.warning("PROFILER_ENABLED is set without METRICS_TOKEN; /debug/profile is not served")
+elif PROFILER_ENABLED:
+    @app.get("/debug/profile", response_class=PlainTextResponse)
+    async def get_profile(seconds: float = Query(10, gt=0, le=PROFILER_MAX_SECONDS), authorization: str = Header("")):
+        """
+        Samples every thread's stack for `seconds` while the app keeps serving, and
+        returns the stacks in collapsed format for a flame graph. One at a time.
+        """
+        check_metrics_token(authorization)
+        try:
+            return await metrics.profiler.profile(seconds)
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
@@ -0,0 +1,190 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import os
+import sys
+import threading
+import uuid
+from typing import Callable, Optional, Sequence
+
+from prometheus_client import CONTENT_TYPE_LATEST as CONTENT_TYPE
+from prometheus_client import REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from app.config import LOG_FORMAT, PROFILER_INTERVAL_MS, get_logger
+
+logger = get_logger(__name__)
+
+# Seconds. DEFAULT_BUCKETS suits handlers, OCR and model calls; FAST_BUCKETS suits SQL statements and MQTT acks.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+# --- Metric Types --- #
+
+class Callback:
+    """
+    A value read when metrics are scraped, for state a component already keeps
+    (queue depths, connection counts, its own counters). `read` returns a number,
+    or a dict of label values (a tuple) to number when the metric has labels.
+    """
+
+    def __init__(self, name: str, documentation: str, read: Callable, kind: str = "gauge", labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        self.family = CounterMetricFamily if kind == "counter" else GaugeMetricFamily
+        self.labelnames = list(labelnames)
+
+    def describe(self):
+        return [self.family(self.name, self.documentation, labels=self.labelnames)]
+
+    def collect(self):
+        family = self.family(self.name, self.documentation, labels=self.labelnames)
+        try:
+            values = self.read()
+        except Exception as e:
+            logger.warning(f"Could not read metric {self.name}: {e}")
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            if value is not None:
+                family.add_metric([str(v) for v in key], value)
+        yield family
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return Counter(name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return Histogram(name, documentation, labelnames, buckets=buckets)
+
+
+def gauge(name: str, documentation: str, read: Callable, labelnames: Sequence[str] = ()) -> Callback:
+    metric = Callback(name, documentation, read, "gauge", labelnames)
+    REGISTRY.register(metric)
+    return metric
+
+
+def counter_from(name: str, documentation: str, read: Callable, labelnames: Sequence[str] = ()) -> Callback:
+    """A counter a component already keeps, read at scrape time."""
+    metric = Callback(name, documentation, read, "counter", labelnames)
+    REGISTRY.register(metric)
+    return metric
+
+
+def render() -> str:
+    """The metrics of this process, process CPU and memory included, in the Prometheus text format."""
+    return generate_latest(REGISTRY).decode()
+
+
+gauge("process_threads", "Threads running in this process.", threading.active_count)
+
+
+# --- Trace IDs --- #
+
+# The update or request the current code runs for. asyncio tasks and
+# asyncio.to_thread inherit it; the database writer thread does not.
+trace_id: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the current trace id to log records as `trace_id`."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id.get()
+        return True
+
+
+def enable_trace_ids():
+    """Tags every log line written through the root handlers with the current trace id."""
+    formatter = logging.Formatter(LOG_FORMAT.replace("%(message)s", "[%(trace_id)s] %(message)s"))
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, TraceIdFilter) for f in handler.filters):
+            handler.addFilter(TraceIdFilter())
+            handler.setFormatter(formatter)
+
+
+# --- Sampling Profiler --- #
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread at a fixed interval from a background
+    thread and counts identical stacks. It does not hook into the code being
+    profiled, so it can run against live traffic for a while. Output is in the
+    collapsed-stack format that flame graph tools (flamegraph.pl, speedscope)
+    read. Stacks are wall-clock: idle threads show up waiting in their poll or
+    queue calls, and time the event loop spends in Python shows up under MainThread.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> bool:
+        """Starts a new profile. Returns False if one is already running."""
+        with self._lock:
+            if self.running:
+                return False
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            if self.samples % 100 == 0:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self, limit: Optional[int] = None) -> str:
+        """The most frequent stacks, one `frame;frame;frame count` line each."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common(limit)) + "\n"
+
+    async def profile(self, seconds: float) -> str:
+        """Profiles for `seconds` without blocking the event loop and returns the collapsed stacks."""
+        if not self.start():
+            raise RuntimeError("A profile is already running")
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(self.stop)
+        logger.info(f"Profiled {seconds}s: {self.samples} samples, {len(self.stacks)} distinct stacks")
+        return self.collapsed()
+
+
+profiler = SamplingProfiler(PROFILER_INTERVAL_MS / 1000)
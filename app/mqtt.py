@@ -1,24 +1,378 @@
+import asyncio
+import datetime
+import json
+import re
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
 import paho.mqtt.client as mqtt
-from app.config import MQTT_BROKER, MQTT_PORT, MQTT_TOPIC_PREFIX, get_logger
+from app.config import (
+    MQTT_BROKER, MQTT_PORT, MQTT_TOPIC_PREFIX, MQTT_TOPIC_ROOT, MQTT_KEEPALIVE, MQTT_QOS,
+    MQTT_PUBLISH_TIMEOUT, MQTT_QUEUE_SIZE, MQTT_MAX_INFLIGHT, MQTT_STATE_TTL, get_logger
+)
+from app.database import get_rooms, get_occupied_room_numbers
+from app import metrics
 
 logger = get_logger(__name__)
 
-def publish_command(device: str, command: str):
+MQTT_PUBLISH_SECONDS = metrics.histogram(
+    "mqtt_publish_seconds", "Time from publishing a batch until the broker acked all of it (or the timeout).",
+    buckets=metrics.FAST_BUCKETS + (5.0, 10.0),
+)
+MQTT_MESSAGES = metrics.counter("mqtt_messages_total", "Messages published, by whether the broker acked them in time.", ["result"])
+
+
+def _set_result(future: asyncio.Future, ok: bool):
+    if not future.done():
+        future.set_result(ok)
+
+
+class MQTTPublisher:
+    """
+    A single long-lived MQTT connection shared by every publisher and subscriber
+    in the process.
+
+    The paho network loop runs in its own thread (`loop_start`) and reconnects on
+    its own after a broker outage. Messages published while disconnected are held
+    in a bounded in-memory outbox and flushed, in order, when the connection is back.
+    Each publish returns an asyncio future that resolves once the broker acks it.
+    Subscriptions are remembered and renewed after every reconnect.
+    """
+
+    def __init__(self, host: str, port: int, keepalive: int = 60, queue_size: int = 1000, max_inflight: int = 100):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self._queue_size = queue_size
+        self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.on_message = self._on_message
+        self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self._client.max_inflight_messages_set(max_inflight)
+        # Neither lock is ever held while calling into paho: paho runs our callbacks
+        # while holding its own mutexes, so doing so could deadlock.
+        self._lock = threading.Lock()  # guards the outbox and connection state
+        self._acks_lock = threading.Lock()  # guards the ack table
+        self._pending = {}  # mid -> (loop, future) awaiting broker ack
+        self._early_acks = set()  # mids acked before they were registered
+        self._outbox = deque()  # (topic, payload, qos, loop, future) held while disconnected
+        self._subscriptions: Dict[str, Tuple[Callable[[str, str], None], int]] = {}
+        self._connected = threading.Event()
+        self._started = False
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    @property
+    def queued(self) -> int:
+        """Number of messages waiting in the outbox for the connection to come back."""
+        return len(self._outbox)
+
+    def start(self):
+        """Connects in the background and starts the network loop thread."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        logger.info(f"Connecting to MQTT broker {self.host}:{self.port}")
+        self._client.connect_async(self.host, self.port, self.keepalive)
+        self._client.loop_start()
+
+    def stop(self):
+        """Disconnects and stops the network loop. Pending publishes resolve as failed."""
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+            pending = [item[3:] for item in self._outbox]
+            self._outbox.clear()
+        with self._acks_lock:
+            pending += list(self._pending.values())
+            self._pending.clear()
+        self._client.disconnect()
+        self._client.loop_stop()
+        for loop, future in pending:
+            self._resolve(loop, future, False)
+
+    # --- paho callbacks (network thread) --- #
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.error(f"MQTT connection refused: {mqtt.connack_string(rc)}")
+            return
+        flushed = 0
+        while True:
+            with self._lock:
+                if not self._outbox:
+                    self._connected.set()
+                    break
+                batch = list(self._outbox)
+                self._outbox.clear()
+            for item in batch:
+                self._send(*item)
+            flushed += len(batch)
+        for pattern, (_, qos) in list(self._subscriptions.items()):
+            client.subscribe(pattern, qos)
+        logger.info(f"Connected to MQTT broker {self.host}:{self.port}" + (f", flushed {flushed} queued messages" if flushed else ""))
+
+    def _on_disconnect(self, client, userdata, rc):
+        with self._lock:
+            self._connected.clear()
+        if rc != 0:
+            logger.warning(f"Lost connection to MQTT broker (rc={rc}), reconnecting...")
+
+    def _on_publish(self, client, userdata, mid):
+        with self._acks_lock:
+            entry = self._pending.pop(mid, None)
+            if entry is None:
+                self._early_acks.add(mid)
+                return
+        self._resolve(*entry, True)
+
+    def _on_message(self, client, userdata, msg):
+        payload = msg.payload.decode(errors="replace")
+        for pattern, (callback, _) in list(self._subscriptions.items()):
+            if mqtt.topic_matches_sub(pattern, msg.topic):
+                try:
+                    callback(msg.topic, payload)
+                except Exception:
+                    logger.exception(f"MQTT handler for '{pattern}' failed on '{msg.topic}'")
+
+    # --- internals --- #
+
+    @staticmethod
+    def _resolve(loop, future, ok: bool):
+        try:
+            loop.call_soon_threadsafe(_set_result, future, ok)
+        except RuntimeError:
+            pass  # the awaiting event loop is already closed
+
+    def _send(self, topic, payload, qos, loop, future):
+        """Hands a message to paho and registers its future for the broker ack."""
+        info = self._client.publish(topic, payload, qos=qos)
+        # For QoS > 0 paho keeps messages published during a reconnect race and
+        # resends them itself, so they are still acked through on_publish.
+        if info.rc == mqtt.MQTT_ERR_SUCCESS or (info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0):
+            with self._acks_lock:
+                acked = info.mid in self._early_acks
+                if acked:
+                    self._early_acks.discard(info.mid)
+                else:
+                    self._pending[info.mid] = (loop, future)
+            if acked:
+                self._resolve(loop, future, True)
+        else:
+            logger.error(f"MQTT publish to '{topic}' failed: {mqtt.error_string(info.rc)}")
+            self._resolve(loop, future, False)
+
+    def _enqueue(self, messages: Iterable[Tuple[str, str]], qos: int) -> List[asyncio.Future]:
+        loop = asyncio.get_running_loop()
+        futures, ready = [], []
+        self.start()
+        with self._lock:
+            for topic, payload in messages:
+                future = loop.create_future()
+                futures.append(future)
+                if self._connected.is_set():
+                    ready.append((topic, payload, qos, loop, future))
+                    continue
+                if len(self._outbox) >= self._queue_size:
+                    dropped = self._outbox.popleft()
+                    logger.warning(f"MQTT outbox full, dropping oldest message for '{dropped[0]}'")
+                    self._resolve(dropped[3], dropped[4], False)
+                self._outbox.append((topic, payload, qos, loop, future))
+        for item in ready:
+            self._send(*item)
+        return futures
+
+    # --- public API --- #
+
+    def subscribe(self, pattern: str, callback: Callable[[str, str], None], qos: int = MQTT_QOS):
+        """
+        Calls `callback(topic, payload)` from the network thread for every message
+        matching `pattern` (MQTT wildcards allowed). Survives reconnects.
+        """
+        self._subscriptions[pattern] = (callback, qos)
+        if self.connected:
+            self._client.subscribe(pattern, qos)
+
+    async def publish(self, topic: str, payload: str, qos: int = MQTT_QOS, timeout: float = MQTT_PUBLISH_TIMEOUT) -> bool:
+        """
+        Publishes one message and waits for the broker to ack it.
+
+        Returns False if the ack does not arrive within `timeout` seconds. A message
+        queued during an outage stays queued and is still delivered on reconnect.
+        """
+        return (await self.publish_many([(topic, payload)], qos=qos, timeout=timeout))[0]
+
+    async def publish_many(self, messages: Iterable[Tuple[str, str]], qos: int = MQTT_QOS, timeout: float = MQTT_PUBLISH_TIMEOUT) -> List[bool]:
+        """
+        Publishes a batch of (topic, payload) messages in one pipelined burst over
+        the shared connection and returns one ack result per message, in order.
+        """
+        started = time.perf_counter()
+        futures = self._enqueue(messages, qos)
+        if not futures:
+            return []
+        done, _ = await asyncio.wait([asyncio.shield(f) for f in futures], timeout=timeout)
+        results = [f.result() if f.done() else False for f in futures]
+        MQTT_PUBLISH_SECONDS.observe(time.perf_counter() - started)
+        acked = sum(results)
+        MQTT_MESSAGES.labels(result="acked").inc(acked)
+        MQTT_MESSAGES.labels(result="failed").inc(len(results) - acked)
+        if len(done) < len(futures):
+            logger.warning(f"{len(futures) - len(done)} of {len(futures)} MQTT publishes not acked within {timeout}s")
+        return results
+
+
+class DeviceState(NamedTuple):
+    room: str
+    device: str
+    value: str
+    updated_at: float  # time.time() of the last state report
+
+
+class DeviceStateCache:
+    """
+    Last state reported by each device, keyed by (room, device).
+
+    Fed from MQTT `.../state` topics, so questions like "is the AC on?" are
+    answered from memory. Entries older than `ttl` seconds are considered stale
+    and are not trusted for skipping duplicate commands.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._states: Dict[Tuple[str, str], DeviceState] = {}
+        self._lock = threading.Lock()
+
+    def update(self, room: str, device: str, value: str, updated_at: Optional[float] = None):
+        state = DeviceState(room, device, value, updated_at or time.time())
+        with self._lock:
+            self._states[(room, device)] = state
+
+    def get(self, room: str, device: str) -> Optional[DeviceState]:
+        with self._lock:
+            return self._states.get((room, device))
+
+    def is_stale(self, state: DeviceState) -> bool:
+        return time.time() - state.updated_at > self.ttl
+
+    def matches(self, room: str, device: str, value: str) -> bool:
+        """True if the device is known, recently, to already be in state `value`."""
+        state = self.get(room, device)
+        return state is not None and not self.is_stale(state) and state.value == value.upper()
+
+    def snapshot(self, room: Optional[str] = None) -> List[DeviceState]:
+        with self._lock:
+            states = list(self._states.values())
+        return sorted((s for s in states if room is None or s.room == room), key=lambda s: (s.room, s.device))
+
+
+def parse_state_payload(payload: str) -> str:
+    """Accepts a plain value ('ON', '25') or JSON such as {"state": "ON"}."""
+    payload = payload.strip()
+    if payload.startswith("{"):
+        try:
+            data = json.loads(payload)
+            if isinstance(data, dict) and "state" in data:
+                payload = str(data["state"])
+        except ValueError:
+            pass
+    return payload.upper()
+
+
+publisher = MQTTPublisher(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE, MQTT_QUEUE_SIZE, MQTT_MAX_INFLIGHT)
+device_states = DeviceStateCache(MQTT_STATE_TTL)
+
+metrics.gauge("mqtt_connected", "1 while the shared MQTT connection is up.", lambda: int(publisher.connected))
+metrics.gauge("mqtt_outbox_messages", "Messages held while the broker is unreachable.", lambda: publisher.queued)
+
+# The room addressed when no target is given, e.g. 'room1' for 'hotel/room1'
+DEFAULT_ROOM = MQTT_TOPIC_PREFIX.rstrip("/").rsplit("/", 1)[-1]
+
+_FLOOR_TARGET = re.compile(r"^floor\s+(\d+)$", re.IGNORECASE)
+_ROOM_PREFIX = re.compile(r"^room\s+", re.IGNORECASE)
+
+
+def command_topic(room: str, device: str) -> str:
+    return f"{MQTT_TOPIC_ROOT}/{room}/{device}/command"
+
+
+def _on_state_message(topic: str, payload: str):
+    """Records a `{root}/{room}/{device}/state` report in the device state cache."""
+    room, device = topic.rsplit("/", 3)[-3:-1]
+    device_states.update(room, device, parse_state_payload(payload))
+
+
+def start():
+    """Opens the shared connection and subscribes to device state topics."""
+    publisher.subscribe(f"{MQTT_TOPIC_ROOT}/+/+/state", _on_state_message)
+    publisher.start()
+
+
+def resolve_targets(db, target: str, device: str) -> List[str]:
+    """
+    Resolves a target expression to room numbers.
+
+    Supported targets: '' (the default room), '12' or 'room 12', '12,14',
+    'floor 3', 'all' and 'vacant' (rooms without a current booking). Group
+    targets only include registered rooms that have `device` installed.
+    """
+    target = target.strip().lower()
+    if not target:
+        return [DEFAULT_ROOM]
+
+    floor = _FLOOR_TARGET.match(target)
+    if floor:
+        rooms = get_rooms(db, floor=int(floor.group(1)))
+    elif target in ("all", "all rooms"):
+        rooms = get_rooms(db)
+    elif target in ("vacant", "vacant rooms", "all vacant rooms"):
+        occupied = get_occupied_room_numbers(db, datetime.datetime.now())
+        rooms = [r for r in get_rooms(db) if r.room_number not in occupied]
+    else:
+        return [_ROOM_PREFIX.sub("", part.strip()) for part in target.split(",") if part.strip()]
+
+    return [r.room_number for r in rooms if device in (r.devices or "").split(",")]
+
+
+async def publish_to_rooms(rooms: List[str], device: str, command: str) -> Dict[str, str]:
+    """
+    Sends `command` to `device` in every room as one batched burst over the shared
+    connection. Returns a per-room result: 'sent', 'failed' or 'skipped' (the
+    device already reported that state).
+    """
+    results = {}
+    to_send = []
+    for room in rooms:
+        if device_states.matches(room, device, command):
+            results[room] = "skipped"
+        else:
+            to_send.append(room)
+    acks = await publisher.publish_many([(command_topic(room, device), command) for room in to_send])
+    for room, ok in zip(to_send, acks):
+        results[room] = "sent" if ok else "failed"
+
+    failed = [room for room, result in results.items() if result == "failed"]
+    logger.info(f"Sent '{command}' to {device} in {len(to_send) - len(failed)}/{len(rooms)} rooms"
+                + (f", failed: {', '.join(failed)}" if failed else ""))
+    return results
+
+
+async def publish_command(device: str, command: str, room: str = DEFAULT_ROOM) -> bool:
     """
-    Publishes a command to a specific MQTT topic.
+    Publishes a command to a device in one room over the shared connection.
+    Commands matching the device's fresh cached state are skipped.
 
     Args:
         device (str): The device to control (e.g., 'light', 'ac').
         command (str): The command to send (e.g., 'ON', 'OFF', '25').
+        room (str): The room number; defaults to the room of MQTT_TOPIC_PREFIX.
     """
-    topic = f"{MQTT_TOPIC_PREFIX}/{device}/command"
-    try:
-        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
-        client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        client.publish(topic, command)
-        client.disconnect()
-        logger.info(f"Published to MQTT topic '{topic}' with message: '{command}'")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to publish to MQTT topic '{topic}': {e}", exc_info=True)
-        return False
+    return (await publish_to_rooms([room], device, command))[room] != "failed"
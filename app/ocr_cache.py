@@ -0,0 +1,124 @@
+import datetime
+import hashlib
+import io
+
+from PIL import Image
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app.config import OCR_CACHE_MAX_ENTRIES, get_logger
+from app.database import OCRCacheEntry
+from app.slip_parser import extract_transaction_key
+
+logger = get_logger(__name__)
+
+# --- Hashing --- #
+
+def content_hash(image_bytes: bytes) -> str:
+    """Exact fingerprint of the image file."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+def perceptual_hash(image_bytes: bytes, size: int = 16) -> str:
+    """
+    Difference hash (dHash) of the image, size*size bits. Unlike the content hash it
+    stays the same when a slip is re-encoded, e.g. forwarded or saved and sent again.
+    Slips from the same bank template can share a hash even when their amounts
+    differ, so a match only marks a candidate; see find_resend.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("L", (size * 4, size * 4)) # JPEG only: decode at a fraction of full size
+    pixels = list(image.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left, right = pixels[row * (size + 1) + col], pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{size * size // 4}x}"
+
+# --- Cache Operations --- #
+
+def _touch(db, entry: OCRCacheEntry | None) -> OCRCacheEntry | None:
+    if entry is not None:
+        entry.last_used_at = datetime.datetime.now()
+        db.commit()
+    return entry
+
+def lookup_by_file(db, file_unique_id: str) -> OCRCacheEntry | None:
+    """Finds a cached result by Telegram file_unique_id, before anything is downloaded."""
+    return _touch(db, db.query(OCRCacheEntry).filter(OCRCacheEntry.file_unique_id == file_unique_id).first())
+
+def lookup_by_image(db, sha256: str) -> OCRCacheEntry | None:
+    """Finds a cached result for the same image bytes."""
+    return _touch(db, db.query(OCRCacheEntry).filter(OCRCacheEntry.content_hash == sha256).first())
+
+def _same_reading(entry: OCRCacheEntry, result: dict) -> bool:
+    """
+    Whether a fresh OCR result shows the same transfer as a cached entry: same
+    name and amount, and the same transaction reference or time. A guest can
+    send two genuine transfers of the same amount, so without a reference or
+    time on both readings the slips count as different.
+    """
+    if entry.amount is None or result.get('amount') is None:
+        return False
+    same_name = " ".join((entry.name or "").casefold().split()) == " ".join((result.get('name') or "").casefold().split())
+    if not same_name or abs(entry.amount - result['amount']) >= 0.005:
+        return False
+    ours = extract_transaction_key(entry.raw_text or "")
+    return ours is not None and ours == extract_transaction_key(result.get('raw_text') or "")
+
+def find_resend(db, dhash: str | None, result: dict) -> OCRCacheEntry | None:
+    """
+    Finds an earlier copy of a re-encoded slip: an entry with the same perceptual
+    hash that shows the same transfer as the fresh OCR result. Entries that paid a
+    booking come first, so a resent slip is flagged as already used.
+    """
+    if not dhash:
+        return None
+    candidates = db.query(OCRCacheEntry).filter(OCRCacheEntry.perceptual_hash == dhash).order_by(
+        OCRCacheEntry.booking_id.is_(None), OCRCacheEntry.id
+    )
+    return next((entry for entry in candidates if _same_reading(entry, result)), None)
+
+def store(db, file_unique_id: str | None, sha256: str, dhash: str | None, result: dict) -> OCRCacheEntry:
+    """
+    Caches an OCR result and evicts the least recently used entries beyond the size limit.
+    Returns the earlier entry instead when the slip is a confirmed resend (see
+    find_resend), or when a concurrent send of the same file stored it first.
+    """
+    resend = find_resend(db, dhash, result)
+    if resend is not None:
+        return _touch(db, resend)
+    entry = OCRCacheEntry(
+        file_unique_id=file_unique_id,
+        content_hash=sha256,
+        perceptual_hash=dhash,
+        name=result['name'],
+        amount=result['amount'],
+        raw_text=result.get('raw_text')
+    )
+    db.add(entry)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        existing = db.query(OCRCacheEntry).filter(OCRCacheEntry.file_unique_id == file_unique_id).first() if file_unique_id else None
+        if existing is None:
+            raise
+        return existing
+    evict(db, OCR_CACHE_MAX_ENTRIES)
+    return entry
+
+def evict(db, max_entries: int) -> int:
+    """
+    Deletes the least recently used entries beyond `max_entries`. Entries that
+    paid a booking are never evicted: they back the duplicate-payment check.
+    """
+    evictable = db.query(OCRCacheEntry.id).filter(OCRCacheEntry.booking_id.is_(None))
+    excess = evictable.count() - max_entries
+    if excess <= 0:
+        return 0
+    oldest = evictable.order_by(OCRCacheEntry.last_used_at, OCRCacheEntry.id).limit(excess).subquery()
+    deleted = db.query(OCRCacheEntry).filter(OCRCacheEntry.id.in_(select(oldest.c.id))).delete(synchronize_session=False)
+    db.commit()
+    logger.info(f"Evicted {deleted} OCR cache entries")
+    return deleted
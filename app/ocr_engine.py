@@ -0,0 +1,159 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from app.config import OCR_WORKERS, OCR_QUEUE_SIZE, OCR_JOB_TIMEOUT, get_logger
+from app import metrics
+
+logger = get_logger(__name__)
+
+OCR_JOB_WAIT_SECONDS = metrics.histogram("ocr_job_wait_seconds", "Time an OCR job waited for a worker process.")
+OCR_JOB_SECONDS = metrics.histogram("ocr_job_seconds", "Time an OCR job ran in a worker process, pickling included.")
+
+
+class OCRQueueFull(Exception):
+    """Raised when the OCR queue is at capacity and a new job cannot be accepted."""
+
+
+class OCRJob:
+    """Handle for a submitted job: its queue position at submit time and its result."""
+
+    def __init__(self, future: asyncio.Future, position: int):
+        self.future = future
+        self.position = position  # jobs ahead of this one; 0 means it starts right away
+
+    async def result(self):
+        return await self.future
+
+
+class OCREngine:
+    """
+    Runs CPU-bound OCR jobs in a process pool sized to the machine's cores.
+
+    Jobs wait in a bounded queue; when it is full, `submit` raises OCRQueueFull
+    instead of piling more work on the CPU. A fixed number of worker tasks feed
+    the pool, so at most `workers` Tesseract runs happen at once and the event
+    loop stays free for text and AI handlers.
+    """
+
+    def __init__(self, workers: int, queue_size: int, timeout: float):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._pool = None
+        self._queue = None
+        self._tasks = []
+        self._running = 0
+        # Metrics
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self._wait_total = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+    def start(self):
+        """Starts the pool and worker tasks on the running event loop."""
+        if self._queue is not None:
+            return
+        self._pool = self._new_pool()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"OCR engine started with {self.workers} workers, queue size {self.queue_size}")
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # spawn: forking a process that runs bot and MQTT threads is unsafe
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def submit(self, fn, *args) -> OCRJob:
+        """
+        Queues `fn(*args)` to run in the process pool. `fn` must be a picklable,
+        module-level function. Raises OCRQueueFull when the queue is at capacity.
+        """
+        self.start()
+        if self._queue.full():
+            self.rejected += 1
+            raise OCRQueueFull(f"OCR queue is full ({self.queue_size} jobs)")
+        future = asyncio.get_running_loop().create_future()
+        ahead = self._queue.qsize() + self._running
+        position = ahead - self.workers + 1 if ahead >= self.workers else 0
+        self._queue.put_nowait((fn, args, future, time.monotonic()))
+        logger.debug(f"Queued OCR job at position {position}, queue depth {self._queue.qsize()}")
+        return OCRJob(future, position)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            fn, args, future, queued_at = await self._queue.get()
+            started = time.monotonic()
+            self._wait_total += started - queued_at
+            OCR_JOB_WAIT_SECONDS.observe(started - queued_at)
+            self._running += 1
+            try:
+                result = await asyncio.wait_for(loop.run_in_executor(self._pool, fn, *args), self.timeout)
+                self.completed += 1
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                logger.warning(f"OCR job timed out after {self.timeout}s")
+                if not future.done():
+                    future.set_result(None)
+            except BrokenProcessPool:
+                # A worker process died (e.g. Tesseract crashed); replace the pool
+                self.failed += 1
+                logger.error("OCR worker process died, restarting the process pool")
+                if not future.done():
+                    future.set_result(None)
+                broken, self._pool = self._pool, self._new_pool()
+                broken.shutdown(wait=False, cancel_futures=True)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"OCR job failed: {e}", exc_info=True)
+                if not future.done():
+                    future.set_result(None)
+            finally:
+                elapsed = time.monotonic() - started
+                OCR_JOB_SECONDS.observe(elapsed)
+                self._run_total += elapsed
+                self._run_max = max(self._run_max, elapsed)
+                self._running -= 1
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        """Queue depth, throughput and latency counters for monitoring."""
+        finished = self.completed + self.failed + self.timed_out
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "running": self._running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(1000 * self._wait_total / finished, 1) if finished else 0.0,
+            "avg_run_ms": round(1000 * self._run_total / finished, 1) if finished else 0.0,
+            "max_run_ms": round(1000 * self._run_max, 1),
+        }
+
+
+ocr_engine = OCREngine(OCR_WORKERS, OCR_QUEUE_SIZE, OCR_JOB_TIMEOUT)
+
+metrics.gauge("ocr_queue_depth", "OCR jobs waiting for a worker process.", lambda: ocr_engine.stats()["queue_depth"])
+metrics.counter_from(
+    "ocr_jobs_total", "OCR jobs by outcome.",
+    lambda: {(outcome,): ocr_engine.stats()[outcome] for outcome in ("completed", "failed", "timed_out", "rejected")},
+    ["outcome"],
+)
@@ -0,0 +1,267 @@
+import bisect
+import re
+import threading
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.config import RECONCILE_INDEX_ENABLED, RECONCILE_AMOUNT_TOLERANCE, RECONCILE_MIN_NAME_SCORE, get_logger
+from app.database import Booking, get_unpaid_bookings_by_amount, on_booking_paid, to_satang
+
+logger = get_logger(__name__)
+
+# --- Name normalization --- #
+
+# Honorifics that slips and bookings use inconsistently, as they read once
+# punctuation is gone ('น.ส.' -> 'น ส'). Thai titles are often written without
+# a space; abbreviations and English titles need a space after them.
+_TITLES = re.compile(r"^(?:นางสาว|นาง|นาย|คุณ|(?:น\s?ส|ด\s?ช|ด\s?ญ|mrs|mr|ms|miss|dr)\s)\s*", re.IGNORECASE)
+# Everything except letters, digits and Thai characters (vowel and tone marks are not \w)
+_PUNCTUATION = re.compile(r"[^\w\s\u0E00-\u0E7F]|_")
+
+
+def normalize_name(name: str) -> str:
+    """Casefolds a name and strips titles and punctuation: 'นาย สมชาย ใจดี' -> 'สมชาย ใจดี'."""
+    name = " ".join(_PUNCTUATION.sub(" ", name or "").casefold().split())
+    while True:
+        stripped = _TITLES.sub("", name).strip()
+        if stripped == name:
+            return name
+        name = stripped
+
+
+class NameScorer:
+    """
+    Scores normalized booking names against one slip name, from 0 to 1.
+
+    Slips truncate long names ('somchai j') and OCR drops or adds spaces, so the
+    score is the best of: character similarity ignoring spaces, similarity with
+    the words sorted, and a fixed 0.9 when the slip shows the booking's first
+    name followed by prefixes of the remaining words. The slip side of both
+    matchers is prepared once, and candidates whose upper bound cannot reach
+    `floor` are rejected before the full comparison.
+    """
+
+    def __init__(self, slip_name: str):
+        self.slip_name = slip_name
+        self._words = slip_name.split()
+        self._compact = SequenceMatcher(None, b="".join(self._words))
+        self._sorted = SequenceMatcher(None, b=" ".join(sorted(self._words)))
+
+    def score(self, booking_name: str, floor: float = 0.0) -> float:
+        if not self.slip_name or not booking_name:
+            return 0.0
+        if booking_name == self.slip_name:
+            return 1.0
+        words = booking_name.split()
+        best = 0.0
+        if (len(self._words) <= len(words) and self._words[0] == words[0]
+                and all(b.startswith(s) for s, b in zip(self._words[1:], words[1:]))):
+            best = 0.9
+        for matcher, seq in ((self._compact, "".join(words)), (self._sorted, " ".join(sorted(words)))):
+            matcher.set_seq1(seq)
+            bound = max(best, floor)
+            if matcher.real_quick_ratio() >= bound and matcher.quick_ratio() >= bound:
+                best = max(best, matcher.ratio())
+        return best
+
+
+def name_similarity(slip_name: str, booking_name: str) -> float:
+    """Scores two normalized names from 0 to 1; see NameScorer."""
+    return NameScorer(slip_name).score(booking_name)
+
+
+def rank_candidates(slip_name: str, satang: int, candidates: List[Tuple[int, int, str]]) -> List[Tuple[int, float]]:
+    """
+    Orders (booking_id, satang, normalized name) candidates for a slip, best first.
+    Names below RECONCILE_MIN_NAME_SCORE are dropped; ties go to the closest amount,
+    then the oldest booking.
+    """
+    scorer = NameScorer(slip_name)
+    scored = []
+    for booking_id, booking_satang, booking_name in candidates:
+        score = scorer.score(booking_name, RECONCILE_MIN_NAME_SCORE)
+        if score >= RECONCILE_MIN_NAME_SCORE:
+            scored.append((-score, abs(booking_satang - satang), booking_id))
+    scored.sort()
+    return [(booking_id, -neg_score) for neg_score, _, booking_id in scored]
+
+
+# --- Unpaid booking index --- #
+
+class UnpaidBookingIndex:
+    """
+    In-memory index of unpaid bookings keyed by amount in satang.
+
+    Candidate lookup is a dict hit for exact amounts, or a bisect over the sorted
+    distinct amounts when a tolerance is set, so it does not grow with the booking
+    history. Bookings written through the ORM in this process are applied on
+    commit; anything else (other processes, raw SQL) is caught by the SQL
+    fallback in `match_booking`, which also adds what it finds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_amount: Dict[int, Dict[int, str]] = {}  # satang -> {booking_id: normalized name}
+        self._amounts: List[int] = []  # sorted keys of _by_amount
+        self._amount_of: Dict[int, int] = {}  # booking_id -> satang
+        self._loaded = False
+
+    def invalidate(self):
+        """Reloads the whole index on next refresh."""
+        with self._lock:
+            self._loaded = False
+
+    def refresh(self, session: Session):
+        """Loads every unpaid booking on first use (or after invalidate)."""
+        if self._loaded:
+            return
+        rows = session.query(Booking.id, Booking.customer_name, Booking.total_price).filter(
+            Booking.is_paid == False, Booking.is_cancelled.isnot(True)
+        ).all()
+        with self._lock:
+            if self._loaded:
+                return
+            self._by_amount, self._amounts, self._amount_of = {}, [], {}
+            for row in rows:
+                self._add(row.id, to_satang(row.total_price), normalize_name(row.customer_name))
+            self._loaded = True
+        logger.info(f"Unpaid booking index loaded with {len(rows)} bookings")
+
+    def apply(self, changes: Dict[int, Optional[Tuple[int, str]]]):
+        """Applies committed changes: booking_id -> (satang, normalized name), or None once paid, cancelled or deleted."""
+        with self._lock:
+            if not self._loaded:
+                return  # the next refresh reads the committed state anyway
+            for booking_id, entry in changes.items():
+                self._remove(booking_id)
+                if entry is not None:
+                    self._add(booking_id, *entry)
+
+    def add(self, booking_id: int, satang: int, name: str):
+        with self._lock:
+            if self._loaded:
+                self._remove(booking_id)
+                self._add(booking_id, satang, name)
+
+    def discard(self, booking_id: int):
+        with self._lock:
+            self._remove(booking_id)
+
+    def _add(self, booking_id: int, satang: int, name: str):
+        bucket = self._by_amount.get(satang)
+        if bucket is None:
+            bucket = self._by_amount[satang] = {}
+            bisect.insort(self._amounts, satang)
+        bucket[booking_id] = name
+        self._amount_of[booking_id] = satang
+
+    def _remove(self, booking_id: int):
+        satang = self._amount_of.pop(booking_id, None)
+        if satang is None:
+            return
+        bucket = self._by_amount[satang]
+        bucket.pop(booking_id, None)
+        if not bucket:
+            del self._by_amount[satang]
+            del self._amounts[bisect.bisect_left(self._amounts, satang)]
+
+    def candidates(self, satang: int, tolerance: int = 0) -> List[Tuple[int, int, str]]:
+        """Returns (booking_id, satang, normalized name) for unpaid bookings within `tolerance` satang."""
+        with self._lock:
+            if tolerance <= 0:
+                return [(i, satang, name) for i, name in self._by_amount.get(satang, {}).items()]
+            start = bisect.bisect_left(self._amounts, satang - tolerance)
+            end = bisect.bisect_right(self._amounts, satang + tolerance)
+            return [
+                (i, amount, name)
+                for amount in self._amounts[start:end]
+                for i, name in self._by_amount[amount].items()
+            ]
+
+    def __len__(self):
+        return len(self._amount_of)
+
+
+booking_index = UnpaidBookingIndex()
+# verify_payment claims bookings with a bulk UPDATE, which the mapper events below do not see
+on_booking_paid(booking_index.discard)
+
+
+@event.listens_for(Booking, "after_insert")
+@event.listens_for(Booking, "after_update")
+def _track_booking_change(mapper, connection, target):
+    """Remembers changed bookings on the session until the transaction commits."""
+    session = Session.object_session(target)
+    if session is None or target.id is None:
+        return
+    entry = None if target.is_paid or target.is_cancelled else (to_satang(target.total_price), normalize_name(target.customer_name))
+    session.info.setdefault("booking_changes", {})[target.id] = entry
+
+
+@event.listens_for(Booking, "after_delete")
+def _track_booking_delete(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None and target.id is not None:
+        session.info.setdefault("booking_changes", {})[target.id] = None
+
+
+@event.listens_for(Session, "after_commit")
+def _flush_booking_changes(session):
+    changes = session.info.pop("booking_changes", None)
+    if changes:
+        booking_index.apply(changes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_booking_changes(session):
+    session.info.pop("booking_changes", None)
+
+
+# --- Matching --- #
+
+def _sql_candidates(session: Session, satang: int, tolerance: int) -> List[Tuple[int, int, str]]:
+    rows = get_unpaid_bookings_by_amount(session, satang - tolerance, satang + tolerance)
+    return [(b.id, to_satang(b.total_price), normalize_name(b.customer_name)) for b in rows]
+
+
+def _first_unpaid(session: Session, ranked: List[Tuple[int, float]]) -> Optional[Booking]:
+    """Returns the best ranked booking that is still unpaid in the database."""
+    for booking_id, score in ranked:
+        booking = session.get(Booking, booking_id)
+        if booking is not None and not booking.is_paid and not booking.is_cancelled:
+            logger.debug(f"Matched booking {booking_id} with name score {score:.2f}")
+            return booking
+        booking_index.discard(booking_id)  # paid, cancelled or deleted outside this process
+    return None
+
+
+def match_booking(session: Session, name: str, amount: float) -> Optional[Booking]:
+    """
+    Finds the unpaid booking a slip most likely pays.
+
+    Candidates come from the unpaid booking index by amount (within
+    RECONCILE_AMOUNT_TOLERANCE), then are ranked by name similarity. If the index
+    is disabled or yields no acceptable match, the (is_paid, satang) indexed SQL
+    query is used instead, so bookings the index has not seen are still found.
+    """
+    if not name or amount is None:
+        return None
+    satang = to_satang(amount)
+    tolerance = to_satang(RECONCILE_AMOUNT_TOLERANCE)
+    slip_name = normalize_name(name)
+
+    if RECONCILE_INDEX_ENABLED:
+        booking_index.refresh(session)
+        ranked = rank_candidates(slip_name, satang, booking_index.candidates(satang, tolerance))
+        booking = _first_unpaid(session, ranked)
+        if booking is not None:
+            return booking
+
+    candidates = _sql_candidates(session, satang, tolerance)
+    if RECONCILE_INDEX_ENABLED:
+        for booking_id, booking_satang, booking_name in candidates:
+            booking_index.add(booking_id, booking_satang, booking_name)
+    return _first_unpaid(session, rank_candidates(slip_name, satang, candidates))
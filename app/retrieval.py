@@ -0,0 +1,356 @@
+import datetime
+import heapq
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event, func, or_
+from sqlalchemy.orm import Session
+
+from app.config import RETRIEVAL_HISTORY_DAYS, KNOWLEDGE_DIR, get_logger
+from app.database import Booking, Expense, get_report_data, on_booking_paid
+
+logger = get_logger(__name__)
+
+DocKey = Tuple[str, object]  # ("booking", id), ("expense", id) or ("knowledge", "file.md#3")
+
+# --- Tokenization --- #
+
+# Latin words and numbers, or runs of Thai script. Thai is written without spaces
+# between words, so Thai runs are indexed as character bigrams.
+_TOKEN = re.compile(r"[a-z0-9]+(?:[.:][0-9]+)?|[\u0E00-\u0E7F]+")
+_THAI = re.compile(r"[\u0E00-\u0E7F]")
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in _TOKEN.findall(text.casefold()):
+        if _THAI.match(token) and len(token) > 2:
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            tokens.append(token)
+    return tokens
+
+
+# --- Documents --- #
+
+def booking_text(b: Booking) -> str:
+    status = "paid" if b.is_paid else "unpaid, not paid yet"
+    return (f"Booking {b.id}: {b.customer_name}, room {b.room_number}, "
+            f"check-in {b.check_in_date:%Y-%m-%d}, check-out {b.check_out_date:%Y-%m-%d}, "
+            f"{b.total_price:.2f} THB, {status}")
+
+
+def expense_text(e: Expense) -> str:
+    date = f"{e.date:%Y-%m-%d}" if e.date else "undated"
+    return f"Expense {e.id}: {e.description}, {e.amount:.2f} THB, category {e.category}, {date}"
+
+
+def load_knowledge(directory: str) -> Dict[DocKey, str]:
+    """Splits each .md/.txt file into paragraphs, each prefixed with its section heading."""
+    docs = {}
+    if not os.path.isdir(directory):
+        return docs
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith((".md", ".txt")):
+            continue
+        with open(os.path.join(directory, name), encoding="utf-8") as f:
+            paragraphs = [p.strip() for p in re.split(r"\n\s*\n", f.read()) if p.strip()]
+        heading = ""
+        for i, paragraph in enumerate(paragraphs):
+            if paragraph.startswith("#"):
+                lines = paragraph.splitlines()
+                heading = lines[0].lstrip("# ").strip()
+                paragraph = "\n".join(lines[1:]).strip()
+                if not paragraph:
+                    continue
+            docs[("knowledge", f"{name}#{i}")] = f"{heading}: {paragraph}" if heading else paragraph
+    return docs
+
+
+def _knowledge_mtime(directory: str) -> float:
+    if not os.path.isdir(directory):
+        return 0.0
+    return max([os.path.getmtime(directory)] + [
+        os.path.getmtime(os.path.join(directory, n)) for n in os.listdir(directory) if n.endswith((".md", ".txt"))
+    ])
+
+
+# --- BM25 Index --- #
+
+class RetrievalIndex:
+    """
+    In-process BM25 index over recent bookings and expenses, all unpaid bookings,
+    and the house rules and FAQ in KNOWLEDGE_DIR.
+
+    Documents are added and removed individually: bookings and expenses changed
+    through the ORM are marked dirty on commit and re-read on the next refresh,
+    and knowledge files are reloaded when they change. The whole index is rebuilt
+    once a day, which also drops records that aged out of the history window.
+    """
+
+    K1 = 1.5
+    B = 0.75
+    FULL_RELOAD_SECONDS = 24 * 3600
+
+    def __init__(self, knowledge_dir: str, history_days: int):
+        self.knowledge_dir = knowledge_dir
+        self.history_days = history_days
+        self._lock = threading.Lock()
+        self._docs: Dict[DocKey, str] = {}
+        self._lengths: Dict[DocKey, int] = {}
+        self._postings: Dict[str, Dict[DocKey, int]] = {}
+        self._total_length = 0
+        self._dirty: Set[DocKey] = set()
+        self._loaded_at = 0.0
+        self._knowledge_mtime = 0.0
+
+    def invalidate(self, keys: Optional[Iterable[DocKey]] = None):
+        """Marks records as changed. Without keys, the whole index is rebuilt on next refresh."""
+        with self._lock:
+            if keys is None:
+                self._loaded_at = 0.0
+            else:
+                self._dirty.update(keys)
+
+    def refresh(self, session: Session):
+        """
+        Builds the index on first use (and daily), then re-reads only dirty records.
+        Rows are read outside the lock: under an AsyncSession.run_sync the queries
+        yield to the event loop, and a handler waiting on the lock would block it.
+        """
+        with self._lock:
+            full = not self._loaded_at or time.monotonic() - self._loaded_at > self.FULL_RELOAD_SECONDS
+            dirty, self._dirty = (set(), set()) if full else (self._dirty, set())
+        if full:
+            docs = {}
+            for model, kind in ((Booking, "booking"), (Expense, "expense")):
+                for row in self._recent(session, model).yield_per(1000):
+                    docs[(kind, row.id)] = _TEXT[kind](row)
+            with self._lock:
+                self._clear()
+                for key, text in docs.items():
+                    self._add(key, text)
+                self._load_knowledge()
+                self._loaded_at = time.monotonic()
+            logger.info(f"Retrieval index built with {len(docs)} records")
+            return
+        changed = {}
+        for kind, model in (("booking", Booking), ("expense", Expense)):
+            ids = {key[1] for key in dirty if key[0] == kind}
+            if ids:
+                rows = {row.id: row for row in self._recent(session, model).filter(model.id.in_(ids))}
+                changed.update({(kind, doc_id): _TEXT[kind](rows[doc_id]) if doc_id in rows else None for doc_id in ids})
+        with self._lock:
+            for key, text in changed.items():
+                self._remove(key)
+                if text is not None:
+                    self._add(key, text)
+            if _knowledge_mtime(self.knowledge_dir) != self._knowledge_mtime:
+                for key in [k for k in self._docs if k[0] == "knowledge"]:
+                    self._remove(key)
+                self._load_knowledge()
+
+    def _recent(self, session: Session, model):
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=self.history_days)
+        if model is Booking:
+            return session.query(Booking).filter(or_(Booking.check_out_date >= cutoff, Booking.is_paid == False))
+        return session.query(Expense).filter(or_(Expense.date >= cutoff, Expense.date.is_(None)))
+
+    def _load_knowledge(self):
+        self._knowledge_mtime = _knowledge_mtime(self.knowledge_dir)
+        for key, text in load_knowledge(self.knowledge_dir).items():
+            self._add(key, text)
+
+    def _clear(self):
+        self._docs, self._lengths, self._postings, self._total_length = {}, {}, {}, 0
+
+    def _add(self, key: DocKey, text: str):
+        terms = Counter(tokenize(text))
+        self._docs[key] = text
+        self._lengths[key] = sum(terms.values())
+        self._total_length += self._lengths[key]
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[key] = tf
+
+    def _remove(self, key: DocKey):
+        text = self._docs.pop(key, None)
+        if text is None:
+            return
+        self._total_length -= self._lengths.pop(key)
+        for term in set(tokenize(text)):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(key, None)
+                if not postings:
+                    del self._postings[term]
+
+    def search(self, query: str, k: int) -> List[Tuple[float, DocKey, str]]:
+        """Returns the top `k` (score, key, text) matches for the query, best first."""
+        with self._lock:
+            n = len(self._docs)
+            if not n:
+                return []
+            avg_length = self._total_length / n
+            scores: Dict[DocKey, float] = {}
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for key, tf in postings.items():
+                    norm = tf + self.K1 * (1 - self.B + self.B * self._lengths[key] / avg_length)
+                    scores[key] = scores.get(key, 0.0) + idf * tf * (self.K1 + 1) / norm
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [(score, key, self._docs[key]) for key, score in best]
+
+    def __len__(self):
+        return len(self._docs)
+
+
+_TEXT = {"booking": booking_text, "expense": expense_text}
+
+retrieval_index = RetrievalIndex(KNOWLEDGE_DIR, RETRIEVAL_HISTORY_DAYS)
+# verify_payment claims bookings with a bulk UPDATE, which the mapper events below do not see
+on_booking_paid(lambda booking_id: retrieval_index.invalidate({("booking", booking_id)}))
+
+
+@event.listens_for(Booking, "after_insert")
+@event.listens_for(Booking, "after_update")
+@event.listens_for(Booking, "after_delete")
+@event.listens_for(Expense, "after_insert")
+@event.listens_for(Expense, "after_update")
+@event.listens_for(Expense, "after_delete")
+def _track_record_change(mapper, connection, target):
+    """Remembers changed records on the session until the transaction commits."""
+    session = Session.object_session(target)
+    if session is not None and target.id is not None:
+        kind = "booking" if isinstance(target, Booking) else "expense"
+        session.info.setdefault("retrieval_changes", set()).add((kind, target.id))
+
+
+@event.listens_for(Session, "after_commit")
+def _flush_record_changes(session):
+    changed = session.info.pop("retrieval_changes", None)
+    if changed:
+        retrieval_index.invalidate(changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_record_changes(session):
+    session.info.pop("retrieval_changes", None)
+
+
+def search(session: Session, query: str, k: int) -> List[str]:
+    """Returns the texts of the `k` records most relevant to the query."""
+    retrieval_index.refresh(session)
+    return [text for _, _, text in retrieval_index.search(query, k)]
+
+
+def build_prompt(question: str, records: List[str]) -> str:
+    """Wraps the question with the retrieved records, so the model answers from hotel data."""
+    if not records:
+        return question
+    context = "\n".join(f"- {record}" for record in records)
+    return (
+        "You are the assistant of a small hotel. Answer the owner's question briefly. "
+        "Use these records from the hotel's own data where they are relevant; "
+        "say so if they do not contain the answer.\n"
+        f"Today is {datetime.date.today():%Y-%m-%d}.\n"
+        f"Records:\n{context}\n\n"
+        f"Question: {question}"
+    )
+
+
+# --- Local Answers --- #
+# Lookups the database answers exactly; these never reach the model.
+
+_ROOM = r"(?:room|ห้อง)\s*(?:no\.?\s*|number\s*|#)?(?P<room>[a-z]?\d+[a-z]?)(?![a-z0-9])"
+_BOOKING = r"(?:booking|การจอง)\s*(?:id\s*)?#?(?P<booking>\d+)(?!\d)"
+# Only payment-status questions ("is room 5 paid?", "did booking 12 pay?", "ห้อง 5 จ่ายหรือยัง"),
+# not requests that merely mention paying ("can room 5 pay by card?", "draft a payment reminder").
+_PAID = (
+    r"(?:\b(?:is|was|has|have)\b.*\bpaid\b|\bdid\b.*\bpay\b"
+    r"|(?:จ่าย|ชำระ)(?:เงิน)?(?:แล้ว)?\s*(?:หรือยัง|รึยัง|ยัง|หรือไม่|หรือเปล่า|ไหม|มั้ย))"
+)
+_LOCAL_PATTERNS = [
+    ("room_paid", re.compile(rf"(?=.*{_PAID}).*?{_ROOM}", re.IGNORECASE)),
+    ("booking_paid", re.compile(rf"(?=.*{_PAID}).*?{_BOOKING}", re.IGNORECASE)),
+    ("occupant", re.compile(rf"(?=.*(?:\bwho\b|ใคร)).*?{_ROOM}", re.IGNORECASE)),
+    ("unpaid", re.compile(r"\bunpaid\b|\boutstanding\b|ค้างจ่าย|ยังไม่(?:จ่าย|ชำระ)", re.IGNORECASE)),
+    ("report", re.compile(
+        r"\b(?:income|revenue|earn\w*|expenses?|spen[dt]|profit)\b.*\b(?P<period>today|this week|this month)\b"
+        r"|(?:รายได้|รายจ่าย|กำไร).*(?P<th_period>วันนี้|สัปดาห์นี้|เดือนนี้)",
+        re.IGNORECASE,
+    )),
+]
+_THAI_PERIODS = {"วันนี้": "today", "สัปดาห์นี้": "this week", "เดือนนี้": "this month"}
+
+
+def _room_booking(session: Session, room: str) -> Optional[Booking]:
+    """The booking covering now for a room, else its next upcoming one, else its latest."""
+    now = datetime.datetime.now()
+    bookings = session.query(Booking).filter(
+        Booking.room_number == room, Booking.is_cancelled.isnot(True)
+    ).order_by(Booking.check_in_date.desc()).limit(20).all()
+    current = [b for b in bookings if b.check_in_date <= now < b.check_out_date]
+    upcoming = [b for b in bookings if b.check_in_date > now]
+    if current:
+        return current[0]
+    if upcoming:
+        return upcoming[-1]
+    return bookings[0] if bookings else None
+
+
+def _paid_status(b: Booking) -> str:
+    status = "is paid" if b.is_paid else "is NOT paid yet"
+    return (f"Booking {b.id} ({b.customer_name}, room {b.room_number}, "
+            f"{b.check_in_date:%Y-%m-%d} to {b.check_out_date:%Y-%m-%d}, {b.total_price:.2f} THB) {status}.")
+
+
+def answer_locally(session: Session, question: str) -> Optional[str]:
+    """Answers exact lookups (payment status, occupant, unpaid bookings, income) from the database, or returns None."""
+    for kind, pattern in _LOCAL_PATTERNS:
+        match = pattern.search(question)
+        if not match:
+            continue
+        if kind in ("room_paid", "occupant"):
+            room = match.group("room")
+            booking = _room_booking(session, room)
+            if booking is None:
+                return f"There are no bookings for room {room}."
+            if kind == "room_paid":
+                return _paid_status(booking)
+            now = datetime.datetime.now()
+            if booking.check_in_date <= now < booking.check_out_date:
+                return f"Room {room} is occupied by {booking.customer_name} until {booking.check_out_date:%Y-%m-%d}."
+            return f"Room {room} is vacant. Its next or last booking: {_paid_status(booking)}"
+        if kind == "booking_paid":
+            booking = session.get(Booking, int(match.group("booking")))
+            return _paid_status(booking) if booking else f"There is no booking {match.group('booking')}."
+        if kind == "unpaid":
+            unpaid_filter = (Booking.is_paid == False, Booking.is_cancelled.isnot(True))
+            count, total = session.query(func.count(Booking.id), func.sum(Booking.total_price)).filter(*unpaid_filter).one()
+            if not count:
+                return "All bookings are paid."
+            unpaid = session.query(Booking).filter(*unpaid_filter).order_by(Booking.check_in_date).limit(10)
+            lines = [f"{count} unpaid booking(s), {total:.2f} THB in total:"]
+            lines += [f"- {b.id}: {b.customer_name}, room {b.room_number}, "
+                      f"check-in {b.check_in_date:%Y-%m-%d}, {b.total_price:.2f} THB" for b in unpaid]
+            if count > 10:
+                lines.append(f"...and {count - 10} more.")
+            return "\n".join(lines)
+        if kind == "report":
+            period = match.group("period") or _THAI_PERIODS[match.group("th_period")]
+            today = datetime.date.today()
+            start = {"today": today,
+                     "this week": today - datetime.timedelta(days=today.weekday()),
+                     "this month": today.replace(day=1)}[period.lower()]
+            report = get_report_data(session, start, today)
+            return (f"{period.capitalize()}: income {report['income']:.2f} THB, "
+                    f"expenses {report['expenses']:.2f} THB, net {report['net']:.2f} THB.")
+    return None
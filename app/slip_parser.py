@@ -0,0 +1,140 @@
+import re
+from typing import NamedTuple
+
+# --- Patterns --- #
+# Compiled once at import. OCR output of Thai bank slips puts each field on its
+# own line, usually as "<label> <value>", so every pattern is anchored on a label.
+
+_AMOUNT = r"(?P<amount>\d{1,3}(?:,\d{3})+\.\d{2}|\d+\.\d{2})"
+_NAME = r"(?P<name>[^\n]+)"
+_SEP = r"\s*[:：]?\s*"
+
+# Account masks, bank abbreviations and similar noise that trail the sender name
+_NAME_NOISE = re.compile(
+    r"(?:^|\s+)(?:[xX*\d]{3,}[-xX*\d]*|ธ\.\s*\S+|ธนาคาร\S*|(?:K|SCB|BBL|KTB)(?:\s*(?:PLUS|EASY|Bank))?\b).*$",
+    re.IGNORECASE,
+)
+
+class SlipTemplate(NamedTuple):
+    bank: str
+    marker: str # Text that identifies the bank anywhere on the slip
+    name: re.Pattern
+    amount: re.Pattern
+
+def _template(bank: str, marker: str, name_labels: str, amount_labels: str) -> SlipTemplate:
+    return SlipTemplate(
+        bank,
+        marker,
+        re.compile(rf"(?:{name_labels}){_SEP}{_NAME}", re.IGNORECASE),
+        re.compile(rf"(?:{amount_labels}){_SEP}{_AMOUNT}", re.IGNORECASE),
+    )
+
+TEMPLATES = (
+    _template("kbank", r"K\s?PLUS|KBank|กสิกร", r"จาก|From", r"จำนวน(?:เงิน)?|Amount"),
+    _template("scb", r"SCB|ไทยพาณิชย์", r"จาก|From", r"จำนวนเงิน|Amount"),
+    _template("bbl", r"Bangkok\s?Bank|Bualuang|กรุงเทพ", r"ชื่อผู้โอน|From\s*Account\s*Name|From", r"จำนวนเงิน|Amount"),
+    _template("ktb", r"Krungthai|กรุงไทย", r"ผู้โอน|จาก|From", r"จำนวนเงิน|Amount"),
+    _template("promptpay", r"Prompt\s?Pay|พร้อมเพย์", r"ผู้โอน|จาก|From", r"จำนวนเงิน|Amount"),
+)
+TEMPLATES_BY_BANK = {t.bank: t for t in TEMPLATES}
+
+# One alternation over every bank marker: a single scan of the text identifies the bank
+_BANK_MARKERS = re.compile("|".join(f"(?P<{t.bank}>{t.marker})" for t in TEMPLATES), re.IGNORECASE)
+
+# Layout-independent fallbacks
+_GENERIC_NAME = re.compile(rf"(?:ชื่อ|Name|To){_SEP}{_NAME}", re.IGNORECASE)
+_GENERIC_AMOUNT = re.compile(rf"(?:จำนวนเงิน|Amount|Total){_SEP}{_AMOUNT}", re.IGNORECASE)
+_ANY_AMOUNT = re.compile(_AMOUNT)
+
+# Transaction reference and time, which tell apart two transfers of the same amount by the same sender
+_REFERENCE = re.compile(
+    rf"(?:รหัสอ้างอิง|เลขที่(?:รายการ|อ้างอิง)|หมายเลขอ้างอิง|Ref(?:erence)?\.?\s*(?:No\.?|ID|Code)?|Transaction\s*(?:ID|No\.?)){_SEP}(?P<reference>[A-Za-z0-9]{{6,}})",
+    re.IGNORECASE,
+)
+_TIMESTAMP = re.compile(
+    r"(?<![\d,.])(?P<date>\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}|\d{1,2}\s*[^\W\d_][^\s\d:]{0,11}\s*\d{2,4})"
+    r"\s*,?\s*-?\s*(?P<time>\d{1,2}[:.]\d{2}(?:[:.]\d{2})?)(?!\d)"
+)
+
+class SlipFields(NamedTuple):
+    name: str | None
+    amount: float | None
+    bank: str | None
+    confidence: float # 0..1, how much of the result came from bank-specific, labelled matches
+
+# --- Extraction --- #
+
+def detect_bank(text: str) -> str | None:
+    match = _BANK_MARKERS.search(text)
+    return match.lastgroup if match else None
+
+def _clean_name(raw: str) -> str | None:
+    name = _NAME_NOISE.sub("", raw).strip(" :：-")
+    return name or None
+
+def _to_amount(match) -> float:
+    return float(match.group("amount").replace(",", ""))
+
+def parse_slip_text(text: str, bank: str | None = None) -> SlipFields:
+    """
+    Extracts the sender name and amount from slip OCR text.
+
+    The bank is detected in one pass over the text (unless given), then that
+    bank's template is tried before the generic patterns. The confidence score
+    rewards a detected bank and fields found by bank-specific, labelled patterns.
+    """
+    bank = bank or detect_bank(text)
+    template = TEMPLATES_BY_BANK.get(bank)
+    confidence = 0.2 if template else 0.0
+
+    name = None
+    match = template.name.search(text) if template else None
+    if match:
+        name = _clean_name(match.group("name"))
+        confidence += 0.35 if name else 0.0
+    if name is None:
+        match = _GENERIC_NAME.search(text)
+        if match:
+            name = _clean_name(match.group("name"))
+            confidence += 0.2 if name else 0.0
+
+    amount = None
+    match = template.amount.search(text) if template else None
+    if match:
+        amount = _to_amount(match)
+        confidence += 0.45
+    else:
+        match = _GENERIC_AMOUNT.search(text)
+        if match:
+            amount = _to_amount(match)
+            confidence += 0.3
+        else:
+            match = _ANY_AMOUNT.search(text)
+            if match:
+                amount = _to_amount(match)
+                confidence += 0.05
+
+    return SlipFields(name, amount, bank, round(min(confidence, 1.0), 2))
+
+def extract_transaction_key(text: str) -> str | None:
+    """
+    Identifies the transfer a slip shows: its reference number, or failing that
+    its date and time, normalized ('ref:015123ABCD', 'at:15ต.ค.67 14:32').
+    None when the OCR text has neither.
+    """
+    match = _REFERENCE.search(text)
+    if match:
+        return f"ref:{match.group('reference').upper()}"
+    match = _TIMESTAMP.search(text)
+    if match:
+        date = "".join(match.group("date").split()).casefold()
+        return f"at:{date} {match.group('time').replace('.', ':')}"
+    return None
+
+def extract_name(text: str) -> str | None:
+    """Extracts a name from the OCR text."""
+    return parse_slip_text(text).name
+
+def extract_amount(text: str) -> float | None:
+    """Extracts the transfer amount from the OCR text."""
+    return parse_slip_text(text).amount
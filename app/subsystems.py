@@ -0,0 +1,258 @@
+"""
+The parts of the app that are slow to import or may be missing a dependency:
+the database, the Telegram bot, MQTT, geofences (Shapely), slip OCR
+(Tesseract, Pillow) and AI answers (Gemini).
+
+Nothing here is imported when the web server starts. The lifespan handler
+starts the critical subsystems (database, bot) in the background, then the
+optional ones; a handler that needs one before then starts or waits for it
+with `await subsystem.get()`. A subsystem that fails, say because Shapely is
+not installed, is reported on /ready and its features answer that they are
+unavailable, while the rest of the app keeps working. Failed critical
+subsystems, and those that failed because one of them had, are retried with
+backoff until they start.
+"""
+import asyncio
+import importlib
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Sequence
+
+from app.config import GEMINI_API_KEY, GEOFENCE_SYNC_SECONDS, get_logger
+
+logger = get_logger(__name__)
+
+# One import at a time: two threads importing modules that import each other can deadlock
+_import_lock = threading.Lock()
+
+
+def _import_locked(name: str):
+    with _import_lock:
+        return importlib.import_module(name)
+
+
+async def load_module(name: str):
+    """Imports a module on a worker thread, so a slow import does not stall the event loop."""
+    return await asyncio.to_thread(_import_locked, name)
+
+
+class SubsystemUnavailable(Exception):
+    """Raised when a subsystem failed to start or is disabled."""
+
+
+class SubsystemDisabled(SubsystemUnavailable):
+    """Raised by a subsystem's start function when it is not configured, e.g. no API key."""
+
+
+class Subsystem:
+    """
+    A part of the app started once, on first use or by `Registry.start_all`.
+    `start` returns the subsystem's handle (usually its module), which `get`
+    returns to callers; `stop` receives it at shutdown.
+    """
+
+    def __init__(self, name: str, start: Callable[[], Awaitable], stop: Optional[Callable] = None,
+                 requires: Sequence["Subsystem"] = (), critical: bool = False):
+        self.name = name
+        self._start = start
+        self._stop = stop
+        self.requires = tuple(requires)
+        self.critical = critical  # the app is not ready without it
+        self.state = "pending"  # pending, starting, ready, disabled, failed or stopped
+        self.error: Optional[str] = None
+        self.seconds: Optional[float] = None
+        self.value = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def retryable(self) -> bool:
+        """Failed critical subsystems are retried, and so are those that failed because a dependency had."""
+        return self.state == "failed" and (self.critical or not all(d.ready for d in self.requires))
+
+    def reset(self):
+        """Lets a failed subsystem be started again."""
+        if self.state == "failed":
+            self.state, self._task = "pending", None
+
+    def start(self) -> asyncio.Task:
+        """Starts the subsystem in the background, once."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"start-{self.name}")
+        return self._task
+
+    async def get(self):
+        """Returns the handle, starting the subsystem or waiting for it as needed. Raises SubsystemUnavailable."""
+        if self.state != "ready":
+            await asyncio.shield(self.start())
+        if self.state != "ready":
+            raise SubsystemUnavailable(f"{self.name} is {self.state}: {self.error}")
+        return self.value
+
+    async def _run(self):
+        started = time.monotonic()
+        try:
+            for dependency in self.requires:
+                await dependency.get()
+            self.state = "starting"
+            self.value = await self._start()
+            self.state = "ready"
+            logger.info(f"Subsystem {self.name} ready in {time.monotonic() - started:.2f}s")
+        except SubsystemDisabled as e:
+            self.state, self.error = "disabled", str(e)
+            logger.info(f"Subsystem {self.name} disabled: {e}")
+        except Exception as e:
+            self.state, self.error = "failed", f"{type(e).__name__}: {e}"
+            logger.error(f"Subsystem {self.name} failed to start: {self.error}", exc_info=not isinstance(e, SubsystemUnavailable))
+        self.seconds = round(time.monotonic() - started, 3)
+
+    async def stop(self):
+        if self.state == "ready" and self._stop is not None:
+            try:
+                await self._stop(self.value)
+            except Exception as e:
+                logger.error(f"Error stopping subsystem {self.name}: {e}", exc_info=True)
+        if self.state == "ready":
+            self.state = "stopped"
+
+
+class Registry:
+    """The subsystems, in start order."""
+
+    RETRY_SECONDS = 2.0  # first retry delay, doubled after every failed round
+    MAX_RETRY_SECONDS = 60.0
+
+    def __init__(self):
+        self.subsystems: Dict[str, Subsystem] = {}
+        self._boot: Optional[asyncio.Task] = None
+
+    def add(self, name: str, start, stop=None, requires: Sequence[Subsystem] = (), critical: bool = False) -> Subsystem:
+        subsystem = Subsystem(name, start, stop, requires, critical)
+        self.subsystems[name] = subsystem
+        return subsystem
+
+    def start_all(self) -> asyncio.Task:
+        """Starts the critical subsystems, then the optional ones, in the background."""
+        async def boot():
+            started = time.monotonic()
+            await asyncio.gather(*(s.start() for s in self.subsystems.values() if s.critical))
+            await asyncio.gather(*(s.start() for s in self.subsystems.values() if not s.critical))
+            logger.info(f"Startup finished in {time.monotonic() - started:.2f}s: "
+                        + ", ".join(f"{s.name} {s.state}" for s in self.subsystems.values()))
+            await self._retry_failed()
+        self._boot = asyncio.create_task(boot(), name="start-subsystems")
+        return self._boot
+
+    async def _retry_failed(self):
+        """Restarts retryable subsystems until none is left; /ready stays false meanwhile."""
+        delay = self.RETRY_SECONDS
+        while True:
+            failed = [s for s in self.subsystems.values() if s.retryable]
+            if not failed:
+                return
+            logger.warning(f"Retrying {', '.join(s.name for s in failed)} in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.MAX_RETRY_SECONDS)
+            for subsystem in failed:
+                subsystem.reset()
+            await asyncio.gather(*(s.start() for s in failed))
+
+    async def stop_all(self):
+        """Stops the started subsystems in reverse order."""
+        if self._boot is not None and not self._boot.done():
+            self._boot.cancel()
+        for subsystem in reversed(list(self.subsystems.values())):
+            await subsystem.stop()
+
+    def ready(self) -> bool:
+        return all(s.ready for s in self.subsystems.values() if s.critical)
+
+    def status(self) -> dict:
+        return {
+            s.name: {"state": s.state, "critical": s.critical, "seconds": s.seconds, "error": s.error}
+            for s in self.subsystems.values()
+        }
+
+
+# --- Subsystems --- #
+
+_background: Dict[str, asyncio.Task] = {}  # tasks started alongside a subsystem, cancelled when it stops
+
+async def _start_database():
+    database = await load_module("app.database")
+    await asyncio.to_thread(database.init_db)
+    return database
+
+async def _stop_database(database):
+    database.db_writer.stop() # Let queued writes finish
+
+async def _start_bot():
+    bot = await load_module("app.bot")
+    return await bot.start()
+
+async def _stop_bot(application):
+    bot = importlib.import_module("app.bot")
+    await bot.stop(application)
+
+async def _start_ai():
+    if not GEMINI_API_KEY:
+        raise SubsystemDisabled("GEMINI_API_KEY is not set")
+    return await load_module("app.llm")
+
+async def _stop_ai(llm):
+    await llm.gateway.close()
+
+async def _start_ocr():
+    ocr = await load_module("app.ocr")
+    ocr.ocr_engine.start()
+    return ocr
+
+async def _stop_ocr(ocr):
+    await ocr.close_http_client()
+    await ocr.ocr_engine.stop()
+
+async def _start_mqtt():
+    mqtt = await load_module("app.mqtt")
+    mqtt.start() # Open the shared MQTT connection and subscribe to device states
+    return mqtt
+
+async def _stop_mqtt(mqtt):
+    mqtt.publisher.stop()
+
+async def _start_geofence():
+    geofence = await load_module("geofence")
+    database = await load_module("app.database")
+
+    def backfill():
+        with database.SessionLocal() as db:
+            geofence.normalize_geofences(db) # Backfill fences stored before normalization or edited since
+
+    await asyncio.to_thread(backfill)
+    # Fences are edited outside the app; keep their stored geometry in step with the polygon text
+    _background["geofence_sync"] = asyncio.create_task(_sync_geofences(geofence, database), name="sync-geofences")
+    return geofence
+
+async def _sync_geofences(geofence, database):
+    while True:
+        await asyncio.sleep(GEOFENCE_SYNC_SECONDS)
+        try:
+            await database.run_write(geofence.normalize_geofences)
+        except Exception as e:
+            logger.warning(f"Could not re-normalize geofences: {e}")
+
+async def _stop_geofence(geofence):
+    task = _background.pop("geofence_sync", None)
+    if task is not None:
+        task.cancel()
+
+
+registry = Registry()
+database = registry.add("database", _start_database, _stop_database, critical=True)
+ai = registry.add("ai", _start_ai, _stop_ai)
+ocr = registry.add("ocr", _start_ocr, _stop_ocr, requires=[database])
+mqtt = registry.add("mqtt", _start_mqtt, _stop_mqtt, requires=[database])
+geofence = registry.add("geofence", _start_geofence, _stop_geofence, requires=[database])
+bot = registry.add("bot", _start_bot, _stop_bot, requires=[database], critical=True)
@@ -1,9 +1,17 @@
+import hashlib
 import json
 import logging
+import threading
+import time
+import shapely
 from shapely.geometry import Point, Polygon
-from typing import List, Optional, Union
+from shapely.strtree import STRtree
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
-from models import Geofence  # ต้องมี models.py ใน project root
+from app.config import GEOFENCE_INDEX_ENABLED, GEOFENCE_SYNC_SECONDS
+from app.database import Geofence
 
 logger = logging.getLogger(__name__)
 
@@ -48,25 +56,268 @@ def parse_polygon(polygon_text: Union[str, List[List[float]]]) -> Optional[Polyg
         return None
 
 
+def polygon_hash(polygon_text: Optional[str]) -> str:
+    return hashlib.sha256((polygon_text or "").encode()).hexdigest()
+
+
+def normalize_geofence(gf: Geofence) -> None:
+    """
+    Fills the normalized geometry columns of a Geofence from its raw polygon JSON.
+    Coordinate order is resolved and invalid shapes are repaired once, here, so
+    readers can use the stored (lon, lat) WKB and bounding box as-is. The hash
+    of the polygon text is kept with them, so rows whose polygon is edited
+    outside the app are found and normalized again (see normalize_geofences).
+    """
+    gf.polygon_hash = polygon_hash(gf.polygon)
+    poly = parse_polygon(gf.polygon)
+    if poly is None or poly.is_empty:
+        logger.warning("Geofence %r has no usable polygon", gf.name)
+        gf.geometry_wkb = None
+        gf.is_valid = False
+        gf.min_lon = gf.min_lat = gf.max_lon = gf.max_lat = None
+        return
+    gf.geometry_wkb = poly.wkb
+    gf.is_valid = True
+    gf.min_lon, gf.min_lat, gf.max_lon, gf.max_lat = poly.bounds
+
+
+@event.listens_for(Geofence, "before_insert")
+def _normalize_on_insert(mapper, connection, target):
+    normalize_geofence(target)
+
+
+@event.listens_for(Geofence, "before_update")
+def _normalize_on_update(mapper, connection, target):
+    if inspect(target).attrs.polygon.history.has_changes():
+        normalize_geofence(target)
+
+
+def _is_current(row) -> bool:
+    """Whether a row's normalized columns were computed from its current polygon text."""
+    return row.polygon_hash is not None and row.polygon_hash == polygon_hash(row.polygon)
+
+
+def normalize_geofences(session: Session) -> int:
+    """
+    Normalizes rows written before normalization existed, and rows whose polygon
+    was edited outside the app (by SQL, another tool) since they were normalized.
+    Returns the row count.
+    """
+    stale = [row.id for row in session.query(Geofence.id, Geofence.polygon, Geofence.polygon_hash) if not _is_current(row)]
+    if not stale:
+        return 0
+    for gf in session.query(Geofence).filter(Geofence.id.in_(stale)):
+        normalize_geofence(gf)
+    session.commit()
+    logger.info("Normalized geometry for %d geofences", len(stale))
+    return len(stale)
+
+
+def _load_geometry(row) -> Optional[Polygon]:
+    """Returns the stored geometry of a row, parsing the raw polygon when it changed since normalization."""
+    if not _is_current(row):
+        return parse_polygon(row.polygon)
+    if row.geometry_wkb is not None:
+        return shapely.from_wkb(row.geometry_wkb)
+    return None
+
+
+class GeofenceIndex:
+    """
+    In-memory spatial index over all geofences.
+
+    Stored geometries are decoded once and kept prepared inside an STRtree,
+    so a point lookup only tests the fences whose bounding box contains the point.
+    Fences changed through the ORM are marked dirty on commit and reloaded on the
+    next refresh; untouched fences are never decoded again. Changes from other
+    workers and tools are found by polling each fence's polygon_hash at most every
+    GEOFENCE_SYNC_SECONDS. A polygon edited by SQL gets a new hash once the
+    geofence sweep re-normalizes it, so it is seen within two intervals.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._geoms: Dict[int, Polygon] = {}
+        self._versions: Dict[int, Optional[str]] = {}  # fence id -> polygon_hash it was loaded with
+        self._dirty: Set[int] = set()
+        self._loaded = False
+        self._polled_at = 0.0
+        # (tree, fence ids in tree order) swapped atomically on rebuild
+        self._snapshot: Tuple[Optional[STRtree], List[int]] = (None, [])
+
+    def invalidate(self, fence_ids: Optional[Iterable[int]] = None):
+        """Marks fences as changed. Without ids, the whole index is reloaded on next refresh."""
+        with self._lock:
+            if fence_ids is None:
+                self._loaded = False
+            else:
+                self._dirty.update(fence_ids)
+
+    def refresh(self, session: Session):
+        """
+        Loads the index on first use and reloads only the fences marked dirty.
+        Rows are read outside the lock: under an AsyncSession.run_sync the query
+        yields to the event loop, and a handler waiting on the lock would block it.
+        """
+        now = time.monotonic()
+        with self._lock:
+            full = not self._loaded
+            poll = not full and now - self._polled_at > GEOFENCE_SYNC_SECONDS
+            if full or poll:
+                self._polled_at = now
+            dirty, self._dirty = (set(), set()) if full else (self._dirty, set())
+        try:
+            if poll:
+                dirty |= self._changed_since_load(session)
+            if not full and not dirty:
+                return
+            query = session.query(*_GEOMETRY_COLUMNS)
+            rows = query.all() if full else query.filter(Geofence.id.in_(dirty)).all()
+        except Exception:
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        loaded = {row.id: self._decode(row) for row in rows}
+        with self._lock:
+            if full:
+                self._geoms, self._versions = {}, {}
+                self._loaded = True
+            for fence_id in dirty - loaded.keys():
+                self._geoms.pop(fence_id, None)  # deleted
+                self._versions.pop(fence_id, None)
+            self._versions.update((row.id, row.polygon_hash) for row in rows)
+            for fence_id, poly in loaded.items():
+                if poly is None:
+                    self._geoms.pop(fence_id, None)
+                else:
+                    self._geoms[fence_id] = poly
+            self._rebuild()
+        if full:
+            logger.info("Geofence index loaded with %d fences", len(loaded))
+        else:
+            logger.debug("Geofence index refreshed %d fences", len(dirty))
+
+    def _changed_since_load(self, session: Session) -> Set[int]:
+        """Ids of fences added, deleted or re-normalized since they were loaded, e.g. by another worker."""
+        current = dict(session.query(Geofence.id, Geofence.polygon_hash).all())
+        with self._lock:
+            known = dict(self._versions)
+        changed = {i for i, version in current.items() if i not in known or known[i] != version}
+        return changed | (known.keys() - current.keys())
+
+    @staticmethod
+    def _decode(row) -> Optional[Polygon]:
+        poly = _load_geometry(row)
+        if poly is None or poly.is_empty:
+            return None
+        shapely.prepare(poly)
+        return poly
+
+    def _rebuild(self):
+        ids = list(self._geoms)
+        tree = STRtree([self._geoms[i] for i in ids]) if ids else None
+        self._snapshot = (tree, ids)
+
+    def query(self, lat: float, lon: float) -> List[int]:
+        """Returns ids of fences that contain or touch the point (lat, lon)."""
+        tree, ids = self._snapshot
+        if tree is None:
+            return []
+        hits = tree.query(Point(lon, lat), predicate="intersects")
+        return [ids[i] for i in sorted(hits)]
+
+    def query_many(self, points: List[Tuple[float, float]]) -> List[List[int]]:
+        """Returns, for each (lat, lon) point, the ids of the fences that contain it."""
+        results: List[List[int]] = [[] for _ in points]
+        tree, ids = self._snapshot
+        if tree is None or not points:
+            return results
+        geoms = shapely.points([(lon, lat) for lat, lon in points])
+        point_idx, tree_idx = tree.query(geoms, predicate="intersects")
+        for p, t in sorted(zip(point_idx.tolist(), tree_idx.tolist())):
+            results[p].append(ids[t])
+        return results
+
+    def __len__(self):
+        return len(self._snapshot[1])
+
+
+_GEOMETRY_COLUMNS = (Geofence.id, Geofence.polygon, Geofence.geometry_wkb, Geofence.polygon_hash)
+
+geofence_index = GeofenceIndex()
+
+
+@event.listens_for(Geofence, "after_insert")
+@event.listens_for(Geofence, "after_update")
+@event.listens_for(Geofence, "after_delete")
+def _track_geofence_change(mapper, connection, target):
+    """Remembers changed fences on the session until the transaction commits."""
+    session = Session.object_session(target)
+    if session is not None and target.id is not None:
+        session.info.setdefault("geofence_changes", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _flush_geofence_changes(session):
+    changed = session.info.pop("geofence_changes", None)
+    if changed:
+        geofence_index.invalidate(changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_geofence_changes(session):
+    session.info.pop("geofence_changes", None)
+
+
+def _load_fences(session: Session, fence_ids: Iterable[int]) -> Dict[int, Geofence]:
+    fence_ids = set(fence_ids)
+    if not fence_ids:
+        return {}
+    return {gf.id: gf for gf in session.query(Geofence).filter(Geofence.id.in_(fence_ids)).all()}
+
+
+def query_geofences_by_bbox(session: "Session", lat: float, lon: float) -> List[Geofence]:
+    """
+    Return Geofence instances containing (lat, lon) using the SQL bounding-box prefilter.
+    Only fences whose stored bbox contains the point are loaded, so the cost follows
+    the number of nearby fences. Needs no in-process state, unlike the index.
+    """
+    p = Point(lon, lat)
+    candidates = session.query(Geofence).filter(
+        Geofence.is_valid == True,
+        Geofence.min_lat <= lat, Geofence.max_lat >= lat,
+        Geofence.min_lon <= lon, Geofence.max_lon >= lon,
+    ).order_by(Geofence.id).all()
+    return [gf for gf in candidates if shapely.from_wkb(gf.geometry_wkb).intersects(p)]
+
+
 def get_geofences_containing_point(session: "Session", lat: float, lon: float) -> List[Geofence]:
     """
-    Return list of Geofence model instances (from models.Geofence) that contain the point (lat, lon).
-    Uses SQLAlchemy session passed by caller.
+    Return list of Geofence model instances that contain the point (lat, lon).
+    Uses SQLAlchemy session passed by caller; only matching rows are loaded.
     """
-    result = []
     try:
-        geofences = session.query(Geofence).all()
-        p = Point(lon, lat)  # shapely Point expects (lon, lat)
-        for gf in geofences:
-            try:
-                poly = parse_polygon(gf.polygon)
-                if poly is None:
-                    continue
-                if poly.contains(p) or poly.touches(p):
-                    result.append(gf)
-            except Exception:
-                logger.exception("Error checking geofence id=%s name=%s", getattr(gf, "id", None), getattr(gf, "name", None))
-                continue
+        if not GEOFENCE_INDEX_ENABLED:
+            return query_geofences_by_bbox(session, lat, lon)
+        geofence_index.refresh(session)
+        ids = geofence_index.query(lat, lon)
+        fences = _load_fences(session, ids)
+        return [fences[i] for i in ids if i in fences]
     except Exception:
         logger.exception("get_geofences_containing_point failed")
-    return result
+        return []
+
+
+def get_geofences_containing_points(session: "Session", points: List[Tuple[float, float]]) -> List[List[Geofence]]:
+    """
+    Batch version of get_geofences_containing_point.
+    Takes a list of (lat, lon) points and returns one list of Geofence instances per point.
+    """
+    try:
+        geofence_index.refresh(session)
+        hits = geofence_index.query_many(points)
+        fences = _load_fences(session, (i for ids in hits for i in ids))
+        return [[fences[i] for i in ids if i in fences] for ids in hits]
+    except Exception:
+        logger.exception("get_geofences_containing_points failed")
+        return [[] for _ in points]
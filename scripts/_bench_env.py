@@ -0,0 +1,25 @@
+"""
+Environment for the scripts that import the app without running it: puts the
+project root on sys.path and sets what app.config requires. Call setup()
+before importing anything from app.
+"""
+import os
+import sys
+import tempfile
+from typing import Optional
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup(db_name: Optional[str] = None, keep_database_url: bool = False):
+    """
+    With `db_name`, points DATABASE_URL at a fresh SQLite file of that name in a
+    temporary directory; `keep_database_url` lets a DATABASE_URL already set win.
+    """
+    if PROJECT_ROOT not in sys.path:
+        sys.path.insert(0, PROJECT_ROOT)
+    # app.config requires these; the scripts never talk to Telegram
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+    os.environ.setdefault("TELEGRAM_USER_ID", "1")
+    if db_name is not None and not (keep_database_url and os.getenv("DATABASE_URL")):
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), db_name)
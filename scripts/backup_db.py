@@ -1,41 +1,374 @@
-import requests
-import os
+"""
+Online, incremental, compressed backups of the SQLite database, sent to the
+authorized Telegram user.
+
+A backup first takes a consistent snapshot with SQLite's online backup API, a
+few hundred pages per step, so the app keeps writing meanwhile. In WAL mode
+the snapshot is pinned by a read transaction, which does not block writers;
+with a rollback journal, writers get in between steps. The snapshot is then
+compared page by page with the previous one:
+
+  - full:  the whole snapshot, gzip-compressed (gunzip it to get a plain .db file)
+  - delta: only the pages that changed since the previous backup
+
+Compression streams straight into the upload. A full backup is taken when
+there is no previous one, every BACKUP_FULL_EVERY_DAYS days, or after
+BACKUP_MAX_DELTAS deltas. Each backup is restored from the local copies and
+checked before it counts.
+
+    python scripts/backup_db.py                      # the nightly cron job
+    python scripts/backup_db.py --full --no-upload
+    python scripts/backup_db.py restore out.db backup_...full.db.gz backup_...delta-1.gz ...
+    python scripts/backup_db.py verify out.db
+"""
+import argparse
 import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+import uuid
+import zlib
+
+import requests
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv(dotenv_path='/app/.env') # Adjust path if .env is elsewhere
 
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 AUTHORIZED_USER_ID = os.getenv("TELEGRAM_USER_ID")
-DATABASE_PATH = "/app/hotel_os_bot.db" # Path to the database file inside the container
-
-def send_db_backup():
-    """Sends the SQLite database file to the authorized Telegram user."""
-    if not all([TELEGRAM_BOT_TOKEN, AUTHORIZED_USER_ID]):
-        print("Error: Bot token or user ID not configured.")
-        return
-
-    if not os.path.exists(DATABASE_PATH):
-        print(f"Error: Database file not found at {DATABASE_PATH}")
-        return
-
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendDocument"
-    
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    file_name = f"backup_hotel_os_{timestamp}.db"
-
-    with open(DATABASE_PATH, 'rb') as db_file:
-        files = {'document': (file_name, db_file)}
-        data = {'chat_id': AUTHORIZED_USER_ID, 'caption': f'Daily database backup from {timestamp}'}
-        
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+
+
+def _database_path() -> str:
+    """BACKUP_DATABASE_PATH, else the file of a sqlite DATABASE_URL, relative to the project root like the app's."""
+    if os.getenv("BACKUP_DATABASE_PATH"):
+        return os.getenv("BACKUP_DATABASE_PATH")
+    url = os.getenv("DATABASE_URL", "sqlite:///hotel_os_bot.db")
+    path = url.split(":///", 1)[1] if url.startswith("sqlite:///") else "hotel_os_bot.db"
+    return path if os.path.isabs(path) else os.path.join(PROJECT_ROOT, path)
+
+
+DATABASE_PATH = _database_path()
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(PROJECT_ROOT, "backups")) # Local copies of the chain, and its manifest
+BACKUP_FULL_EVERY_DAYS = int(os.getenv("BACKUP_FULL_EVERY_DAYS", 7))
+BACKUP_MAX_DELTAS = int(os.getenv("BACKUP_MAX_DELTAS", 14))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", 256))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", 0.005)) # Seconds between steps, leaving room for writers
+BACKUP_MAX_RESTARTS = 5 # Rollback-journal mode only: after this many restarts, copy in one step
+COMPRESS_LEVEL = 6
+
+DELTA_MAGIC = b"HOSDELTA1\n"
+MANIFEST = "manifest.json"
+
+
+class BackupError(Exception):
+    """Raised when a snapshot, upload or restore check fails."""
+
+
+# --- Snapshot --- #
+
+class _Restarted(Exception):
+    pass
+
+
+def snapshot(db_path: str, dest_path: str, pages_per_step: int = None, step_sleep: float = None) -> dict:
+    """
+    Copies a consistent snapshot of the live database to `dest_path` with the
+    online backup API, `pages_per_step` pages at a time. Returns timing stats.
+    """
+    pages_per_step = pages_per_step or BACKUP_PAGES_PER_STEP
+    step_sleep = BACKUP_STEP_SLEEP if step_sleep is None else step_sleep
+    started = time.monotonic()
+    source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+    dest = sqlite3.connect(dest_path)
+    restarts = 0
+    try:
+        wal = source.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+        if wal:
+            # A read transaction pins one WAL snapshot for every step; writers carry on
+            source.execute("BEGIN")
+            source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        remaining_before = [None]
+
+        def progress(status, remaining, total):
+            nonlocal restarts
+            if remaining_before[0] is not None and remaining > remaining_before[0]:
+                restarts += 1  # another connection wrote; SQLite started over
+                if restarts > BACKUP_MAX_RESTARTS:
+                    raise _Restarted()
+            remaining_before[0] = remaining
+
         try:
-            response = requests.post(url, data=data, files=files)
-            response.raise_for_for_status()
-            print(f"Successfully sent database backup to user {AUTHORIZED_USER_ID}")
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending backup: {e}")
+            source.backup(dest, pages=pages_per_step, progress=progress, sleep=step_sleep)
+        except _Restarted:
+            source.backup(dest, pages=-1)
+        if wal:
+            source.rollback()
+    finally:
+        source.close()
+        dest.close()
+    return {"seconds": time.monotonic() - started, "restarts": restarts, "wal": wal}
+
+
+def page_size_of(path: str) -> int:
+    with open(path, "rb") as f:
+        header = f.read(100)
+    size = struct.unpack(">H", header[16:18])[0]
+    return 65536 if size == 1 else size
+
+
+def iter_pages(path: str, page_size: int):
+    with open(path, "rb") as f:
+        while True:
+            page = f.read(page_size)
+            if not page:
+                return
+            yield page
+
+
+def page_hash(page: bytes) -> str:
+    return hashlib.blake2b(page, digest_size=16).hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# --- Backup Files --- #
+
+def _compressed(chunks, level: int = COMPRESS_LEVEL):
+    """gzip-compresses an iterable of byte chunks, yielding compressed output as it is produced."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def full_chunks(snapshot_path: str):
+    with open(snapshot_path, "rb") as f:
+        yield from iter(lambda: f.read(1 << 20), b"")
+
+
+def delta_chunks(snapshot_path: str, page_size: int, changed: list, header: dict):
+    """A delta: magic, one JSON header line, then (page number, page bytes) for each changed page."""
+    yield DELTA_MAGIC + json.dumps(header).encode() + b"\n"
+    changed = set(changed)
+    for number, page in enumerate(iter_pages(snapshot_path, page_size), start=1):
+        if number in changed:
+            yield struct.pack(">I", number) + page
+
+
+class _Tee:
+    """Passes chunks through while writing them to a local file and counting bytes."""
+
+    def __init__(self, chunks, path: str):
+        self.chunks = chunks
+        self.path = path
+        self.bytes = 0
+
+    def __iter__(self):
+        with open(self.path, "wb") as f:
+            for chunk in self.chunks:
+                f.write(chunk)
+                self.bytes += len(chunk)
+                yield chunk
+
+
+def _multipart(chunks, file_name: str, fields: dict, boundary: str):
+    for name, value in fields.items():
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n').encode()
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="document"; filename="{file_name}"\r\n'
+           f'Content-Type: application/gzip\r\n\r\n').encode()
+    yield from chunks
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def upload(chunks, file_name: str, caption: str):
+    """Streams the file to the authorized user with sendDocument, without holding it in memory."""
+    boundary = uuid.uuid4().hex
+    response = requests.post(
+        f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendDocument",
+        data=_multipart(chunks, file_name, {"chat_id": AUTHORIZED_USER_ID, "caption": caption}, boundary),
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        timeout=300,
+    )
+    response.raise_for_status()
+
+
+# --- Manifest --- #
+
+def load_manifest(backup_dir: str):
+    try:
+        with open(os.path.join(backup_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_manifest(backup_dir: str, manifest: dict):
+    path = os.path.join(backup_dir, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+# --- Backup --- #
+
+def run_backup(db_path: str = DATABASE_PATH, backup_dir: str = BACKUP_DIR, force_full: bool = False,
+               send: bool = True, verify: bool = True) -> dict:
+    """Takes a full or delta backup, keeps it in `backup_dir`, optionally uploads and verifies it. Returns stats."""
+    if not os.path.exists(db_path):
+        raise BackupError(f"Database file not found at {db_path}")
+    if send and not all([TELEGRAM_BOT_TOKEN, AUTHORIZED_USER_ID]):
+        raise BackupError("Bot token or user ID not configured.")
+    os.makedirs(backup_dir, exist_ok=True)
+    stats = {"db_bytes": os.path.getsize(db_path)}
+
+    with tempfile.TemporaryDirectory(dir=backup_dir) as work:
+        snapshot_path = os.path.join(work, "snapshot.db")
+        stats.update(snapshot(db_path, snapshot_path))
+        page_size = page_size_of(snapshot_path)
+        hashes = [page_hash(page) for page in iter_pages(snapshot_path, page_size)]
+        sha256 = file_sha256(snapshot_path)
+
+        manifest = load_manifest(backup_dir)
+        full = force_full or manifest is None or manifest["page_size"] != page_size \
+            or len(manifest["chain"]) > BACKUP_MAX_DELTAS \
+            or time.time() - manifest["full_at"] > BACKUP_FULL_EVERY_DAYS * 86400
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        if full:
+            file_name = f"backup_hotel_os_{timestamp}.full.db.gz"
+            chunks = full_chunks(snapshot_path)
+            stats["pages_sent"] = len(hashes)
+        else:
+            previous = manifest["page_hashes"]
+            changed = [n for n, h in enumerate(hashes, start=1) if n > len(previous) or previous[n - 1] != h]
+            file_name = f"backup_hotel_os_{timestamp}.delta-{len(manifest['chain'])}.gz"
+            header = {"parent": manifest["chain"][-1], "page_size": page_size, "page_count": len(hashes), "sha256": sha256}
+            chunks = delta_chunks(snapshot_path, page_size, changed, header)
+            stats["pages_sent"] = len(changed)
+        stats.update({"kind": "full" if full else "delta", "file": file_name, "pages": len(hashes)})
+
+        started = time.monotonic()
+        local_copy = _Tee(_compressed(chunks), os.path.join(backup_dir, file_name))
+        if send:
+            kind = "Full" if full else f"Incremental ({stats['pages_sent']} changed pages)"
+            upload(local_copy, file_name, f"{kind} database backup from {timestamp}")
+        else:
+            for _ in local_copy:
+                pass
+        stats["upload_seconds"] = time.monotonic() - started
+        stats["bytes_sent"] = local_copy.bytes
+
+        chain = [file_name] if full else manifest["chain"] + [file_name]
+        if verify:
+            restored = os.path.join(work, "restored.db")
+            restore([os.path.join(backup_dir, name) for name in chain], restored)
+            if file_sha256(restored) != sha256:
+                raise BackupError(f"Restored chain does not match the snapshot: {', '.join(chain)}")
+            verify_database(restored)
+
+    save_manifest(backup_dir, {
+        "chain": chain, "page_size": page_size, "page_hashes": hashes, "sha256": sha256,
+        "full_at": time.time() if full else manifest["full_at"],
+    })
+    if full:
+        # Older chains are superseded; the uploaded copies remain in Telegram
+        for name in os.listdir(backup_dir):
+            if name.startswith("backup_hotel_os_") and name != file_name:
+                os.remove(os.path.join(backup_dir, name))
+    return stats
+
+
+# --- Restore and Verify --- #
+
+def restore(files: list, out_path: str):
+    """Rebuilds the database from a full backup followed by its deltas, in order."""
+    if not files or not files[0].endswith(".full.db.gz"):
+        raise BackupError("A restore starts with a .full.db.gz backup")
+    with gzip.open(files[0], "rb") as src, open(out_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    previous = os.path.basename(files[0])
+    for path in files[1:]:
+        with gzip.open(path, "rb") as src:
+            if src.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+                raise BackupError(f"{path} is not a delta backup")
+            header = json.loads(src.readline())
+            if header["parent"] != previous:
+                raise BackupError(f"{path} follows {header['parent']}, not {previous}")
+            page_size = header["page_size"]
+            with open(out_path, "r+b") as dst:
+                while True:
+                    number = src.read(4)
+                    if not number:
+                        break
+                    dst.seek((struct.unpack(">I", number)[0] - 1) * page_size)
+                    dst.write(src.read(page_size))
+                dst.truncate(header["page_count"] * page_size)
+        if file_sha256(out_path) != header["sha256"]:
+            raise BackupError(f"Database after {path} does not match its checksum")
+        previous = os.path.basename(path)
+
+
+def verify_database(path: str) -> dict:
+    """Opens a restored database and runs SQLite's integrity check. Returns row counts per table."""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = connection.execute("PRAGMA integrity_check").fetchone()[0]
+        if result != "ok":
+            raise BackupError(f"Integrity check failed: {result}")
+        tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        return {table: connection.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0] for table in tables}
+    finally:
+        connection.close()
+
+
+def send_db_backup(force_full: bool = False, send: bool = True):
+    """Takes the nightly backup and reports the outcome."""
+    try:
+        stats = run_backup(force_full=force_full, send=send)
+    except (BackupError, requests.exceptions.RequestException, sqlite3.Error) as e:
+        print(f"Error creating backup: {e}")
+        return False
+    print(f"{stats['kind'].capitalize()} backup {stats['file']}: {stats['pages_sent']}/{stats['pages']} pages, "
+          f"{stats['bytes_sent']} bytes sent for a {stats['db_bytes']} byte database, "
+          f"snapshot {stats['seconds']:.2f}s, compress+upload {stats['upload_seconds']:.2f}s, verified"
+          + (f", sent to user {AUTHORIZED_USER_ID}" if send else ""))
+    return True
+
 
 if __name__ == "__main__":
-    print("Executing daily database backup...")
-    send_db_backup()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="action")
+    parser.add_argument("--full", action="store_true", help="Take a full backup even if a delta would do")
+    parser.add_argument("--no-upload", action="store_true", help="Keep the backup locally only")
+    restore_parser = sub.add_parser("restore", help="Rebuild a database from a full backup and its deltas")
+    restore_parser.add_argument("out")
+    restore_parser.add_argument("files", nargs="+")
+    verify_parser = sub.add_parser("verify", help="Check a restored database")
+    verify_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.action == "restore":
+        restore(args.files, args.out)
+        print(f"Restored {args.out}: {verify_database(args.out)}")
+    elif args.action == "verify":
+        print(f"{args.path} is intact: {verify_database(args.path)}")
+    else:
+        print("Executing daily database backup...")
+        send_db_backup(force_full=args.full, send=not args.no_upload)
@@ -0,0 +1,120 @@
+"""
+Compares "which rooms are free for these nights" across the property: a scan
+of every booking in Python, the (room, check-in, check-out) indexed overlap
+query and the in-memory availability calendar, on a seeded SQLite database.
+Also times booking creation with its in-transaction conflict check.
+
+    python scripts/benchmark_availability.py --rooms 100 --years 1 3 10
+"""
+import argparse
+import datetime
+import random
+import time
+
+import _bench_env
+
+_bench_env.setup("benchmark_availability.db")
+
+from app import availability
+from app.database import Booking, BookingConflict, Room, SessionLocal, engine, init_db, create_booking
+
+END = datetime.date(2027, 1, 1)
+
+
+def scan_free_rooms(db, first_night: datetime.date, end_night: datetime.date, floor=None) -> dict:
+    """What answering the question took before: load every booking and compare dates."""
+    rooms = [r.room_number for r in db.query(Room.room_number)]
+    booked = {}
+    for b in db.query(Booking):
+        if not b.is_cancelled and b.check_in_date.date() < end_night and b.check_out_date.date() > first_night:
+            booked.setdefault(b.room_number, []).append(b.id)
+    return {"free": [r for r in rooms if r not in booked], "booked": booked}
+
+
+def seed(room_count: int, years: int, rng: random.Random) -> int:
+    """Fills `room_count` rooms back to back for `years` years, with gaps and some cancellations. Returns the booking count."""
+    Booking.__table__.drop(engine, checkfirst=True)
+    Room.__table__.drop(engine, checkfirst=True)
+    init_db()
+    rooms = [{"room_number": f"{1 + i // 20}{i % 20 + 1:02d}", "floor": 1 + i // 20} for i in range(room_count)]
+    rows = []
+    for room in rooms:
+        day = END.replace(year=END.year - years)
+        while day < END:
+            nights = rng.randint(1, 5)
+            check_in = datetime.datetime.combine(day, datetime.time(14))
+            rows.append({
+                "customer_name": f"Guest {len(rows)}",
+                "room_number": room["room_number"],
+                "check_in_date": check_in,
+                "check_out_date": check_in + datetime.timedelta(days=nights, hours=-3),
+                "total_price": 1200.0 * nights,
+                "is_paid": True,
+                "is_cancelled": rng.random() < 0.05,
+            })
+            day += datetime.timedelta(days=nights + rng.randint(0, 4))
+    with engine.begin() as conn:
+        conn.execute(Room.__table__.insert(), rooms)
+        conn.execute(Booking.__table__.insert(), rows)
+    return len(rows)
+
+
+def measure(fn, db, ranges) -> tuple:
+    started = time.perf_counter()
+    results = [fn(db, first, end) for first, end in ranges]
+    return 1000 * (time.perf_counter() - started) / len(ranges), results
+
+
+def run(room_count: int, years_list, queries: int, seed_value: int):
+    rng = random.Random(seed_value)
+    print(f"{'bookings':>9} {'method':<10} {'ms/query':>9}")
+    for years in years_list:
+        count = seed(room_count, years, rng)
+        ranges = []
+        for _ in range(queries):
+            first = END - datetime.timedelta(days=rng.randint(30, 365))
+            ranges.append((first, first + datetime.timedelta(days=rng.randint(1, 7))))
+        db = SessionLocal()
+        availability.calendar.invalidate()
+        started = time.perf_counter()
+        availability.calendar.refresh(db)
+        load_ms = 1000 * (time.perf_counter() - started)
+        index_on = availability.AVAILABILITY_INDEX_ENABLED
+        try:
+            availability.AVAILABILITY_INDEX_ENABLED = False
+            sql_ms, sql = measure(availability.find_available_rooms, db, ranges[:50])
+            availability.AVAILABILITY_INDEX_ENABLED = True
+            index_ms, index = measure(availability.find_available_rooms, db, ranges)
+        finally:
+            availability.AVAILABILITY_INDEX_ENABLED = index_on
+        scan_ms, scan = measure(scan_free_rooms, db, ranges[:5])
+        for got in (sql, index[:len(sql)]):
+            if [r["free"] for r in got[:len(scan)]] != [r["free"] for r in scan]:
+                raise SystemExit("Methods disagree on which rooms are free")
+        for label, ms in (("scan", scan_ms), ("sql", sql_ms), ("calendar", index_ms)):
+            print(f"{count:>9} {label:<10} {ms:>9.3f}")
+        print(f"{count:>9} {'(load)':<10} {load_ms:>9.1f}")
+
+        created = conflicts = 0
+        started = time.perf_counter()
+        for first, end in ranges[:200]:
+            room = f"1{rng.randint(1, min(room_count, 20)):02d}"
+            try:
+                create_booking(db, "Benchmark", room, datetime.datetime.combine(first, datetime.time(14)),
+                               datetime.datetime.combine(end, datetime.time(11)), 1200.0)
+                created += 1
+            except BookingConflict:
+                conflicts += 1
+        create_ms = 1000 * (time.perf_counter() - started) / (created + conflicts)
+        print(f"{count:>9} {'create':<10} {create_ms:>9.3f}  ({created} created, {conflicts} refused)")
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 3, 10], help="Years of booking history to seed")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    run(args.rooms, args.years, args.queries, args.seed)
@@ -0,0 +1,167 @@
+"""
+Benchmark for scripts/backup_db.py. Seeds a WAL database of roughly --size-mb
+MB, keeps a writer committing small transactions in the background, and runs:
+
+  - copy:  the old approach, uploading the raw live file
+  - full:  a stepped online snapshot, compressed while it streams
+  - delta: a snapshot after --change-pct percent of the rows were updated
+
+Uploads go to a local sink that stands in for the Bot API and counts the bytes
+it receives. Reports duration, bytes sent against the database size, and how
+long the writer's commits took while each backup ran.
+
+    python scripts/benchmark_backup.py --size-mb 200 --change-pct 2
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("TELEGRAM_USER_ID", "1")
+
+ROW_BYTES = 300
+
+
+def sink():
+    """A sendDocument endpoint that reads and discards the body, counting bytes."""
+    received = {"bytes": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            if self.headers.get("Transfer-Encoding") == "chunked":
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    received["bytes"] += len(self.rfile.read(size))
+                    self.rfile.readline()
+                    if size == 0:
+                        break
+            else:
+                received["bytes"] += len(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            body = b'{"ok": true, "result": {}}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, received
+
+
+def seed(path: str, size_mb: int) -> int:
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("CREATE TABLE bookings (id INTEGER PRIMARY KEY, room TEXT, guest TEXT, notes TEXT)")
+    rows = size_mb * 1024 * 1024 // ROW_BYTES
+    connection.execute("BEGIN")
+    connection.executemany(
+        "INSERT INTO bookings (room, guest, notes) VALUES (?, ?, ?)",
+        ((str(i % 200), f"guest {i}", os.urandom(ROW_BYTES // 3).hex()[:ROW_BYTES - 40] + "a" * 20) for i in range(rows)),
+    )
+    connection.execute("COMMIT")
+    connection.close()
+    return rows
+
+
+class Writer(threading.Thread):
+    """Commits one small update at a time, recording how long each commit took."""
+
+    def __init__(self, path: str, rows: int):
+        super().__init__(daemon=True)
+        self.path = path
+        self.rows = rows
+        self.latencies = []
+        self.running = True
+
+    def run(self):
+        connection = sqlite3.connect(self.path, isolation_level=None, timeout=60)
+        while self.running:
+            started = time.monotonic()
+            connection.execute("UPDATE bookings SET guest = ? WHERE id = ?", (f"guest {time.time()}", random.randint(1, self.rows)))
+            self.latencies.append(time.monotonic() - started)
+            time.sleep(0.005)
+        connection.close()
+
+    def collect(self) -> list:
+        latencies, self.latencies = self.latencies, []
+        return latencies
+
+
+def legacy_copy(db_path: str, url: str):
+    with open(db_path, "rb") as document:
+        requests.post(url, data={"chat_id": os.environ["TELEGRAM_USER_ID"]}, files={"document": document}, timeout=300).raise_for_status()
+
+
+def report(name: str, seconds: float, sent: int, db_bytes: int, latencies: list):
+    latencies = sorted(latencies) or [0.0]
+    p99 = latencies[int(0.99 * (len(latencies) - 1))]
+    print(f"{name:<6} {seconds:>7.2f}s   sent {sent / 1e6:>8.2f} MB ({100 * sent / db_bytes:>5.1f}% of db)   "
+          f"writer commits: {len(latencies)}, p50 {1000 * statistics.median(latencies):.1f} ms, "
+          f"p99 {1000 * p99:.1f} ms, max {1000 * latencies[-1]:.1f} ms")
+
+
+def run(args):
+    server, received = sink()
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{server.server_port}"
+    work = tempfile.mkdtemp()
+    db_path = os.path.join(work, "hotel_os_bot.db")
+    os.environ["BACKUP_DATABASE_PATH"] = db_path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import backup_db
+
+    rows = seed(db_path, args.size_mb)
+    db_bytes = os.path.getsize(db_path)
+    print(f"{db_bytes / 1e6:.1f} MB database, {rows} rows, {args.pages_per_step} pages per step")
+    writer = Writer(db_path, rows)
+    writer.start()
+    time.sleep(0.5)
+    writer.collect()
+
+    def measure(name, backup):
+        received["bytes"] = 0
+        started = time.monotonic()
+        backup()
+        report(name, time.monotonic() - started, received["bytes"], os.path.getsize(db_path), writer.collect())
+
+    backup_dir = os.path.join(work, "backups")
+    url = f"{os.environ['TELEGRAM_API_URL']}/bot{os.environ['TELEGRAM_BOT_TOKEN']}/sendDocument"
+    backup_db.BACKUP_PAGES_PER_STEP = args.pages_per_step
+    measure("copy", lambda: legacy_copy(db_path, url))
+    measure("full", lambda: backup_db.run_backup(db_path, backup_dir, force_full=True))
+
+    connection = sqlite3.connect(db_path, isolation_level=None, timeout=60)
+    changed = random.sample(range(1, rows + 1), rows * args.change_pct // 100)
+    connection.execute("BEGIN")
+    connection.executemany("UPDATE bookings SET notes = ? WHERE id = ?", ((os.urandom(8).hex(), i) for i in changed))
+    connection.execute("COMMIT")
+    connection.close()
+    writer.collect()
+    measure("delta", lambda: backup_db.run_backup(db_path, backup_dir))
+
+    writer.running = False
+    writer.join()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=100)
+    parser.add_argument("--change-pct", type=int, default=1, help="Percent of rows updated before the delta backup")
+    parser.add_argument("--pages-per-step", type=int, default=256)
+    run(parser.parse_args())
@@ -0,0 +1,346 @@
+"""
+End-to-end benchmark of the bot. Seeds a SQLite database with a year of
+bookings and expenses, rooms and geofences, then starts the app under uvicorn
+in webhook mode with every external service replaced by a local fake:
+
+  - Telegram Bot API and file server: fake_bot_api from benchmark_webhook.py,
+    serving generated slip images
+  - Gemini: scripts/fake_gemini.py
+  - MQTT: scripts/fake_mqtt_broker.py, answering device commands with state reports
+
+It replays a mix of updates through the real bot handlers and reports, per
+kind of update, reply latency p50/p95/p99: from posting the update to the
+bot's last message or edit for it. Also overall throughput and the peak
+resident memory of the app and its OCR worker processes.
+
+--save writes the results as JSON. --compare checks a run against such a file
+and exits with status 1 when a kind's p95 or p99 got slower, throughput
+dropped or peak memory grew by more than --tolerance percent. Compare runs of
+the same --count, --mix and --seed on the same machine.
+
+    python scripts/benchmark_e2e.py --count 2000 --save baseline.json
+    python scripts/benchmark_e2e.py --count 2000 --compare baseline.json
+    python scripts/benchmark_e2e.py --mix slip=1,lookup=1 --bookings 100000
+
+Slips are only read when Tesseract is installed; without it they are
+measured as unreadable.
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_webhook import CHAT_BASE, SECRET, TOKEN, USER_ID, fake_bot_api, free_port, percentile, post_all, start_app
+import fake_gemini
+import fake_mqtt_broker
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", TOKEN)
+os.environ.setdefault("TELEGRAM_USER_ID", str(USER_ID))
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark_e2e.db")
+
+from PIL import Image, ImageDraw, ImageFont
+
+from app.database import Booking, Expense, Geofence, Room, SessionLocal, engine, init_db, rebuild_daily_summary, to_satang
+
+DEFAULT_MIX = "command=2,device=1,lookup=3,ai=2,slip=1,location=1"
+QUESTIONS = ["What time is breakfast?", "Can I bring a pet?", "Is there parking nearby?", "How do I get to the airport?"]
+MQTT_ROOT = "hotel"
+
+
+# --- Seeding --- #
+
+def seed(rng: random.Random, bookings: int, expenses: int, room_count: int, geofences: int) -> dict:
+    """Bulk-inserts the history and returns what the updates refer to: rooms, unpaid bookings and fence centres."""
+    init_db()
+    rooms = [f"{floor}{number:02d}" for floor in range(1, room_count // 10 + 2) for number in range(1, 11)][:room_count]
+    now = datetime.datetime.now().replace(microsecond=0)
+    booking_rows, unpaid = [], []
+    for i in range(bookings):
+        check_in = now - datetime.timedelta(days=rng.uniform(-30, 365))
+        price = rng.choice([800.0, 1200.0, 1500.0, 2400.0]) + rng.randrange(0, 100) * 10
+        # Recent bookings are the ones still waiting for a slip
+        is_paid = check_in < now - datetime.timedelta(days=14) or rng.random() < 0.7
+        name = f"Guest {rng.choice('ABCDEFGHJKLMNPRSTW')}{i}"
+        booking_rows.append({
+            "customer_name": name, "check_in_date": check_in, "check_out_date": check_in + datetime.timedelta(days=rng.randint(1, 5)),
+            "room_number": rng.choice(rooms), "total_price": price, "total_price_satang": to_satang(price),
+            "is_paid": is_paid, "created_at": check_in - datetime.timedelta(days=rng.randint(0, 30)),
+        })
+        if not is_paid:
+            unpaid.append((name, price))
+    expense_rows = [
+        {"description": rng.choice(["supplies", "laundry", "repairs", "electricity"]), "amount": round(rng.uniform(100, 5000), 2),
+         "category": "General", "date": now - datetime.timedelta(days=rng.uniform(0, 365))}
+        for _ in range(expenses)
+    ]
+    centres, fence_rows = [], []
+    for i in range(geofences):
+        lat, lon, half = rng.uniform(13.6, 13.9), rng.uniform(100.4, 100.7), rng.uniform(0.001, 0.01)
+        centres.append((lat, lon))
+        # Inserted without normalized columns, as external tools do; the app's backfill fills them on startup
+        fence_rows.append({"name": f"Zone {i}", "polygon": json.dumps(
+            [[lat - half, lon - half], [lat - half, lon + half], [lat + half, lon + half], [lat + half, lon - half]])})
+    with engine.begin() as conn:
+        conn.execute(Room.__table__.insert(), [{"room_number": r, "floor": int(r[:-2]), "devices": "light,ac"} for r in rooms])
+        conn.execute(Booking.__table__.insert(), booking_rows)
+        conn.execute(Expense.__table__.insert(), expense_rows)
+        conn.execute(Geofence.__table__.insert(), fence_rows)
+    with SessionLocal() as db:
+        rebuild_daily_summary(db)
+    return {"rooms": rooms, "unpaid": unpaid, "centres": centres, "bookings": bookings}
+
+
+def slip_image(name: str, amount: float) -> bytes:
+    """A K PLUS style transfer slip as a PNG, laid out like the ones the templates expect."""
+    image = Image.new("L", (720, 960), 255)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=32)
+    lines = ["K PLUS", "Transfer successful", datetime.date.today().strftime("%d %b %Y"),
+             f"From: {name.upper()}", "xxx-x-x1234-x", "To: HOTEL OS", f"Amount: {amount:,.2f}", "Fee: 0.00"]
+    for i, line in enumerate(lines):
+        draw.text((60, 80 + 90 * i), line, fill=0, font=font)
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+# --- Updates --- #
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("command", "device", "lookup", "ai", "slip", "location"):
+            raise argparse.ArgumentTypeError(f"Unknown kind of update: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def message_for(kind: str, rng: random.Random, seeded: dict, slips: list) -> dict:
+    if kind == "command":
+        return {"text": rng.choice(["/status", "/daily_report", "/weekly_report", "/monthly_report", "/help"])}
+    if kind == "device":
+        target = rng.choice([rng.choice(seeded["rooms"]), f"floor {rng.randint(1, 3)}", ""])
+        command = rng.choice(["/light ON", "/light OFF", "/ac 25", "/ac OFF"]).split()
+        return {"text": " ".join([command[0], target, command[1]]).replace("  ", " ")}
+    if kind == "lookup":
+        room = rng.choice(seeded["rooms"])
+        return {"text": rng.choice([f"is room {room} paid?", f"who is in room {room}?", "unpaid bookings",
+                                    f"is booking {rng.randint(1, seeded['bookings'])} paid?", "income this week"])}
+    if kind == "ai":
+        return {"text": rng.choice(QUESTIONS)}
+    if kind == "slip":
+        file_id = rng.choice(slips)
+        return {"photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 720, "height": 960}]}
+    lat, lon = rng.choice(seeded["centres"]) if rng.random() < 0.8 else (rng.uniform(13.6, 13.9), rng.uniform(100.4, 100.7))
+    return {"location": {"latitude": lat, "longitude": lon}}
+
+
+def build_updates(count: int, mix: dict, rng: random.Random, seeded: dict, slips: list) -> tuple:
+    """Returns the updates and the kind of each, keyed by chat id as post_all records them."""
+    kinds, weights = zip(*mix.items())
+    updates, kind_of = [], {}
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        chat_id = CHAT_BASE + i
+        message = {"message_id": i + 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                   "from": {"id": USER_ID, "is_bot": False, "first_name": "Owner"}, **message_for(kind, rng, seeded, slips)}
+        if message.get("text", "").startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(message["text"].split()[0])}]
+        updates.append({"update_id": i + 1, "message": message})
+        kind_of[chat_id] = kind
+    return updates, kind_of
+
+
+# --- Measurement --- #
+
+def peak_memory(pid: int) -> dict:
+    """Peak resident memory (VmHWM) of the app and the sum over its child processes, in MB. Linux only."""
+    def hwm(process: str):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            return None
+
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += f.read().split()
+    except OSError:
+        pass
+    child_peaks = [peak for peak in map(hwm, children) if peak is not None]
+    return {"app_mb": hwm(str(pid)), "workers_mb": round(sum(child_peaks), 1) if child_peaks else None}
+
+
+def wait_until_settled(last_replies: dict, expected: int, settle: float, timeout: float):
+    """Waits until every update has a reply and the bot sent nothing for `settle` seconds."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        quiet = time.monotonic() - max(last_replies.values(), default=0.0)
+        if len(last_replies) >= expected and quiet >= settle:
+            return
+        time.sleep(0.1)
+
+
+def summarize(result: dict, last_replies: dict, kind_of: dict, started: float) -> dict:
+    by_kind = {}
+    for chat, kind in kind_of.items():
+        entry = by_kind.setdefault(kind, {"count": 0, "latencies": []})
+        entry["count"] += 1
+        if chat in last_replies:
+            entry["latencies"].append(last_replies[chat] - result["sent"][chat])
+    kinds = {}
+    for kind, entry in sorted(by_kind.items()):
+        latencies = entry["latencies"]
+        kinds[kind] = {
+            "count": entry["count"], "unanswered": entry["count"] - len(latencies),
+            "p50_ms": round(1000 * statistics.median(latencies), 1) if latencies else None,
+            "p95_ms": round(1000 * percentile(latencies, 0.95), 1) if latencies else None,
+            "p99_ms": round(1000 * percentile(latencies, 0.99), 1) if latencies else None,
+        }
+    handled = [chat for chat in kind_of if chat in last_replies]
+    duration = max((last_replies[chat] for chat in handled), default=started) - started
+    return {
+        "throughput": round(len(handled) / duration, 1) if duration > 0 else 0.0,
+        "ack_p99_ms": round(1000 * percentile(result["acks"], 0.99), 1),
+        "webhook_statuses": {str(k): v for k, v in sorted(result["statuses"].items())},
+        "kinds": kinds,
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Returns a line per metric that regressed by more than `tolerance` percent."""
+    limit = 1 + tolerance / 100
+    regressions = []
+
+    def check(label: str, now, before, higher_is_worse: bool = True):
+        if now is None or not before:
+            return
+        worse = now > before * limit if higher_is_worse else now < before / limit
+        if worse:
+            regressions.append(f"{label}: {before} -> {now}")
+
+    check("throughput (updates/s)", current["throughput"], baseline.get("throughput"), higher_is_worse=False)
+    for kind, stats in current["kinds"].items():
+        before = baseline.get("kinds", {}).get(kind, {})
+        for metric in ("p95_ms", "p99_ms"):
+            check(f"{kind} {metric}", stats[metric], before.get(metric))
+    for metric in ("app_mb", "workers_mb"):
+        check(f"memory {metric}", current["memory"][metric], baseline.get("memory", {}).get(metric))
+    return regressions
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    started = time.monotonic()
+    seeded = seed(rng, args.bookings, args.expenses, args.rooms, args.geofences)
+    print(f"Seeded {args.bookings} bookings ({len(seeded['unpaid'])} unpaid), {args.expenses} expenses, "
+          f"{args.rooms} rooms and {args.geofences} geofences in {time.monotonic() - started:.1f}s")
+
+    files = {}
+    for i, (name, amount) in enumerate(rng.sample(seeded["unpaid"], min(args.slips, len(seeded["unpaid"])))):
+        files[f"slip{i}"] = slip_image(name, amount)
+    last_replies = {}
+    bot_api, _, calls = fake_bot_api(files, last_replies)
+    gemini = fake_gemini.serve(latency=args.llm_latency, chunk_delay=0.01)
+    broker = fake_mqtt_broker.serve(echo_states=True)
+    port = free_port()
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": TOKEN, "TELEGRAM_USER_ID": str(USER_ID), "GEMINI_API_KEY": "benchmark",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{bot_api.server_port}",
+        "TELEGRAM_WEBHOOK_URL": f"http://127.0.0.1:{port}", "TELEGRAM_WEBHOOK_SECRET": SECRET,
+        "TELEGRAM_CONCURRENT_UPDATES": str(args.concurrent_updates),
+        "GEMINI_API_ENDPOINT": f"http://127.0.0.1:{gemini.server_port}",
+        "MQTT_BROKER": "127.0.0.1", "MQTT_PORT": str(broker.server_address[1]), "MQTT_TOPIC_PREFIX": f"{MQTT_ROOT}/101",
+        "LLM_CACHE_TTL": "0", "LOGGING_LEVEL": "WARNING",
+    }
+    updates, kind_of = build_updates(args.count, args.mix, rng, seeded, list(files))
+    process = start_app(port, 1, env)
+    try:
+        deadline = time.monotonic() + 60
+        while calls["setWebhook"] < 1:
+            if time.monotonic() > deadline or process.poll() is not None:
+                sys.exit("The app did not start")
+            time.sleep(0.2)
+        time.sleep(args.warmup)  # let the optional subsystems finish starting
+
+        posted = time.monotonic()
+        result = asyncio.run(post_all(f"http://127.0.0.1:{port}/telegram/webhook", updates, args.concurrency))
+        wait_until_settled(last_replies, len(updates), args.settle, args.timeout)
+        memory = peak_memory(process.pid)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        for server in (bot_api, gemini, broker):
+            server.shutdown()
+
+    summary = summarize(result, dict(last_replies), kind_of, posted)
+    summary["memory"] = memory
+    summary["config"] = {
+        "count": args.count, "mix": args.mix, "seed": args.seed, "concurrency": args.concurrency,
+        "concurrent_updates": args.concurrent_updates, "bookings": args.bookings, "expenses": args.expenses,
+        "llm_latency": args.llm_latency, "python": platform.python_version(), "machine": platform.machine(),
+        "cpus": os.cpu_count(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+    print(f"{args.count} updates, {args.concurrency} concurrent posts, {args.concurrent_updates} concurrent handlers; "
+          f"webhook responses {summary['webhook_statuses']}, ack p99 {summary['ack_p99_ms']} ms")
+    print(f"{'kind':<10} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'unanswered':>11}")
+    for kind, stats in summary["kinds"].items():
+        print(f"{kind:<10} {stats['count']:>6} {stats['p50_ms'] or '-':>9} {stats['p95_ms'] or '-':>9} "
+              f"{stats['p99_ms'] or '-':>9} {stats['unanswered']:>11}")
+    print(f"throughput: {summary['throughput']} updates/s; peak memory: app {memory['app_mb']} MB, "
+          f"OCR workers {memory['workers_mb']} MB; MQTT messages: {broker.stats['published']}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Saved results to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions past {args.tolerance}% against {args.compare}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions past {args.tolerance}% against {args.compare}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=1000, help="Updates to replay")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"Relative weight of each kind of update (default {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the data and the updates")
+    parser.add_argument("--concurrency", type=int, default=20, help="Webhook requests in flight")
+    parser.add_argument("--concurrent-updates", type=int, default=8, help="TELEGRAM_CONCURRENT_UPDATES for the app")
+    parser.add_argument("--bookings", type=int, default=20000)
+    parser.add_argument("--expenses", type=int, default=5000)
+    parser.add_argument("--rooms", type=int, default=60)
+    parser.add_argument("--geofences", type=int, default=500)
+    parser.add_argument("--slips", type=int, default=50, help="Distinct slip images; repeats hit the OCR cache")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Fake Gemini seconds before the first byte")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds to wait after the bot is up")
+    parser.add_argument("--settle", type=float, default=2, help="Quiet seconds after which all replies are in")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for replies after posting")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Fail on regressions against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=20, help="Percent a metric may get worse before --compare fails")
+    run(parser.parse_args())
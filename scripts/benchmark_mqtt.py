@@ -0,0 +1,47 @@
+"""
+Measures MQTT fan-out throughput (commands/sec) through the shared publisher.
+
+Run against a local broker, e.g. `mosquitto -p 1883`:
+    python scripts/benchmark_mqtt.py --host localhost --port 1883 --rooms 1 100 1000
+"""
+import argparse
+import asyncio
+import time
+
+import _bench_env
+
+_bench_env.setup()
+
+from app.mqtt import MQTTPublisher, command_topic
+
+
+async def run(host: str, port: int, room_counts, repeat: int, qos: int):
+    publisher = MQTTPublisher(host, port)
+    publisher.start()
+    # Wait for the first connection so the handshake is not part of the measurement
+    if not await publisher.publish("benchmark/warmup", "1", qos=qos, timeout=10):
+        print(f"Error: no ack from broker at {host}:{port}")
+        return
+
+    print(f"{'rooms':>6} {'commands':>9} {'seconds':>9} {'cmd/s':>10} {'failed':>7}")
+    for count in room_counts:
+        messages = [(command_topic(f"bench{i}", "light"), "OFF") for i in range(count)]
+        total, failed, started = 0, 0, time.perf_counter()
+        for _ in range(repeat):
+            results = await publisher.publish_many(messages, qos=qos, timeout=60)
+            total += len(results)
+            failed += results.count(False)
+        elapsed = time.perf_counter() - started
+        print(f"{count:>6} {total:>9} {elapsed:>9.3f} {total / elapsed:>10.0f} {failed:>7}")
+    publisher.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--rooms", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=10, help="Fan-out bursts per room count")
+    parser.add_argument("--qos", type=int, default=1, choices=[0, 1])
+    args = parser.parse_args()
+    asyncio.run(run(args.host, args.port, args.rooms, args.repeat, args.qos))
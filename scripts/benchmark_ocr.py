@@ -0,0 +1,75 @@
+"""
+Compares slip OCR before and after preprocessing: accuracy and ms/slip.
+
+The corpus is a directory of slip images plus a labels.json mapping each file
+name to its expected fields:
+    {"kbank_001.jpg": {"name": "Somchai Jaidee", "amount": 1500.00}, ...}
+
+    python scripts/benchmark_ocr.py path/to/slips
+"""
+import argparse
+import io
+import json
+import os
+import time
+
+import _bench_env
+
+_bench_env.setup()
+
+import pytesseract
+from PIL import Image
+
+from app.ocr import extract_amount, extract_name, extract_slip_details
+
+
+def raw_ocr(image_bytes: bytes) -> dict | None:
+    """The original path: full-resolution image straight into Tesseract."""
+    text = pytesseract.image_to_string(Image.open(io.BytesIO(image_bytes)), lang='tha+eng')
+    name, amount = extract_name(text), extract_amount(text)
+    return {"name": name, "amount": amount} if name and amount else None
+
+
+def _normalize(name: str) -> str:
+    return "".join(name.split()).casefold()
+
+
+def score(result: dict | None, expected: dict) -> tuple:
+    """Returns (name_ok, amount_ok) for one slip."""
+    if not result:
+        return False, False
+    name_ok = _normalize(expected["name"]) in _normalize(result["name"])
+    amount_ok = abs(result["amount"] - float(expected["amount"])) < 0.005
+    return name_ok, amount_ok
+
+
+def run(corpus: str):
+    with open(os.path.join(corpus, "labels.json"), encoding="utf-8") as f:
+        labels = json.load(f)
+    slips = []
+    for file_name, expected in sorted(labels.items()):
+        with open(os.path.join(corpus, file_name), "rb") as f:
+            slips.append((file_name, f.read(), expected))
+    if not slips:
+        print("Error: labels.json lists no slips")
+        return
+
+    print(f"{'pipeline':<14} {'slips':>5} {'ms/slip':>9} {'name':>7} {'amount':>7} {'both':>7}")
+    for label, fn in (("raw", raw_ocr), ("preprocessed", extract_slip_details)):
+        names = amounts = both = 0
+        started = time.perf_counter()
+        for _, image_bytes, expected in slips:
+            name_ok, amount_ok = score(fn(image_bytes), expected)
+            names += name_ok
+            amounts += amount_ok
+            both += name_ok and amount_ok
+        ms = 1000 * (time.perf_counter() - started) / len(slips)
+        n = len(slips)
+        print(f"{label:<14} {n:>5} {ms:>9.0f} {names / n:>7.0%} {amounts / n:>7.0%} {both / n:>7.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", help="Directory with slip images and labels.json")
+    args = parser.parse_args()
+    run(args.corpus)
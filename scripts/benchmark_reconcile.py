@@ -0,0 +1,102 @@
+"""
+Compares slip-to-booking matching: the old ILIKE scan, the indexed SQL path and
+the in-memory unpaid booking index, on a seeded SQLite database.
+
+    python scripts/benchmark_reconcile.py --bookings 1000 10000 100000
+"""
+import argparse
+import datetime
+import random
+import time
+
+import _bench_env
+
+_bench_env.setup("benchmark_reconcile.db")
+
+from app import reconcile
+from app.database import Booking, SessionLocal, engine, init_db
+
+FIRST_NAMES = ["Somchai", "Anan", "Malee", "Suda", "Niran", "Kanya", "Prasert", "Wanida", "สมชาย", "มาลี", "สุดา", "อนันต์"]
+LAST_NAMES = ["Jaidee", "Srisuk", "Wongsa", "Thongdee", "Boonmee", "ใจดี", "ศรีสุข", "บุญมี", "ทองดี"]
+TITLES = ["", "Mr. ", "Ms. ", "นาย ", "นางสาว ", "คุณ "]
+PRICES = [800.0, 1200.0, 1500.0, 1800.0, 2400.0, 3500.0]
+
+
+def legacy_find(db, name: str, amount: float):
+    """The original matcher: leading-wildcard ILIKE plus float equality."""
+    return db.query(Booking).filter(
+        Booking.customer_name.ilike(f'%{name}%'),
+        Booking.total_price == amount,
+        Booking.is_paid == False
+    ).first()
+
+
+def seed(count: int, unpaid_count: int, rng: random.Random) -> list:
+    """Inserts `count` bookings, `unpaid_count` of them unpaid, and returns slips for some unpaid ones."""
+    Booking.__table__.drop(engine, checkfirst=True)
+    init_db()
+    today = datetime.datetime(2024, 1, 1)
+    unpaid_ids = set(rng.sample(range(count), min(unpaid_count, count)))
+    rows = []
+    for i in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        rows.append({
+            "customer_name": f"{first} {last} {i}",
+            "check_in_date": today,
+            "check_out_date": today + datetime.timedelta(days=1),
+            "room_number": str(100 + i % 50),
+            "total_price": rng.choice(PRICES) + i % 7,
+            "is_paid": i not in unpaid_ids,
+        })
+    with engine.begin() as conn:
+        conn.execute(Booking.__table__.insert(), rows)
+    init_db()  # backfills total_price_satang for the bulk insert
+    unpaid = [r for r in rows if not r["is_paid"]]
+    # Slips show the name with a title and, as OCR does, sometimes without spaces
+    slips = []
+    for r in rng.sample(unpaid, min(200, len(unpaid))):
+        name = rng.choice(TITLES) + r["customer_name"]
+        if rng.random() < 0.3:
+            name = name.replace(" ", "")
+        slips.append((r["customer_name"], name, r["total_price"]))
+    return slips
+
+
+def measure(fn, db, slips) -> tuple:
+    correct = 0
+    started = time.perf_counter()
+    for expected, name, amount in slips:
+        booking = fn(db, name, amount)
+        correct += booking is not None and booking.customer_name == expected
+    elapsed = time.perf_counter() - started
+    return 1000 * elapsed / len(slips), correct / len(slips)
+
+
+def run(counts, unpaid_count: int, seed_value: int):
+    rng = random.Random(seed_value)
+    print(f"{'bookings':>9} {'matcher':<8} {'ms/slip':>9} {'matched':>8}")
+    for count in counts:
+        slips = seed(count, unpaid_count, rng)
+        db = SessionLocal()
+        reconcile.booking_index.invalidate()
+        reconcile.booking_index.refresh(db)  # load outside the measurement
+        index_on = reconcile.RECONCILE_INDEX_ENABLED
+        try:
+            reconcile.RECONCILE_INDEX_ENABLED = False
+            sql = measure(reconcile.match_booking, db, slips)
+            reconcile.RECONCILE_INDEX_ENABLED = True
+            index = measure(reconcile.match_booking, db, slips)
+        finally:
+            reconcile.RECONCILE_INDEX_ENABLED = index_on
+        for label, (ms, matched) in (("ilike", measure(legacy_find, db, slips)), ("sql", sql), ("index", index)):
+            print(f"{count:>9} {label:<8} {ms:>9.3f} {matched:>8.0%}")
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bookings", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--unpaid", type=int, default=500, help="Unpaid bookings; the rest of the history is paid")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    run(args.bookings, args.unpaid, args.seed)
@@ -0,0 +1,99 @@
+"""
+Compares report latency as history grows: the original SUM scans without the
+date indexes, the same scans with them, and the daily_summary rollup.
+
+    python scripts/benchmark_reports.py --years 1 5 20
+"""
+import argparse
+import datetime
+import random
+import time
+
+import _bench_env
+
+_bench_env.setup("benchmark_reports.db")
+
+from sqlalchemy import func
+
+from app.database import Booking, DailySummary, Expense, SessionLocal, engine, get_report_data, init_db, rebuild_daily_summary
+
+
+def scan_report(db, start: datetime.date, end: datetime.date):
+    """The original report: two SUM aggregates with range filters."""
+    start_of_day = datetime.datetime.combine(start, datetime.time.min)
+    end_of_day = datetime.datetime.combine(end, datetime.time.max)
+    income = db.query(func.sum(Booking.total_price)).filter(
+        Booking.is_paid == True,
+        Booking.created_at >= start_of_day,
+        Booking.created_at <= end_of_day
+    ).scalar() or 0.0
+    expenses = db.query(func.sum(Expense.amount)).filter(
+        Expense.date >= start_of_day,
+        Expense.date <= end_of_day
+    ).scalar() or 0.0
+    return {"income": income, "expenses": expenses, "net": income - expenses}
+
+
+def seed(days: int, per_day: int, rng: random.Random):
+    """Bulk-inserts `days` of history ending today, then rebuilds the rollup."""
+    for table in (Booking.__table__, Expense.__table__, DailySummary.__table__):
+        table.drop(engine, checkfirst=True)
+    init_db()
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time(12))
+    bookings, expenses = [], []
+    for d in range(days):
+        at = today - datetime.timedelta(days=d)
+        for i in range(per_day):
+            bookings.append({
+                "customer_name": f"Guest {d}-{i}", "check_in_date": at, "check_out_date": at,
+                "room_number": str(i), "total_price": rng.choice([800.0, 1200.0, 1500.0]),
+                "is_paid": rng.random() < 0.95, "created_at": at,
+            })
+        expenses.append({"description": "supplies", "amount": rng.uniform(100, 2000), "category": "General", "date": at})
+    with engine.begin() as conn:
+        conn.execute(Booking.__table__.insert(), bookings)
+        conn.execute(Expense.__table__.insert(), expenses)
+    with SessionLocal() as db:
+        rebuild_daily_summary(db)
+    return len(bookings)
+
+
+def timed(fn, db, start, end, repeat: int) -> tuple:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(db, start, end)
+    return 1000 * (time.perf_counter() - started) / repeat, result
+
+
+def run(years, per_day: int, repeat: int):
+    rng = random.Random(7)
+    today = datetime.date.today()
+    periods = (("day", today), ("week", today - datetime.timedelta(days=today.weekday())), ("month", today.replace(day=1)))
+    date_indexes = [i for table in (Booking.__table__, Expense.__table__) for i in table.indexes
+                    if {"created_at", "date"} & {c.name for c in i.columns}]
+    print(f"{'years':>5} {'bookings':>9} {'report':<6} {'unindexed ms':>13} {'scan ms':>9} {'rollup ms':>10} {'same':>5}")
+    for y in years:
+        count = seed(365 * y, per_day, rng)
+        results = {}
+        for index in date_indexes:
+            index.drop(engine)
+        with SessionLocal() as db:
+            for label, start in periods:
+                results[label] = [timed(scan_report, db, start, today, repeat)]
+        for index in date_indexes:
+            index.create(engine)
+        with SessionLocal() as db:
+            for label, start in periods:
+                results[label] += [timed(scan_report, db, start, today, repeat), timed(get_report_data, db, start, today, repeat)]
+        for label, ((unindexed_ms, _), (scan_ms, scan), (rollup_ms, rollup)) in results.items():
+            same = abs(scan["net"] - rollup["net"]) < 0.01
+            print(f"{y:>5} {count:>9} {label:<6} {unindexed_ms:>13.2f} {scan_ms:>9.2f} {rollup_ms:>10.2f} {str(same):>5}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--bookings-per-day", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.years, args.bookings_per_day, args.repeat)
@@ -0,0 +1,94 @@
+"""
+Measures the retrieval path in front of Gemini on a seeded database: how many
+operational questions are answered locally without the model, how long local
+answers and top-k lookups take, and how large the grounded prompts are.
+
+    python scripts/benchmark_retrieval.py --bookings 20000 --expenses 5000 --questions 2000
+"""
+import argparse
+import datetime
+import random
+import statistics
+import time
+
+import _bench_env
+
+_bench_env.setup("benchmark_retrieval.db", keep_database_url=True)
+
+from app.config import RETRIEVAL_TOP_K
+from app.database import Booking, Expense, SessionLocal, init_db
+from app import retrieval
+
+NAMES = ["Somchai Jaidee", "Suda Kaewmanee", "John Smith", "Anna Müller", "สมชาย ใจดี", "วิภา ศรีสุข", "Kenji Tanaka"]
+CATEGORIES = ["Utilities", "Laundry", "Repairs", "Supplies", "Staff"]
+
+# Questions the bot gets, as templates: {room}, {booking}, {name} and {category} are filled in
+QUESTIONS = [
+    "is room {room} paid?", "ห้อง {room} จ่ายแล้วหรือยัง", "has booking {booking} paid?",
+    "who is in room {room}?", "which bookings are unpaid?", "ใครค้างจ่ายบ้าง",
+    "income today", "what is the profit this month?", "รายได้เดือนนี้",
+    "when does {name} check out?", "how much did we spend on {category}?",
+    "what is the wifi password?", "can guests bring pets?",
+]
+
+
+def seed(bookings: int, expenses: int):
+    rng = random.Random(7)
+    now = datetime.datetime.now()
+    db = SessionLocal()
+    for i in range(bookings):
+        check_in = now - datetime.timedelta(days=rng.randint(-30, 365))
+        db.add(Booking(customer_name=f"{rng.choice(NAMES)} {i}", room_number=str(rng.randint(1, 40)),
+                       check_in_date=check_in, check_out_date=check_in + datetime.timedelta(days=rng.randint(1, 5)),
+                       total_price=float(rng.randint(8, 40) * 100), is_paid=rng.random() < 0.95))
+    for i in range(expenses):
+        db.add(Expense(description=f"{rng.choice(CATEGORIES).lower()} bill {i}", amount=float(rng.randint(1, 200) * 50),
+                       category=rng.choice(CATEGORIES), date=now - datetime.timedelta(days=rng.randint(0, 365))))
+    db.commit()
+    db.close()
+
+
+def run(bookings: int, expenses: int, questions: int):
+    init_db()
+    seed(bookings, expenses)
+    rng = random.Random(11)
+    db = SessionLocal()
+
+    started = time.perf_counter()
+    retrieval.retrieval_index.refresh(db)
+    print(f"{bookings} bookings, {expenses} expenses: index of {len(retrieval.retrieval_index)} documents "
+          f"built in {1000 * (time.perf_counter() - started):.0f} ms")
+
+    local_ms, search_ms, prompt_chars = [], [], []
+    for _ in range(questions):
+        question = rng.choice(QUESTIONS).format(room=rng.randint(1, 40), booking=rng.randint(1, bookings),
+                                                name=rng.choice(NAMES), category=rng.choice(CATEGORIES))
+        started = time.perf_counter()
+        answer = retrieval.answer_locally(db, question)
+        if answer:
+            local_ms.append(1000 * (time.perf_counter() - started))
+            continue
+        started = time.perf_counter()
+        records = retrieval.search(db, question, RETRIEVAL_TOP_K)
+        search_ms.append(1000 * (time.perf_counter() - started))
+        prompt_chars.append(len(retrieval.build_prompt(question, records)))
+    db.close()
+
+    def p95(values):
+        return sorted(values)[int(0.95 * (len(values) - 1))] if values else 0.0
+
+    print(f"answered locally: {len(local_ms)}/{questions} ({100 * len(local_ms) / questions:.0f}%)")
+    print(f"{'path':<8} {'count':>6} {'p50 ms':>8} {'p95 ms':>8}")
+    for name, values in (("local", local_ms), ("search", search_ms)):
+        print(f"{name:<8} {len(values):>6} {statistics.median(values) if values else 0:>8.2f} {p95(values):>8.2f}")
+    if prompt_chars:
+        print(f"grounded prompt: {statistics.mean(prompt_chars):.0f} chars on average, {max(prompt_chars)} max")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bookings", type=int, default=20000)
+    parser.add_argument("--expenses", type=int, default=5000)
+    parser.add_argument("--questions", type=int, default=2000)
+    args = parser.parse_args()
+    run(args.bookings, args.expenses, args.questions)
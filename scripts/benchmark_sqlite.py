@@ -0,0 +1,116 @@
+"""
+Write/read contention on SQLite: the default rollback-journal setup with every
+thread writing directly, against the WAL profile with writes serialized
+through the single writer thread.
+
+Writer threads record expenses, reader threads build the daily report, for a
+fixed duration per profile:
+    python scripts/benchmark_sqlite.py --writers 8 --readers 8 --seconds 10
+"""
+import argparse
+import datetime
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+import _bench_env
+
+_bench_env.setup()
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base, DatabaseWriter, Expense, apply_sqlite_pragmas, get_daily_report_data
+
+
+def add_expense(db, n: int):
+    db.add(Expense(description=f"benchmark {n}", amount=100.0, category="Benchmark"))
+    db.commit()
+
+
+def run_profile(name: str, tuned: bool, writers: int, readers: int, seconds: float) -> dict:
+    path = os.path.join(tempfile.mkdtemp(), f"{name}.db")
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False},
+                           pool_size=writers + readers, max_overflow=0)
+    if tuned:
+        event.listen(engine, "connect", apply_sqlite_pragmas)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+    writer = DatabaseWriter(Session) if tuned else None
+
+    stop = time.monotonic() + seconds
+    lock = threading.Lock()
+    latencies = {"write": [], "read": []}
+    errors = {"write": 0, "read": 0}
+
+    def write_loop(worker: int):
+        n = 0
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                if writer:
+                    writer.submit(add_expense, n).result()
+                else:
+                    with Session() as db:
+                        add_expense(db, n)
+                with lock:
+                    latencies["write"].append(time.perf_counter() - started)
+            except OperationalError:
+                with lock:
+                    errors["write"] += 1
+            n += 1
+
+    def read_loop(worker: int):
+        today = datetime.date.today()
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                with Session() as db:
+                    get_daily_report_data(db, today)
+                with lock:
+                    latencies["read"].append(time.perf_counter() - started)
+            except OperationalError:
+                with lock:
+                    errors["read"] += 1
+
+    threads = [threading.Thread(target=write_loop, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=read_loop, args=(i,)) for i in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if writer:
+        writer.stop()
+    engine.dispose()
+
+    result = {}
+    for kind in ("write", "read"):
+        values = sorted(latencies[kind])
+        result[kind] = {
+            "ops": len(values) / seconds,
+            "p50_ms": 1000 * statistics.median(values) if values else 0.0,
+            "p95_ms": 1000 * values[int(0.95 * (len(values) - 1))] if values else 0.0,
+            "errors": errors[kind],
+        }
+    return result
+
+
+def run(writers: int, readers: int, seconds: float):
+    print(f"{writers} writer and {readers} reader threads, {seconds:.0f}s per profile")
+    print(f"{'profile':<9} {'kind':<6} {'ops/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'locked':>7}")
+    for name, tuned in (("default", False), ("tuned", True)):
+        result = run_profile(name, tuned, writers, readers, seconds)
+        for kind, r in result.items():
+            print(f"{name:<9} {kind:<6} {r['ops']:>9.0f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['errors']:>7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+    run(args.writers, args.readers, args.seconds)
@@ -0,0 +1,137 @@
+"""
+Startup benchmark. Measures:
+
+  - import: median time to `import app.main` in a fresh interpreter
+  - serving: time from launching uvicorn until / answers
+  - ready: time from launching uvicorn until /ready answers 200 (database
+    and bot started; the bot runs in webhook mode against a local fake Bot API)
+
+and prints each subsystem's state and start time as /ready reports it. With
+--check-lazy it exits with status 1 when importing app.main loads one of the
+modules subsystems start later (LAZY_MODULES), so CI catches a heavy
+dependency creeping back into the import path without relying on timings.
+--max-import-ms fails on a slow median import instead, for local comparisons.
+
+    python scripts/benchmark_startup.py --runs 5
+    python scripts/benchmark_startup.py --check-lazy --skip-server
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark_webhook import ROOT, SECRET, TOKEN, USER_ID, fake_bot_api, free_port, start_app
+
+# Loaded by app/subsystems.py after the server is up; app.main must not import them
+LAZY_MODULES = (
+    "telegram", "sqlalchemy", "aiosqlite", "apscheduler", "shapely", "geofence", "paho", "PIL", "pytesseract",
+    "app.database", "app.bot", "app.ocr", "app.llm", "app.mqtt",
+)
+
+IMPORT_SNIPPET = (
+    "import json, sys, time; started = time.perf_counter(); import app.main; seconds = time.perf_counter() - started; "
+    f"print(json.dumps({{'seconds': seconds, 'lazy': sorted(m for m in {LAZY_MODULES!r} if m in sys.modules)}}))"
+)
+
+
+def app_env(**extra) -> dict:
+    return {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": TOKEN, "TELEGRAM_USER_ID": str(USER_ID),
+        "DATABASE_URL": "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark_startup.db"),
+        "MQTT_BROKER": "127.0.0.1", "MQTT_PORT": "1",  # no broker: MQTT keeps retrying in the background
+        "LOGGING_LEVEL": "WARNING",
+        **extra,
+    }
+
+
+def measure_import(runs: int) -> tuple:
+    """Returns the import times in seconds and the LAZY_MODULES that importing app.main loaded."""
+    env = app_env()
+    timings, loaded = [], set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, env=env, capture_output=True, text=True)
+        if output.returncode != 0:
+            sys.exit(f"Importing app.main failed:\n{output.stderr}")
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        timings.append(result["seconds"])
+        loaded.update(result["lazy"])
+    return timings, sorted(loaded)
+
+
+def measure_server(timeout: float) -> dict:
+    bot_api, _, _ = fake_bot_api()
+    port = free_port()
+    extra = {
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{bot_api.server_port}",
+        "TELEGRAM_WEBHOOK_URL": f"http://127.0.0.1:{port}", "TELEGRAM_WEBHOOK_SECRET": SECRET,
+    }
+    started = time.monotonic()
+    process = start_app(port, 1, app_env(**extra))
+    result = {"serving": None, "ready": None, "subsystems": {}}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=5) as client:
+            deadline = started + timeout
+            while time.monotonic() < deadline and process.poll() is None:
+                try:
+                    if result["serving"] is None and client.get("/").status_code == 200:
+                        result["serving"] = time.monotonic() - started
+                    response = client.get("/ready")
+                    result["subsystems"] = response.json()["subsystems"]
+                    if response.status_code == 200:
+                        result["ready"] = time.monotonic() - started
+                        break
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.02)
+            # Let the optional subsystems finish so their start times are reported too
+            while time.monotonic() < deadline and any(s["state"] in ("pending", "starting") for s in result["subsystems"].values()):
+                time.sleep(0.1)
+                result["subsystems"] = client.get("/ready").json()["subsystems"]
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        bot_api.shutdown()
+    return result
+
+
+def run(args):
+    timings, loaded = measure_import(args.runs)
+    import_ms = 1000 * statistics.median(timings)
+    print(f"import app.main: median {import_ms:.0f} ms, min {1000 * min(timings):.0f} ms over {args.runs} run(s)")
+    print(f"  loads {', '.join(loaded)}" if loaded else "  loads none of the lazily started modules")
+
+    if not args.skip_server:
+        result = measure_server(args.timeout)
+        serving = f"{1000 * result['serving']:.0f} ms" if result["serving"] is not None else "never"
+        ready = f"{1000 * result['ready']:.0f} ms" if result["ready"] is not None else "never"
+        print(f"uvicorn launch to first response: {serving}, to ready: {ready}")
+        for name, subsystem in result["subsystems"].items():
+            seconds = f"{1000 * subsystem['seconds']:.0f} ms" if subsystem["seconds"] is not None else "-"
+            error = f"  ({subsystem['error']})" if subsystem["error"] else ""
+            print(f"  {name:<10} {subsystem['state']:<9} {seconds:>8}{error}")
+        if result["ready"] is None:
+            sys.exit("The app never became ready")
+
+    if args.check_lazy and loaded:
+        sys.exit(f"Importing app.main loads {', '.join(loaded)}; import them from the subsystem that needs them")
+    if args.max_import_ms and import_ms > args.max_import_ms:
+        sys.exit(f"Importing app.main took {import_ms:.0f} ms, more than the {args.max_import_ms:.0f} ms allowed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to time the import in")
+    parser.add_argument("--check-lazy", action="store_true", help="Fail if importing app.main loads a lazily started module")
+    parser.add_argument("--max-import-ms", type=float, default=0, help="Fail if the median import is slower; 0 disables")
+    parser.add_argument("--skip-server", action="store_true", help="Only time the import")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for the app to become ready")
+    run(parser.parse_args())
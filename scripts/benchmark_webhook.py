@@ -0,0 +1,226 @@
+"""
+Load test for webhook mode. Starts the app under uvicorn against a local fake
+Bot API server and the fake Gemini server, then posts updates to the webhook
+route and measures:
+
+  - ack: time until the webhook answers (the update is queued)
+  - reply: time until the bot's first message for that update reaches the fake Bot API
+
+Updates come from a JSONL file of recorded updates (one Update object per line,
+as Telegram posts them) or a synthetic mix of commands, local lookups and AI
+questions. Each replayed update gets its own chat id, so replies can be matched
+to it, and is sent from the authorized user.
+
+    python scripts/benchmark_webhook.py --count 2000 --concurrency 50 --workers 2
+    python scripts/benchmark_webhook.py --updates recorded.jsonl --concurrent-updates 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+import fake_gemini
+
+TOKEN = "123456:benchmark"
+USER_ID = 1
+SECRET = "benchmark-secret"
+CHAT_BASE = 1_000_000
+
+SYNTHETIC = ["/start", "/daily_report", "/status", "is room 5 paid?", "unpaid bookings", "what time is breakfast?"]
+
+
+def fake_bot_api(files: dict = None, last_replies: dict = None):
+    """
+    Minimal Bot API: answers getMe, records the first message sent to each chat.
+    `files` maps file ids to the bytes getFile and the file server hand out;
+    `last_replies`, if given, gets the time of the latest message or edit per chat.
+    """
+    replies = {}  # chat id -> monotonic time of the first message
+    calls = {"setWebhook": 0}
+    files = files or {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            data = files.get(self.path.rsplit("/", 1)[-1])
+            self.send_response(200 if data is not None else 404)
+            self.send_header("Content-Length", str(len(data or b"")))
+            self.end_headers()
+            self.wfile.write(data or b"")
+
+        def do_POST(self):
+            received = time.monotonic()
+            method = self.path.rstrip("/").rsplit("/", 1)[-1]
+            raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if "json" in self.headers.get("Content-Type", ""):
+                params = json.loads(raw or b"{}")
+            else:
+                params = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+            chat_id = int(params.get("chat_id", 0) or 0)
+            with lock:
+                calls[method] = calls.get(method, 0) + 1
+                if method == "sendMessage":
+                    replies.setdefault(chat_id, received)
+                if last_replies is not None and method in ("sendMessage", "editMessageText"):
+                    last_replies[chat_id] = received
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+            elif method == "getFile" and params.get("file_id") in files:
+                file_id = params["file_id"]
+                result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(files[file_id]), "file_path": f"photos/{file_id}"}
+            elif method in ("sendMessage", "editMessageText"):
+                result = {"message_id": calls[method], "date": int(time.time()),
+                          "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+            else:
+                result = True
+            body = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, replies, calls
+
+
+def load_updates(path: str, count: int) -> list:
+    if path:
+        with open(path, encoding="utf-8") as f:
+            recorded = [json.loads(line) for line in f if line.strip()]
+    else:
+        recorded = []
+        for text in SYNTHETIC:
+            message = {"message_id": 1, "date": int(time.time()), "text": text,
+                       "chat": {"id": 0, "type": "private"}, "from": {"id": USER_ID, "is_bot": False, "first_name": "Owner"}}
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            recorded.append({"update_id": 0, "message": message})
+    updates = []
+    for i in range(count):
+        update = json.loads(json.dumps(recorded[i % len(recorded)]))
+        update["update_id"] = i + 1
+        message = update.get("message") or update.get("edited_message")
+        if message:
+            message["chat"] = {"id": CHAT_BASE + i, "type": "private"}
+            message["from"] = {**message.get("from", {}), "id": USER_ID}
+        updates.append(update)
+    return updates
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(port: int, workers: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+
+
+async def post_all(url: str, updates: list, concurrency: int) -> dict:
+    sent = {}
+    acks = []
+    statuses = {}
+    queue = list(reversed(updates))
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker():
+            while queue:
+                update = queue.pop()
+                started = time.monotonic()
+                sent[CHAT_BASE + update["update_id"] - 1] = started
+                response = await client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                acks.append(time.monotonic() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {"sent": sent, "acks": acks, "statuses": statuses}
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[int(p * (len(values) - 1))] if values else 0.0
+
+
+def run(args):
+    bot_api, replies, calls = fake_bot_api()
+    gemini = fake_gemini.serve(latency=args.llm_latency, chunk_delay=0.01)
+    port = args.port or free_port()
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": TOKEN, "TELEGRAM_USER_ID": str(USER_ID), "GEMINI_API_KEY": "benchmark",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{bot_api.server_port}",
+        "TELEGRAM_WEBHOOK_URL": f"http://127.0.0.1:{port}", "TELEGRAM_WEBHOOK_SECRET": SECRET,
+        "TELEGRAM_CONCURRENT_UPDATES": str(args.concurrent_updates),
+        "GEMINI_API_ENDPOINT": f"http://127.0.0.1:{gemini.server_port}",
+        "DATABASE_URL": os.environ.get("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark_webhook.db")),
+        "MQTT_BROKER": "127.0.0.1", "MQTT_PORT": "1",  # no broker: device commands fail fast
+        "LLM_CACHE_TTL": "0", "LOGGING_LEVEL": "WARNING",
+    }
+    process = start_app(port, args.workers, env)
+    try:
+        deadline = time.monotonic() + 60
+        while calls["setWebhook"] < args.workers:
+            if time.monotonic() > deadline or process.poll() is not None:
+                sys.exit("The app did not start")
+            time.sleep(0.2)
+
+        updates = load_updates(args.updates, args.count)
+        url = f"http://127.0.0.1:{port}/telegram/webhook"
+        started = time.monotonic()
+        result = asyncio.run(post_all(url, updates, args.concurrency))
+        posted = time.monotonic() - started
+        deadline = time.monotonic() + args.timeout
+        while len(replies) < len(updates) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        handled = max(replies.values(), default=started) - started
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    latencies = [replies[chat] - sent for chat, sent in result["sent"].items() if chat in replies]
+    print(f"{len(updates)} updates, {args.concurrency} concurrent posts, {args.workers} worker(s), "
+          f"{args.concurrent_updates} concurrent handlers per worker")
+    print(f"webhook responses: {dict(sorted(result['statuses'].items()))}")
+    print(f"accepted: {len(updates) / posted:>8.0f} updates/s   ack p50 {1000 * statistics.median(result['acks']):.1f} ms, "
+          f"p99 {1000 * percentile(result['acks'], 0.99):.1f} ms")
+    if latencies:
+        print(f"handled:  {len(latencies) / handled:>8.0f} updates/s   reply p50 {1000 * statistics.median(latencies):.1f} ms, "
+              f"p95 {1000 * percentile(latencies, 0.95):.1f} ms, p99 {1000 * percentile(latencies, 0.99):.1f} ms")
+    print(f"unanswered: {len(updates) - len(latencies)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", help="JSONL file of recorded updates; default is a synthetic mix")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50, help="Webhook requests in flight")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--concurrent-updates", type=int, default=8, help="TELEGRAM_CONCURRENT_UPDATES for the app")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Fake Gemini seconds before the first byte")
+    parser.add_argument("--port", type=int, default=0, help="Port for the app; default is any free one")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for replies after posting")
+    run(parser.parse_args())
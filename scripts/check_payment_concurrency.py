@@ -0,0 +1,87 @@
+"""
+Fires many payment slips at a small set of unpaid bookings at once and checks
+that verify_payment never lets two slips claim the same booking.
+
+Each worker thread uses its own session, as concurrent handlers do. Exits
+non-zero if any booking ends up with more than one slip, or a claimed booking
+is not marked paid.
+
+    python scripts/check_payment_concurrency.py --bookings 20 --slips 400 --threads 16
+"""
+import argparse
+import datetime
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import _bench_env
+
+_bench_env.setup("check_payment_concurrency.db", keep_database_url=True)
+
+from sqlalchemy.exc import OperationalError
+
+from app.database import Booking, PaymentSlip, SessionLocal, init_db, verify_payment
+
+
+def seed(count: int) -> list:
+    now = datetime.datetime.now()
+    db = SessionLocal()
+    bookings = [
+        Booking(customer_name=f"Guest {i}", check_in_date=now, check_out_date=now + datetime.timedelta(days=1),
+                room_number=str(100 + i), total_price=1500.0)
+        for i in range(count)
+    ]
+    db.add_all(bookings)
+    db.commit()
+    ids = [b.id for b in bookings]
+    db.close()
+    return ids
+
+
+def run(booking_count: int, slip_count: int, threads: int) -> bool:
+    init_db()
+    booking_ids = seed(booking_count)
+    start = threading.Barrier(threads)
+    outcomes = Counter()
+
+    def pay(slip_no: int):
+        if slip_no < threads:
+            start.wait()  # release the first wave together
+        db = SessionLocal()
+        try:
+            booking_id = booking_ids[slip_no % len(booking_ids)]
+            slip = verify_payment(db, booking_id, f"slip-{slip_no}", "{}")
+            return "claimed" if slip else "already paid"
+        except OperationalError:
+            return "database busy"
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for outcome in pool.map(pay, range(slip_count)):
+            outcomes[outcome] += 1
+
+    db = SessionLocal()
+    slips_per_booking = Counter(row.booking_id for row in db.query(PaymentSlip.booking_id).filter(PaymentSlip.booking_id.in_(booking_ids)))
+    unpaid_claimed = db.query(Booking.id).filter(Booking.id.in_(list(slips_per_booking)), Booking.is_paid == False).count()
+    db.close()
+
+    double_claimed = {b: n for b, n in slips_per_booking.items() if n > 1}
+    print(f"slips: {slip_count}, bookings: {booking_count}, threads: {threads}")
+    for outcome, count in sorted(outcomes.items()):
+        print(f"  {outcome:<14} {count:>6}")
+    print(f"  bookings paid  {len(slips_per_booking):>6}")
+    print(f"  double-claimed {len(double_claimed):>6}")
+    ok = not double_claimed and not unpaid_claimed and outcomes["claimed"] == len(slips_per_booking)
+    print("OK" if ok else f"FAILED: {double_claimed or f'{unpaid_claimed} claimed bookings not marked paid'}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bookings", type=int, default=20)
+    parser.add_argument("--slips", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.bookings, args.slips, args.threads) else 1)
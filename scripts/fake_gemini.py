@@ -0,0 +1,100 @@
+"""
+A local stand-in for the Gemini REST API, for testing the LLM gateway without
+a key or network access. Serves generateContent and streamGenerateContent
+(alt=sse) for any model, echoing the prompt back in chunks.
+
+    python scripts/fake_gemini.py --port 8089 --latency 0.5 --chunk-delay 0.05 --fail-rate 0.1
+    GEMINI_API_ENDPOINT=http://localhost:8089 uvicorn app.main:app
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def answer_for(prompt: str, words: int) -> list:
+    """The fake answer, as the chunks it is streamed in."""
+    text = f"You asked: {prompt}. " + " ".join(f"word{i}" for i in range(words))
+    return [piece + " " for piece in text.split(" ")]
+
+
+def make_handler(latency: float, chunk_delay: float, fail_rate: float, words: int):
+    stats = {"requests": 0, "failed": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            with lock:
+                stats["requests"] += 1
+            if not parse_qs(url.query).get("key"):
+                return self._json(403, {"error": {"code": 403, "message": "API key missing"}})
+            time.sleep(latency)
+            if random.random() < fail_rate:
+                with lock:
+                    stats["failed"] += 1
+                return self._json(503, {"error": {"code": 503, "message": "The model is overloaded"}})
+            prompt = body["contents"][-1]["parts"][0]["text"]
+            chunks = answer_for(prompt, words)
+            if url.path.endswith(":generateContent"):
+                return self._json(200, _response("".join(chunks)))
+            if not url.path.endswith(":streamGenerateContent"):
+                return self._json(404, {"error": {"code": 404, "message": "Unknown method"}})
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in chunks:
+                event = f"data: {json.dumps(_response(chunk))}\r\n\r\n".encode()
+                self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+                self.wfile.flush()
+                time.sleep(chunk_delay)
+            self.wfile.write(b"0\r\n\r\n")
+
+    Handler.stats = stats
+    return Handler
+
+
+def _response(text: str) -> dict:
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}]}
+
+
+def serve(port: int = 0, latency: float = 0.0, chunk_delay: float = 0.0, fail_rate: float = 0.0, words: int = 20):
+    """Starts the fake server on a background thread and returns it; `server.server_port` is the bound port."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(latency, chunk_delay, fail_rate, words))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before the first byte")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="Seconds between streamed chunks")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--words", type=int, default=20, help="Extra words in each answer")
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.chunk_delay, args.fail_rate, args.words)
+    print(f"Fake Gemini API on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,176 @@
+"""
+A local stand-in for an MQTT broker, for testing device control without
+Mosquitto or network access. Speaks enough MQTT 3.1.1 for paho: CONNECT,
+PUBLISH (QoS 0-2, acknowledged), SUBSCRIBE with + and # wildcards, PINGREQ and
+DISCONNECT. Messages are forwarded to subscribers at QoS 0 and not retained.
+
+With --echo-states it also plays the devices: every `<root>/<room>/<device>/command`
+is answered with the same payload on `<root>/<room>/<device>/state`, so the
+app's device state cache fills up as it would against real rooms.
+
+    python scripts/fake_mqtt_broker.py --port 1883 --echo-states
+    MQTT_BROKER=127.0.0.1 MQTT_PORT=1883 uvicorn app.main:app
+"""
+import argparse
+import socketserver
+import struct
+import threading
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    pattern_levels, topic_levels = pattern.split("/"), topic.split("/")
+    for i, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+def _packet(kind: int, body: bytes, flags: int = 0) -> bytes:
+    header = bytearray([kind << 4 | flags])
+    length = len(body)
+    while True:
+        byte, length = length % 128, length // 128
+        header.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(header) + body
+
+
+def _string(value: str) -> bytes:
+    data = value.encode()
+    return struct.pack(">H", len(data)) + data
+
+
+def make_handler(echo_states: bool):
+    stats = {"connections": 0, "published": 0, "delivered": 0}
+    sessions = set()  # connected handlers
+    lock = threading.Lock()
+
+    class Handler(socketserver.BaseRequestHandler):
+        def setup(self):
+            self.subscriptions = set()
+            self.send_lock = threading.Lock()
+            with lock:
+                stats["connections"] += 1
+                sessions.add(self)
+
+        def finish(self):
+            with lock:
+                sessions.discard(self)
+
+        def send(self, data: bytes):
+            with self.send_lock:
+                self.request.sendall(data)
+
+        def read(self, size: int) -> bytes:
+            data = b""
+            while len(data) < size:
+                chunk = self.request.recv(size - len(data))
+                if not chunk:
+                    raise ConnectionError("client went away")
+                data += chunk
+            return data
+
+        def handle(self):
+            try:
+                while True:
+                    first = self.read(1)[0]
+                    length, shift = 0, 0
+                    while True:
+                        byte = self.read(1)[0]
+                        length |= (byte & 0x7F) << shift
+                        shift += 7
+                        if not byte & 0x80:
+                            break
+                    if not self.dispatch(first >> 4, first & 0x0F, self.read(length)):
+                        return
+            except (ConnectionError, OSError):
+                return
+
+        def dispatch(self, kind: int, flags: int, body: bytes) -> bool:
+            if kind == CONNECT:
+                self.send(_packet(CONNACK, b"\x00\x00"))
+            elif kind == PUBLISH:
+                qos = (flags >> 1) & 3
+                (size,) = struct.unpack(">H", body[:2])
+                topic, rest = body[2:2 + size].decode(), body[2 + size:]
+                if qos:
+                    packet_id, payload = rest[:2], rest[2:]
+                    self.send(_packet(PUBACK if qos == 1 else PUBREC, packet_id))
+                else:
+                    payload = rest
+                route(topic, payload)
+            elif kind == PUBREL:
+                self.send(_packet(PUBCOMP, body[:2]))
+            elif kind == SUBSCRIBE:
+                packet_id, offset, granted = body[:2], 2, bytearray()
+                while offset < len(body):
+                    (size,) = struct.unpack(">H", body[offset:offset + 2])
+                    self.subscriptions.add(body[offset + 2:offset + 2 + size].decode())
+                    offset += size + 3  # topic filter and its requested QoS
+                    granted.append(0)
+                self.send(_packet(SUBACK, packet_id + bytes(granted)))
+            elif kind == UNSUBSCRIBE:
+                packet_id, offset = body[:2], 2
+                while offset < len(body):
+                    (size,) = struct.unpack(">H", body[offset:offset + 2])
+                    self.subscriptions.discard(body[offset + 2:offset + 2 + size].decode())
+                    offset += size + 2
+                self.send(_packet(UNSUBACK, packet_id))
+            elif kind == PINGREQ:
+                self.send(_packet(PINGRESP, b""))
+            elif kind == DISCONNECT:
+                return False
+            return True
+
+    def route(topic: str, payload: bytes):
+        with lock:
+            stats["published"] += 1
+            targets = [s for s in sessions if any(topic_matches(p, topic) for p in s.subscriptions)]
+        message = _packet(PUBLISH, _string(topic) + payload)
+        for session in targets:
+            try:
+                session.send(message)
+                with lock:
+                    stats["delivered"] += 1
+            except OSError:
+                pass
+        if echo_states and topic.endswith("/command"):
+            route(topic[:-len("command")] + "state", payload)
+
+    Handler.stats = stats
+    return Handler
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(port: int = 0, echo_states: bool = False):
+    """
+    Starts the fake broker on a background thread and returns it;
+    `server.server_address[1]` is the bound port and `server.stats` counts messages.
+    """
+    handler = make_handler(echo_states)
+    server = _Server(("127.0.0.1", port), handler)
+    server.stats = handler.stats
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--echo-states", action="store_true", help="Answer each command with a state report")
+    args = parser.parse_args()
+    server = serve(args.port, args.echo_states)
+    print(f"Fake MQTT broker on 127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,20 @@
+"""
+Recomputes the daily_summary rollup from all paid bookings and expenses.
+
+The rollup is kept up to date on every write and filled on the first start
+after it was added; run this after editing bookings or expenses outside the
+app (e.g. with the sqlite3 shell):
+    python scripts/rebuild_daily_summary.py
+"""
+import _bench_env
+
+_bench_env.setup()
+
+from app.database import SessionLocal, init_db, rebuild_daily_summary
+
+
+if __name__ == "__main__":
+    init_db()
+    with SessionLocal() as db:
+        days = rebuild_daily_summary(db)
+    print(f"Daily summary rebuilt for {days} days")
@@ -9,6 +9,8 @@ cron
 (crontab -l 2>/dev/null; echo "0 0 * * * /usr/local/bin/python /app/scripts/backup_db.py >> /proc/1/fd/1 2>&1") | crontab -
 
 # Start the main application
-# Use uvicorn to run the FastAPI app. The bot will run in a background thread.
+# Use uvicorn to run the FastAPI app. The bot runs on the same event loop, fed by
+# polling, or by the webhook route when TELEGRAM_WEBHOOK_URL is set. Only webhook
+# mode can use more than one worker (WEB_CONCURRENCY).
 echo "Starting FastAPI server and Telegram Bot..."
-uvicorn app.main:app --host 0.0.0.0 --port 7860
+uvicorn app.main:app --host 0.0.0.0 --port 7860 --workers "${WEB_CONCURRENCY:-1}"
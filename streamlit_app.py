@@ -1,6 +1,10 @@
+import uuid
+
 import streamlit as st
 from openai import OpenAI
 
+from app import conversation
+
 # Show title and description.
 st.title("💬 Chatbot")
 st.write(
@@ -20,37 +24,54 @@ else:
     # Create an OpenAI client.
     client = OpenAI(api_key=openai_api_key)
 
-    # Create a session state variable to store the chat messages. This ensures that the
-    # messages persist across reruns.
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
+    # Chat history lives in the app database, so it survives reruns and restarts.
+    # The conversation id is kept in the URL; bookmark it to come back to a chat.
+    db_sessions = st.cache_resource(conversation.connect)()
+    if "conversation" not in st.query_params:
+        st.query_params["conversation"] = uuid.uuid4().hex
+    conversation_id = f"streamlit:{st.query_params['conversation']}"
 
     # Display the existing chat messages via `st.chat_message`.
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    with db_sessions() as db:
+        for turn in conversation.get_turns(db, conversation_id):
+            with st.chat_message(turn.role):
+                st.markdown(turn.content)
 
     # Create a chat input field to allow the user to enter a message. This will display
     # automatically at the bottom of the page.
     if prompt := st.chat_input("What is up?"):
 
         # Store and display the current prompt.
-        st.session_state.messages.append({"role": "user", "content": prompt})
         with st.chat_message("user"):
             st.markdown(prompt)
 
+        # Send only the summary of older turns and the recent ones that fit the
+        # token budget, so the request size stays bounded as the chat grows.
+        with db_sessions() as db:
+            context = conversation.get_context(db, conversation_id)
+        messages = [{"role": "system", "content": f"Summary of the earlier conversation:\n{context['summary']}"}] if context["summary"] else []
+        messages += context["messages"] + [{"role": "user", "content": prompt}]
+
         # Generate a response using the OpenAI API.
         stream = client.chat.completions.create(
             model="gpt-3.5-turbo",
-            messages=[
-                {"role": m["role"], "content": m["content"]}
-                for m in st.session_state.messages
-            ],
+            messages=messages,
             stream=True,
         )
 
-        # Stream the response to the chat using `st.write_stream`, then store it in 
-        # session state.
+        # Stream the response to the chat using `st.write_stream`, then store the
+        # turn and fold older turns into the summary if the history is over budget.
         with st.chat_message("assistant"):
             response = st.write_stream(stream)
-        st.session_state.messages.append({"role": "assistant", "content": response})
+
+        def summarize(instruction: str) -> str:
+            completion = client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[{"role": "user", "content": instruction}],
+            )
+            return completion.choices[0].message.content
+
+        with db_sessions() as db:
+            conversation.add_turn(db, conversation_id, "user", prompt)
+            conversation.add_turn(db, conversation_id, "assistant", response)
+            conversation.compact(db, conversation_id, summarize)
@@ -3,23 +3,69 @@ document.addEventListener('DOMContentLoaded', function() {
     const tg = window.Telegram.WebApp;
     tg.ready();
 
-    // --- Hardware Control --- //
-    document.getElementById('light-on-btn').addEventListener('click', () => {
-        // Sending data to the bot
-        tg.sendData(JSON.stringify({ type: 'hardware_control', device: 'light', command: 'ON' }));
-    });
+    const statusEl = document.getElementById('status');
+    const FLUSH_DELAY_MS = 400; // Clicks within this window go out in one request
 
-    document.getElementById('light-off-btn').addEventListener('click', () => {
-        tg.sendData(JSON.stringify({ type: 'hardware_control', device: 'light', command: 'OFF' }));
-    });
+    // --- Action Queue --- //
+    // Actions are queued and sent together to /api/actions, authenticated with the
+    // signed initData. Without initData, they go out as one sendData batch instead
+    // (sendData closes the Web App, so that path sends at once).
+    let queue = [];
+    let flushTimer = null;
 
-    document.getElementById('ac-on-btn').addEventListener('click', () => {
-        tg.sendData(JSON.stringify({ type: 'hardware_control', device: 'ac', command: 'ON' }));
-    });
+    function showStatus(text) {
+        statusEl.textContent = text;
+    }
 
-    document.getElementById('ac-off-btn').addEventListener('click', () => {
-        tg.sendData(JSON.stringify({ type: 'hardware_control', device: 'ac', command: 'OFF' }));
-    });
+    function enqueue(action, immediately) {
+        queue.push(action);
+        showStatus(`${queue.length} action(s) queued...`);
+        clearTimeout(flushTimer);
+        if (immediately || !tg.initData) {
+            flush();
+        } else {
+            flushTimer = setTimeout(flush, FLUSH_DELAY_MS);
+        }
+    }
+
+    async function flush() {
+        flushTimer = null;
+        const actions = queue;
+        queue = [];
+        if (actions.length === 0) return;
+
+        if (!tg.initData) {
+            tg.sendData(JSON.stringify(actions.length === 1 ? actions[0] : { type: 'batch', actions: actions }));
+            return;
+        }
+        try {
+            const response = await fetch('/api/actions', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json', 'X-Telegram-Init-Data': tg.initData },
+                body: JSON.stringify({ actions: actions })
+            });
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            const data = await response.json();
+            showStatus(data.results.map(r => (r.ok ? '✓ ' : '✗ ') + r.message).join('\n'));
+        } catch (error) {
+            // Keep the actions for the next attempt
+            queue = actions.concat(queue);
+            showStatus(`Could not reach the server (${error.message}). Will retry with the next action.`);
+        }
+    }
+
+    // --- Hardware Control --- //
+    function hardware(device, command) {
+        const target = document.getElementById('hw-target').value.trim();
+        enqueue({ type: 'hardware_control', device: device, command: command, target: target });
+    }
+
+    document.getElementById('light-on-btn').addEventListener('click', () => hardware('light', 'ON'));
+    document.getElementById('light-off-btn').addEventListener('click', () => hardware('light', 'OFF'));
+    document.getElementById('ac-on-btn').addEventListener('click', () => hardware('ac', 'ON'));
+    document.getElementById('ac-off-btn').addEventListener('click', () => hardware('ac', 'OFF'));
 
     // --- Expense Form --- //
     const expenseForm = document.getElementById('expense-form');
@@ -31,23 +77,27 @@ document.addEventListener('DOMContentLoaded', function() {
         const category = document.getElementById('expense-category').value;
 
         if (description && amount) {
-            const expenseData = {
+            enqueue({
                 type: 'expense_add',
                 description: description,
                 amount: parseFloat(amount),
                 category: category
-            };
-            // Send the data to the bot
-            tg.sendData(JSON.stringify(expenseData));
-            
-            // Optional: Show feedback to user and close web app
-            tg.showPopup({title: "Success", message: "Expense has been recorded."}, () => {
-                tg.close();
-            });
-
+            }, true);
+            expenseForm.reset();
         } else {
             tg.showAlert('Please fill in all fields.');
         }
     });
 
+    // Send anything still queued when the Web App is closed
+    window.addEventListener('pagehide', () => {
+        if (queue.length && tg.initData) {
+            const body = JSON.stringify({ actions: queue });
+            fetch('/api/actions', {
+                method: 'POST', keepalive: true, body: body,
+                headers: { 'Content-Type': 'application/json', 'X-Telegram-Init-Data': tg.initData }
+            });
+        }
+    });
+
 });